@@ -77,6 +77,26 @@ class CommonBackend(Backend):
         self._schedule(unique_links)
         self.states.update_cache(unique_links)
 
+    def links_extracted_many(self, batch):
+        seen = OrderedDict()
+        unique_batch = []
+        for request, links in batch:
+            unique = []
+            for link in links:
+                fingerprint = link.meta[b'fingerprint']
+                if fingerprint not in seen:
+                    # depth is taken from the first page linking to it, as the stored copy of link keeps it
+                    link.meta[b'depth'] = request.meta.get(b'depth', 0)+1
+                    seen[fingerprint] = link
+                    unique.append(link)
+            unique_batch.append((request, unique))
+        unique_links = list(seen.values())
+        self.states.fetch(seen.keys())
+        self.states.set_states(unique_links)
+        self.metadata.links_extracted_many(unique_batch)
+        self._schedule(unique_links)
+        self.states.update_cache(unique_links)
+
     def request_error(self, request, error):
         request.meta[b'state'] = States.ERROR
         self.metadata.request_error(request, error)
@@ -10,11 +10,12 @@ from frontera.contrib.backends.remote.codecs.msgpack import Decoder, Encoder
 
 from happybase import Connection
 from msgpack import Unpacker, Packer
+from cachetools import LRUCache
 import six
 from six.moves import range
 from w3lib.util import to_bytes
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 from datetime import datetime
 from calendar import timegm
 from time import time
@@ -25,18 +26,38 @@ from collections import Iterable
 import logging
 
 
+_uint8 = Struct('>B')
+_uint16 = Struct('>H')
+_uint32 = Struct('>I')
+_uint64 = Struct('>Q')
+_float = Struct('>f')
+_packed_states = [_uint8.pack(i) for i in range(256)]
+_packed_zero_depth = _uint32.pack(0)
+
 _pack_functions = {
     'url': to_bytes,
-    'depth': lambda x: pack('>I', 0),
-    'created_at': lambda x: pack('>Q', x),
-    'status_code': lambda x: pack('>H', x),
-    'state': lambda x: pack('>B', x),
+    'depth': lambda x: _packed_zero_depth,
+    'created_at': _uint64.pack,
+    'status_code': _uint16.pack,
+    'state': lambda x: _packed_states[x],
     'error': to_bytes,
     'domain_fingerprint': to_bytes,
-    'score': lambda x: pack('>f', x),
+    'score': _float.pack,
     'content': to_bytes
 }
 
+_columns = dict((k, ('s' if k in ['score', 'state'] else 'c' if k == 'content' else 'm') + ':' + k)
+                for k in _pack_functions)
+_url_column = _columns['url']
+_depth_column = _columns['depth']
+_created_at_column = _columns['created_at']
+_status_code_column = _columns['status_code']
+_state_column = _columns['state']
+_error_column = _columns['error']
+_domain_fingerprint_column = _columns['domain_fingerprint']
+_score_column = _columns['score']
+_content_column = _columns['content']
+
 
 def unpack_score(blob):
     return unpack(">d", blob)[0]
@@ -46,27 +67,77 @@ def prepare_hbase_object(obj=None, **kwargs):
     if not obj:
         obj = dict()
     for k, v in six.iteritems(kwargs):
-        if k in ['score', 'state']:
-            cf = 's'
-        elif k == 'content':
-            cf = 'c'
-        else:
-            cf = 'm'
-        func = _pack_functions[k]
-        obj[cf + ':' + k] = func(v)
+        obj[_columns[k]] = _pack_functions[k](v)
     return obj
 
 
+# Specialized equivalents of prepare_hbase_object() for every metadata event, avoiding per-put column lookups.
+# Timestamps are expected to be packed already with pack_timestamp(), so it can be done once per batch.
+def pack_timestamp(timestamp):
+    return _uint64.pack(timestamp)
+
+
+def prepare_seed_object(url, domain_fingerprint, created_at):
+    return {_url_column: to_bytes(url),
+            _depth_column: _packed_zero_depth,
+            _created_at_column: created_at,
+            _domain_fingerprint_column: to_bytes(domain_fingerprint)}
+
+
+def prepare_link_object(url, domain_fingerprint, created_at):
+    return {_url_column: to_bytes(url),
+            _created_at_column: created_at,
+            _domain_fingerprint_column: to_bytes(domain_fingerprint)}
+
+
+def prepare_crawled_object(status_code, content=None):
+    if content is None:
+        return {_status_code_column: _uint16.pack(status_code)}
+    return {_status_code_column: _uint16.pack(status_code),
+            _content_column: to_bytes(content)}
+
+
+def prepare_error_object(url, error, domain_fingerprint, created_at):
+    return {_url_column: to_bytes(url),
+            _created_at_column: created_at,
+            _error_column: to_bytes(error),
+            _domain_fingerprint_column: to_bytes(domain_fingerprint)}
+
+
+def prepare_state_object(state):
+    return {_state_column: _packed_states[state]}
+
+
+def prepare_score_object(score):
+    return {_score_column: _float.pack(score)}
+
+
 def utcnow_timestamp():
     d = datetime.utcnow()
     return timegm(d.timetuple())
 
 
+def queue_counter_column(rk):
+    """
+    Returns the counter column of queue table row key, each partition and score interval pair has its own counter.
+    E.g. row key 0_0.49_0.50_1466430981413287 is counted in f:0_0.49_0.50 column.
+    """
+    return b'f:' + b'_'.join(to_bytes(rk).split(b'_')[:3])
+
+
 class HBaseQueue(Queue):
 
     GET_RETRIES = 3
+    COUNTERS_ROW = b'_counters'
+    COMPACTION_MAX_ROW_SIZE = 65536
+    COMPACTION_MAX_ROW_ITEMS = 64
+    COMPACTION_SCAN_LIMIT = 10000
 
-    def __init__(self, connection, partitions, table_name, drop=False):
+    def __init__(self, connection, partitions, table_name, drop=False, compaction_interval=0.0):
+        """
+        :param compaction_interval: float, seconds between compactions of a partition, made from within
+            :meth:`get_next_requests` before the partition is scanned. 0 disables compaction.
+        """
         self.connection = connection
         self.partitions = [i for i in range(0, partitions)]
         self.partitioner = Crc32NamePartitioner(self.partitions)
@@ -85,6 +156,9 @@ class HBaseQueue(Queue):
             pass
         self.decoder = Decoder(Request, DumbResponse)
         self.encoder = Encoder(Request)
+        self.compaction_interval = compaction_interval
+        self._started = time()
+        self._last_compaction = dict()
 
     def frontier_start(self):
         pass
@@ -92,6 +166,11 @@ class HBaseQueue(Queue):
     def frontier_stop(self):
         pass
 
+    def _update_counters(self, table, deltas):
+        for column, value in six.iteritems(deltas):
+            if value:
+                table.counter_inc(self.COUNTERS_ROW, column, value=value)
+
     def schedule(self, batch):
         to_schedule = dict()
         now = int(time())
@@ -155,8 +234,11 @@ class HBaseQueue(Queue):
             data.setdefault(rk, []).append((score, item))
 
         table = self.connection.table(self.table_name)
+        counters = dict()
         with table.batch(transaction=True) as b:
             for rk, tuples in six.iteritems(data):
+                column = queue_counter_column(rk)
+                counters[column] = counters.get(column, 0) + len(tuples)
                 obj = dict()
                 for score, item in tuples:
                     column = 'f:%0.3f_%0.3f' % get_interval(score, 0.001)
@@ -171,6 +253,7 @@ class HBaseQueue(Queue):
                     final[column] = stream.getvalue()
                 final[b'f:t'] = str(timestamp)
                 b.put(rk, final)
+        self._update_counters(table, counters)
 
     def get_next_requests(self, max_n_requests, partition_id, **kwargs):
         """
@@ -187,11 +270,17 @@ class HBaseQueue(Queue):
         min_requests = kwargs.pop('min_requests')
         min_hosts = kwargs.pop('min_hosts')
         max_requests_per_host = kwargs.pop('max_requests_per_host')
-        assert(max_n_requests > min_requests)
+        # batches sized to spider credits can be smaller than min_requests
+        min_requests = min(min_requests, max_n_requests)
+        if self.compaction_interval and \
+                time() - self._last_compaction.get(partition_id, self._started) > self.compaction_interval:
+            self.compact(partition_id)
+            self._last_compaction[partition_id] = time()
         table = self.connection.table(self.table_name)
 
         meta_map = {}
         queue = {}
+        row_sizes = {}
         limit = min_requests
         tries = 0
         count = 0
@@ -205,14 +294,17 @@ class HBaseQueue(Queue):
                               tries, limit, count, len(queue.keys()))
             meta_map.clear()
             queue.clear()
+            row_sizes.clear()
             count = 0
             for rk, data in table.scan(limit=int(limit), batch_size=256, filter=filter):
+                row_sizes[rk] = 0
                 for cq, buf in six.iteritems(data):
                     if cq == b'f:t':
                         continue
                     stream = BytesIO(buf)
                     unpacker = Unpacker(stream)
                     for item in unpacker:
+                        row_sizes[rk] += 1
                         fprint, host_crc32, _, _ = item
                         if host_crc32 not in queue:
                             queue[host_crc32] = []
@@ -258,14 +350,91 @@ class HBaseQueue(Queue):
                         results.append(request)
                     trash_can.add(rk)
 
+        counters = dict()
         with table.batch(transaction=True) as b:
             for rk in trash_can:
                 b.delete(rk)
+                column = queue_counter_column(rk)
+                counters[column] = counters.get(column, 0) - row_sizes[rk]
+        self._update_counters(table, counters)
         self.logger.debug("%d row keys removed", len(trash_can))
         return results
 
+    def compact(self, partition_id):
+        """
+        Merges small rows of the partition sharing the same score interval into one row, so that the following
+        scans have to read less rows. Only rows which are already due for crawling are merged. Packed cells are
+        concatenated as is, because msgpack streams can be appended to each other. Merged rows are limited to
+        COMPACTION_MAX_ROW_ITEMS requests, because rows are removed from the queue as a whole.
+
+        Compaction isn't atomic, rows removed from the partition while it's running would be written back. Therefore
+        it has to be called only by the process consuming the partition, in between :meth:`get_next_requests` calls.
+
+        :param partition_id: partition id to compact
+        :return: number of removed rows
+        """
+        table = self.connection.table(self.table_name)
+        prefix = '%d_' % partition_id
+        now_ts = int(time())
+        filter = "PrefixFilter ('%s') AND SingleColumnValueFilter ('f', 't', <=, 'binary:%d')" % (prefix, now_ts)
+        groups = dict()
+        for rk, data in table.scan(limit=self.COMPACTION_SCAN_LIMIT, batch_size=256, filter=filter):
+            size, items = 0, 0
+            for cq, buf in six.iteritems(data):
+                if cq == b'f:t':
+                    continue
+                size += len(buf)
+                items += sum(1 for _ in Unpacker(BytesIO(buf)))
+            if size >= self.COMPACTION_MAX_ROW_SIZE or items >= self.COMPACTION_MAX_ROW_ITEMS:
+                continue
+            groups.setdefault(queue_counter_column(rk), []).append((rk, data, size, items))
+
+        removed = 0
+        with table.batch(transaction=True) as b:
+            for rows in six.itervalues(groups):
+                if len(rows) < 2:
+                    continue
+                merged = dict()
+                size, items = 0, 0
+                rk = None
+                for row_key, data, row_size, row_items in sorted(rows, key=lambda row: row[0]):
+                    if rk is not None and (size + row_size > self.COMPACTION_MAX_ROW_SIZE or
+                                           items + row_items > self.COMPACTION_MAX_ROW_ITEMS):
+                        b.put(rk, merged)
+                        merged = dict()
+                        size, items = 0, 0
+                        rk = None
+                    if rk is None:
+                        rk = row_key
+                    else:
+                        b.delete(row_key)
+                        removed += 1
+                    for cq, buf in six.iteritems(data):
+                        if cq == b'f:t':
+                            merged[cq] = max(merged.get(cq, buf), buf, key=int)
+                            continue
+                        merged[cq] = merged.get(cq, b'') + buf
+                    size += row_size
+                    items += row_items
+                b.put(rk, merged)
+        self.logger.debug("Compaction of partition %d, %d rows removed", partition_id, removed)
+        return removed
+
+    def count_per_partition(self):
+        """
+        Returns count of documents in the queue per partition, read from the counters row.
+
+        :return: dict partition id -> int
+        """
+        table = self.connection.table(self.table_name)
+        counts = dict([(partition_id, 0) for partition_id in self.partitions])
+        for column, value in six.iteritems(table.row(self.COUNTERS_ROW)):
+            partition_id = int(column[2:].split(b'_')[0])
+            counts[partition_id] = counts.get(partition_id, 0) + unpack('>q', value)[0]
+        return counts
+
     def count(self):
-        return NotImplementedError
+        return sum(six.itervalues(self.count_per_partition()))
 
 
 class HBaseState(States):
@@ -277,6 +446,10 @@ class HBaseState(States):
         self._state_cache = {}
         self._cache_size_limit = cache_size_limit
 
+    @property
+    def cache(self):
+        return self._state_cache
+
     def update_cache(self, objs):
         objs = objs if isinstance(objs, Iterable) else [objs]
 
@@ -299,8 +472,7 @@ class HBaseState(States):
         for chunk in chunks(list(self._state_cache.items()), 32768):
             with table.batch(transaction=True) as b:
                 for fprint, state in chunk:
-                    hb_obj = prepare_hbase_object(state=state)
-                    b.put(unhexlify(fprint), hb_obj)
+                    b.put(unhexlify(fprint), prepare_state_object(state))
         if force_clear:
             self.logger.debug("Cache has %d requests, clearing" % len(self._state_cache))
             self._state_cache.clear()
@@ -320,8 +492,14 @@ class HBaseState(States):
 
 
 class HBaseMetadata(Metadata):
-    def __init__(self, connection, table_name, drop_all_tables, use_snappy, batch_size, store_content):
+    def __init__(self, connection, table_name, drop_all_tables, use_snappy, batch_size, store_content,
+                 cache_size=0):
+        """
+        :param cache_size: number of recently written fingerprints to remember. Links already known are not
+            re-written to the table. 0 disables the filter.
+        """
         self._table_name = table_name
+        self.logger = logging.getLogger("hbase.metadata")
         tables = set(connection.tables())
         if drop_all_tables and self._table_name in tables:
             connection.delete_table(self._table_name, disable=True)
@@ -340,6 +518,11 @@ class HBaseMetadata(Metadata):
         table = connection.table(self._table_name)
         self.batch = table.batch(batch_size=batch_size)
         self.store_content = store_content
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.stats = {
+            'links_written': 0,
+            'links_skipped': 0
+        }
 
     def frontier_start(self):
         pass
@@ -349,45 +532,50 @@ class HBaseMetadata(Metadata):
 
     def flush(self):
         self.batch.send()
+        self.logger.debug("Links written %d, skipped as already known %d",
+                          self.stats['links_written'], self.stats['links_skipped'])
+
+    def _remember(self, rk):
+        if self.cache is not None:
+            self.cache[rk] = True
 
     def add_seeds(self, seeds):
+        created_at = pack_timestamp(utcnow_timestamp())
         for seed in seeds:
-            obj = prepare_hbase_object(url=seed.url,
-                                       depth=0,
-                                       created_at=utcnow_timestamp(),
-                                       domain_fingerprint=seed.meta[b'domain'][b'fingerprint'])
-            self.batch.put(unhexlify(seed.meta[b'fingerprint']), obj)
+            obj = prepare_seed_object(seed.url, seed.meta[b'domain'][b'fingerprint'], created_at)
+            rk = unhexlify(seed.meta[b'fingerprint'])
+            self.batch.put(rk, obj)
+            self._remember(rk)
 
     def page_crawled(self, response):
-        obj = prepare_hbase_object(status_code=response.status_code, content=response.body) if self.store_content else \
-            prepare_hbase_object(status_code=response.status_code)
+        obj = prepare_crawled_object(response.status_code, response.body if self.store_content else None)
         self.batch.put(unhexlify(response.meta[b'fingerprint']), obj)
 
     def links_extracted(self, request, links):
+        created_at = pack_timestamp(utcnow_timestamp())
         links_dict = dict()
         for link in links:
             links_dict[unhexlify(link.meta[b'fingerprint'])] = (link, link.url, link.meta[b'domain'])
         for link_fingerprint, (link, link_url, link_domain) in six.iteritems(links_dict):
-            obj = prepare_hbase_object(url=link_url,
-                                       created_at=utcnow_timestamp(),
-                                       domain_fingerprint=link_domain[b'fingerprint'])
-            self.batch.put(link_fingerprint, obj)
+            if self.cache is not None and link_fingerprint in self.cache:
+                self.stats['links_skipped'] += 1
+                continue
+            self.batch.put(link_fingerprint, prepare_link_object(link_url, link_domain[b'fingerprint'], created_at))
+            self._remember(link_fingerprint)
+            self.stats['links_written'] += 1
 
     def request_error(self, request, error):
-        obj = prepare_hbase_object(url=request.url,
-                                   created_at=utcnow_timestamp(),
-                                   error=error,
-                                   domain_fingerprint=request.meta[b'domain'][b'fingerprint'])
+        obj = prepare_error_object(request.url, error, request.meta[b'domain'][b'fingerprint'],
+                                   pack_timestamp(utcnow_timestamp()))
         rk = unhexlify(request.meta[b'fingerprint'])
         self.batch.put(rk, obj)
+        self._remember(rk)
 
     def update_score(self, batch):
         if not isinstance(batch, dict):
             raise TypeError('batch should be dict with fingerprint as key, and float score as value')
         for fprint, (score, url, schedule) in six.iteritems(batch):
-            obj = prepare_hbase_object(score=score)
-            rk = unhexlify(fprint)
-            self.batch.put(rk, obj)
+            self.batch.put(unhexlify(fprint), prepare_score_object(score))
 
 
 class HBaseBackend(DistributedBackend):
@@ -436,10 +624,11 @@ class HBaseBackend(DistributedBackend):
         settings = manager.settings
         drop_all_tables = settings.get('HBASE_DROP_ALL_TABLES')
         o._queue = HBaseQueue(o.connection, o.queue_partitions,
-                              settings.get('HBASE_QUEUE_TABLE'), drop=drop_all_tables)
+                              settings.get('HBASE_QUEUE_TABLE'), drop=drop_all_tables,
+                              compaction_interval=settings.get('HBASE_QUEUE_COMPACTION_INTERVAL'))
         o._metadata = HBaseMetadata(o.connection, settings.get('HBASE_METADATA_TABLE'), drop_all_tables,
                                     settings.get('HBASE_USE_SNAPPY'), settings.get('HBASE_BATCH_SIZE'),
-                                    settings.get('STORE_CONTENT'))
+                                    settings.get('STORE_CONTENT'), settings.get('HBASE_METADATA_CACHE_SIZE'))
         return o
 
     @property
@@ -478,7 +667,9 @@ class HBaseBackend(DistributedBackend):
         self.metadata.request_error(page, error)
 
     def finished(self):
-        raise NotImplementedError
+        if self.queue is None:
+            raise NotImplementedError
+        return self.queue.count() == 0
 
     def get_next_requests(self, max_next_requests, **kwargs):
         next_pages = []
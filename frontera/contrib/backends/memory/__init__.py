@@ -128,6 +128,10 @@ class MemoryStates(States):
         self._cache_size_limit = cache_size_limit
         self.logger = logging.getLogger("memory.states")
 
+    @property
+    def cache(self):
+        return self._cache
+
     def _put(self, obj):
         self._cache[obj.meta[b'fingerprint']] = obj.meta[b'state']
 
@@ -199,6 +203,13 @@ class MemoryBaseBackend(CommonBackend):
             self._id += 1
         super(MemoryBaseBackend, self).links_extracted(request, links)
 
+    def links_extracted_many(self, batch):
+        for _, links in batch:
+            for link in links:
+                link.meta[b'id'] = self._id
+                self._id += 1
+        super(MemoryBaseBackend, self).links_extracted_many(batch)
+
     def finished(self):
         return self.queue.count() == 0
 
@@ -248,10 +259,33 @@ class MemoryRandomBackend(MemoryBaseBackend):
 class MemoryDFSOverusedBackend(MemoryDFSBackend):
     def __init__(self, manager):
         super(MemoryDFSOverusedBackend, self).__init__(manager)
-        self.overused_buffer = OverusedBuffer(super(MemoryDFSOverusedBackend, self).get_next_requests)
+        settings = manager.settings
+        self.overused_buffer = OverusedBuffer(super(MemoryDFSOverusedBackend, self).get_next_requests,
+                                              max_per_key=settings.get('OVERUSED_MAX_PER_KEY') or None,
+                                              max_pending=settings.get('OVERUSED_MAX_PENDING') or None,
+                                              overflow_func=self._hold)
+        self._overflowed = []
+
+    def _hold(self, requests):
+        self._overflowed.extend(requests)
+
+    def _reschedule(self, requests):
+        self.queue.schedule([(request.meta[b'fingerprint'], request.meta.get(b'_scr', 1.0), request, True)
+                             for request in requests])
+        self.queue_size += len(requests)
 
     def get_next_requests(self, max_next_requests, **kwargs):
-        return self.overused_buffer.get_next_requests(max_next_requests, **kwargs)
+        # overflowed requests are held aside till the end of call and requests behind them are taken from queue, so
+        # other keys don't starve behind requests of overused keys
+        self._overflowed = []
+        requests = self.overused_buffer.get_next_requests(max_next_requests, **kwargs)
+        overflowed = 0
+        while len(requests) < max_next_requests and len(self._overflowed) > overflowed:
+            overflowed = len(self._overflowed)
+            requests.extend(self.overused_buffer.get_next_requests(max_next_requests - len(requests), **kwargs))
+        self._reschedule(self._overflowed)
+        self._overflowed = []
+        return requests
 
 
 BASE = MemoryBaseBackend
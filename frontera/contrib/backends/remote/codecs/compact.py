@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+""" A compact binary codec for Frontera. Implemented in pure Python, no extra libraries needed.
+
+Well-known meta keys are stored at fixed positions, marked in a presence bit mask, instead of repeating the keys.
+Strings are interned in a per-message table, which is pre-filled with common keys and values, so every repeated
+string costs one or two bytes. Domain records repeated by links of the same host are referenced by index, hex
+fingerprints are packed to raw bytes and integers are varint encoded.
+"""
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+from struct import Struct
+import re
+
+import six
+from six.moves import range
+from w3lib.util import to_bytes, to_native_str
+
+from frontera.core.codec import BaseDecoder, BaseEncoder, LazyMessage
+
+
+# Strings every message string table starts with. Appending to this list is backward compatible only if all
+# producers are updated first, changing the existing order isn't.
+STATIC_STRINGS = [
+    b'', b'-', b'GET', b'POST', b'HEAD', b'http', b'https', b'fingerprint', b'domain', b'netloc', b'name', b'scheme',
+    b'sld', b'tld', b'subdomain', b'state', b'depth', b'jid', b'score', b'id', b'_scr', b'error', b'created_at',
+    b'is_seed', b'scrapy_meta', b'scrapy_callback', b'scrapy_errback', b'origin_is_frontier', b'frontier_request',
+    b'redirect_urls', b'redirect_domains', b'redirect_fingerprints', b'redirect_times', b'redirect_ttl',
+    b'download_timeout', b'download_slot', b'download_latency', b'link_text', b'rule', b'referer', b'Referer',
+    b'Cookie', b'Accept', b'Accept-Language', b'Accept-Encoding', b'User-Agent', b'Content-Type', b'text/html',
+    b'parse', b'com', b'org', b'net', b'www'
+]
+
+# Meta keys stored at fixed positions.
+FIXED_META = [
+    b'fingerprint', b'domain', b'state', b'depth', b'jid', b'score', b'origin_is_frontier', b'scrapy_callback',
+    b'scrapy_errback', b'scrapy_meta'
+]
+
+NONE, FALSE, TRUE, INT, FLOAT, STRING, LIST, DICT, HEX, BINARY = range(10)
+
+ADD_SEEDS, PAGE_CRAWLED, LINKS_EXTRACTED, REQUEST_ERROR, UPDATE_SCORE, NEW_JOB_ID, OFFSET, CREDITS = range(1, 9)
+
+_message_types = {
+    ADD_SEEDS: 'add_seeds',
+    PAGE_CRAWLED: 'page_crawled',
+    LINKS_EXTRACTED: 'links_extracted',
+    REQUEST_ERROR: 'request_error',
+    UPDATE_SCORE: 'update_score',
+    NEW_JOB_ID: 'new_job_id',
+    OFFSET: 'offset',
+    CREDITS: 'credits'
+}
+_static_index = dict((s, i) for i, s in enumerate(STATIC_STRINGS))
+_fixed_meta = [(1 << i, key) for i, key in enumerate(FIXED_META)]
+_fixed_meta_keys = frozenset(FIXED_META)
+_double = Struct('>d')
+_hex = re.compile(b'^(?:[0-9a-f][0-9a-f]){8,}$')
+
+
+class _Writer(object):
+    def __init__(self):
+        self.out = bytearray()
+        self.strings = dict(_static_index)
+        self.domains = {}
+        self.domains_count = 0
+
+    def varint(self, value):
+        out = self.out
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    def string(self, value):
+        idx = self.strings.get(value)
+        if idx is not None:
+            self.varint(idx << 1 | 1)
+            return
+        self.strings[value] = len(self.strings)
+        self.varint(len(value) << 1)
+        self.out += value
+
+    def binary(self, value):
+        if value is None:
+            self.out.append(NONE)
+            return
+        self.out.append(BINARY)
+        self.varint(len(value))
+        self.out += value
+
+    def value(self, obj):
+        out = self.out
+        if obj is None:
+            out.append(NONE)
+        elif obj is True:
+            out.append(TRUE)
+        elif obj is False:
+            out.append(FALSE)
+        elif isinstance(obj, six.binary_type):
+            if len(obj) >= 16 and _hex.match(obj):
+                out.append(HEX)
+                self.varint(len(obj) >> 1)
+                out += unhexlify(obj)
+            else:
+                out.append(STRING)
+                self.string(obj)
+        elif isinstance(obj, six.text_type):
+            out.append(STRING)
+            self.string(obj.encode('utf8'))
+        elif isinstance(obj, six.integer_types):
+            out.append(INT)
+            self.varint(obj << 1 if obj >= 0 else (-obj << 1) - 1)
+        elif isinstance(obj, float):
+            out.append(FLOAT)
+            out += _double.pack(obj)
+        elif isinstance(obj, dict):
+            out.append(DICT)
+            self.varint(len(obj))
+            for key, value in six.iteritems(obj):
+                self.value(key)
+                self.value(value)
+        elif isinstance(obj, (list, tuple)):
+            out.append(LIST)
+            self.varint(len(obj))
+            for item in obj:
+                self.value(item)
+        elif hasattr(obj, '__dict__'):
+            self.value(obj.__dict__)
+        else:
+            out.append(NONE)
+
+    def domain(self, domain):
+        try:
+            key = frozenset(six.iteritems(domain))
+        except (TypeError, AttributeError):
+            key = None
+        idx = self.domains.get(key) if key is not None else None
+        if idx is not None:
+            self.varint(idx << 1 | 1)
+            return
+        self.varint(0)
+        if key is not None:
+            self.domains[key] = self.domains_count
+        self.domains_count += 1
+        self.value(domain)
+
+    def meta(self, meta):
+        mask = 0
+        for bit, key in _fixed_meta:
+            if key in meta:
+                mask |= bit
+        self.varint(mask)
+        for bit, key in _fixed_meta:
+            if mask & bit:
+                if key == b'domain':
+                    self.domain(meta[key])
+                else:
+                    self.value(meta[key])
+        extra = [key for key in meta if key not in _fixed_meta_keys]
+        self.varint(len(extra))
+        for key in extra:
+            self.value(key)
+            self.value(meta[key])
+
+    def request(self, request):
+        self.string(to_bytes(request.url))
+        self.string(to_bytes(request.method))
+        self.value(request.headers)
+        self.value(request.cookies)
+        self.meta(request.meta)
+
+    def response(self, response, send_body):
+        self.string(to_bytes(response.url))
+        self.value(response.status_code)
+        self.meta(response.meta)
+        self.binary(response.body if send_body else None)
+
+
+class Encoder(BaseEncoder):
+    def __init__(self, request_model, *a, **kw):
+        self.send_body = True if 'send_body' in kw and kw['send_body'] else False
+
+    def _start(self, type):
+        writer = _Writer()
+        writer.out.append(type)
+        return writer
+
+    def encode_add_seeds(self, seeds):
+        writer = self._start(ADD_SEEDS)
+        writer.varint(len(seeds))
+        for seed in seeds:
+            writer.request(seed)
+        return bytes(writer.out)
+
+    def encode_page_crawled(self, response):
+        writer = self._start(PAGE_CRAWLED)
+        writer.response(response, self.send_body)
+        return bytes(writer.out)
+
+    def encode_links_extracted(self, request, links):
+        writer = self._start(LINKS_EXTRACTED)
+        writer.request(request)
+        writer.varint(len(links))
+        for link in links:
+            writer.request(link)
+        return bytes(writer.out)
+
+    def encode_request_error(self, request, error):
+        writer = self._start(REQUEST_ERROR)
+        writer.request(request)
+        writer.string(to_bytes(str(error)))
+        return bytes(writer.out)
+
+    def encode_request(self, request):
+        writer = _Writer()
+        writer.request(request)
+        return bytes(writer.out)
+
+    def encode_update_score(self, request, score, schedule):
+        writer = self._start(UPDATE_SCORE)
+        writer.request(request)
+        writer.value(score)
+        writer.value(schedule)
+        return bytes(writer.out)
+
+    def encode_new_job_id(self, job_id):
+        writer = self._start(NEW_JOB_ID)
+        writer.varint(int(job_id))
+        return bytes(writer.out)
+
+    def encode_offset(self, partition_id, offset):
+        writer = self._start(OFFSET)
+        writer.varint(int(partition_id))
+        writer.varint(int(offset))
+        return bytes(writer.out)
+
+    def encode_credits(self, partition_id, offset, credits):
+        writer = self._start(CREDITS)
+        writer.varint(int(partition_id))
+        writer.varint(int(offset))
+        writer.varint(int(credits))
+        return bytes(writer.out)
+
+
+class _Reader(object):
+    def __init__(self, buffer):
+        self.data = bytes(buffer)
+        self.octets = self.data if six.PY3 else bytearray(self.data)
+        self.pos = 0
+        self.strings = list(STATIC_STRINGS)
+        self.domains = []
+
+    def byte(self):
+        value = self.octets[self.pos]
+        self.pos += 1
+        return value
+
+    def varint(self):
+        octets = self.octets
+        pos = self.pos
+        byte = octets[pos]
+        pos += 1
+        if byte < 0x80:
+            self.pos = pos
+            return byte
+        result = byte & 0x7f
+        shift = 7
+        while True:
+            byte = octets[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return result
+
+    def raw(self, length):
+        end = self.pos + length
+        value = self.data[self.pos:end]
+        self.pos = end
+        return value
+
+    def string(self):
+        value = self.varint()
+        if value & 1:
+            return self.strings[value >> 1]
+        value = self.raw(value >> 1)
+        self.strings.append(value)
+        return value
+
+    def value(self):
+        tag = self.byte()
+        if tag == STRING:
+            return self.string()
+        if tag == INT:
+            value = self.varint()
+            return -((value + 1) >> 1) if value & 1 else value >> 1
+        if tag == NONE:
+            return None
+        if tag == TRUE:
+            return True
+        if tag == FALSE:
+            return False
+        if tag == HEX:
+            return hexlify(self.raw(self.varint()))
+        if tag == DICT:
+            obj = {}
+            for _ in range(self.varint()):
+                key = self.value()
+                obj[key] = self.value()
+            return obj
+        if tag == LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == FLOAT:
+            value, = _double.unpack_from(self.data, self.pos)
+            self.pos += 8
+            return value
+        if tag == BINARY:
+            return self.raw(self.varint())
+        raise TypeError('Unknown value tag %d' % tag)
+
+    def domain(self):
+        ref = self.varint()
+        if ref & 1:
+            return dict(self.domains[ref >> 1])
+        domain = self.value()
+        self.domains.append(domain)
+        return dict(domain) if isinstance(domain, dict) else domain
+
+    def meta(self):
+        mask = self.varint()
+        meta = {}
+        for bit, key in _fixed_meta:
+            if mask & bit:
+                meta[key] = self.domain() if key == b'domain' else self.value()
+        for _ in range(self.varint()):
+            key = self.value()
+            meta[key] = self.value()
+        return meta
+
+
+class Decoder(BaseDecoder):
+    supports_buffers = True
+
+    def __init__(self, request_model, response_model, *a, **kw):
+        self._request_model = request_model
+        self._response_model = response_model
+
+    def _read_request_fields(self, reader):
+        return reader.string(), reader.string(), reader.value(), reader.value(), reader.meta()
+
+    def _request_from_fields(self, fields):
+        url, method, headers, cookies, meta = fields
+        return self._request_model(url=to_native_str(url),
+                                   method=method,
+                                   headers=headers,
+                                   cookies=cookies,
+                                   meta=meta)
+
+    def _read_request(self, reader):
+        return self._request_from_fields(self._read_request_fields(reader))
+
+    def _read_response_fields(self, reader):
+        return reader.string(), reader.value(), reader.meta(), reader.value()
+
+    def _response_from_fields(self, fields):
+        url, status_code, meta, body = fields
+        url = to_native_str(url)
+        return self._response_model(url=url,
+                                    status_code=status_code,
+                                    body=body,
+                                    request=self._request_model(url=url, meta=meta))
+
+    def _read_head(self, type, reader):
+        """
+        Reads fields of request or response the message starts with, without creating objects.
+        """
+        if type == PAGE_CRAWLED:
+            return self._read_response_fields(reader)
+        if type in (LINKS_EXTRACTED, REQUEST_ERROR, UPDATE_SCORE):
+            return self._read_request_fields(reader)
+        return None
+
+    def _decode_message(self, type, head, reader):
+        if type == PAGE_CRAWLED:
+            return ('page_crawled', self._response_from_fields(head))
+        if type == LINKS_EXTRACTED:
+            request = self._request_from_fields(head)
+            return ('links_extracted', request, [self._read_request(reader) for _ in range(reader.varint())])
+        if type == UPDATE_SCORE:
+            return ('update_score', self._request_from_fields(head), reader.value(), reader.value())
+        if type == REQUEST_ERROR:
+            return ('request_error', self._request_from_fields(head), to_native_str(reader.string()))
+        if type == ADD_SEEDS:
+            return ('add_seeds', [self._read_request(reader) for _ in range(reader.varint())])
+        if type == NEW_JOB_ID:
+            return ('new_job_id', reader.varint())
+        if type == OFFSET:
+            return ('offset', reader.varint(), reader.varint())
+        if type == CREDITS:
+            return ('credits', reader.varint(), reader.varint(), reader.varint())
+        raise TypeError('Unknown message type')
+
+    def decode(self, buffer):
+        reader = _Reader(buffer)
+        type = reader.byte()
+        return self._decode_message(type, self._read_head(type, reader), reader)
+
+    def decode_lazy(self, buffer):
+        reader = _Reader(buffer)
+        type = reader.byte()
+        if type not in _message_types:
+            raise TypeError('Unknown message type')
+        head = self._read_head(type, reader)
+        job_id = None
+        if head is not None:
+            meta = head[2] if type == PAGE_CRAWLED else head[4]
+            job_id = meta.get(b'jid')
+        return LazyMessage(_message_types[type], job_id, lambda: self._decode_message(type, head, reader))
+
+    def decode_request(self, buffer):
+        return self._read_request(_Reader(buffer))
@@ -4,7 +4,7 @@
 from __future__ import absolute_import
 import json
 from base64 import b64decode, b64encode
-from frontera.core.codec import BaseDecoder, BaseEncoder
+from frontera.core.codec import BaseDecoder, BaseEncoder, LazyMessage
 from w3lib.util import to_unicode, to_native_str
 from frontera.utils.misc import dict_to_unicode, dict_to_bytes
 
@@ -93,6 +93,14 @@ class Encoder(BaseEncoder, CrawlFrontierJSONEncoder):
             'offset': int(offset)
         })
 
+    def encode_credits(self, partition_id, offset, credits):
+        return self.encode({
+            'type': 'credits',
+            'partition_id': int(partition_id),
+            'offset': int(offset),
+            'credits': int(credits)
+        })
+
 
 class Decoder(json.JSONDecoder, BaseDecoder):
     def __init__(self, request_model, response_model, *a, **kw):
@@ -117,7 +125,15 @@ class Decoder(json.JSONDecoder, BaseDecoder):
                                    meta=obj[b'meta'])
 
     def decode(self, message):
-        message = dict_to_bytes(super(Decoder, self).decode(message))
+        return self._decode_object(dict_to_bytes(super(Decoder, self).decode(message)))
+
+    def decode_lazy(self, message):
+        obj = super(Decoder, self).decode(message)
+        type = to_native_str(obj['type'])
+        job_id = obj['r']['meta'].get('jid') if 'r' in obj else None
+        return LazyMessage(type, job_id, lambda: self._decode_object(dict_to_bytes(obj)))
+
+    def _decode_object(self, message):
         if message[b'type'] == b'links_extracted':
             request = self._request_from_object(message[b'r'])
             links = [self._request_from_object(link) for link in message[b'links']]
@@ -140,6 +156,8 @@ class Decoder(json.JSONDecoder, BaseDecoder):
             return ('new_job_id', int(message[b'job_id']))
         if message[b'type'] == b'offset':
             return ('offset', int(message[b'partition_id']), int(message[b'offset']))
+        if message[b'type'] == b'credits':
+            return ('credits', int(message[b'partition_id']), int(message[b'offset']), int(message[b'credits']))
         return TypeError('Unknown message type')
 
     def decode_request(self, message):
@@ -3,34 +3,21 @@
 """
 from __future__ import absolute_import
 
-from msgpack import packb, unpackb
+from msgpack import Packer, Unpacker
 
-from frontera.core.codec import BaseDecoder, BaseEncoder
-import six
+from frontera.core.codec import BaseDecoder, BaseEncoder, LazyMessage
 from w3lib.util import to_native_str
 
 
+def _serialize(obj):
+    """Called by packer for objects msgpack doesn't support natively."""
+    if hasattr(obj, '__dict__'):
+        return obj.__dict__
+    return None
+
+
 def _prepare_request_message(request):
-    def serialize(obj):
-        """Recursively walk object's hierarchy."""
-        if isinstance(obj, six.text_type):
-            return obj.encode('utf8')
-        if isinstance(obj, (bool, six.integer_types, float, six.binary_type)):
-            return obj
-        elif isinstance(obj, dict):
-            obj = obj.copy()
-            for key in obj:
-                obj[key] = serialize(obj[key])
-            return obj
-        elif isinstance(obj, list):
-            return [serialize(item) for item in obj]
-        elif isinstance(obj, tuple):
-            return tuple(serialize([item for item in obj]))
-        elif hasattr(obj, '__dict__'):
-            return serialize(obj.__dict__)
-        else:
-            return None
-    return [request.url, request.method, request.headers, request.cookies, serialize(request.meta)]
+    return [request.url, request.method, request.headers, request.cookies, request.meta]
 
 
 def _prepare_response_message(response, send_body):
@@ -38,38 +25,83 @@ def _prepare_response_message(response, send_body):
 
 
 class Encoder(BaseEncoder):
+    """
+    Packer is reused between messages, so encoder instances shouldn't be shared between threads.
+    """
     def __init__(self, request_model, *a, **kw):
         self.send_body = True if 'send_body' in kw and kw['send_body'] else False
+        self._packer = Packer(default=_serialize, use_bin_type=False)
 
     def encode_add_seeds(self, seeds):
-        return packb([b'as', [_prepare_request_message(seed) for seed in seeds]])
+        return self._packer.pack([b'as', [_prepare_request_message(seed) for seed in seeds]])
 
     def encode_page_crawled(self, response):
-        return packb([b'pc', _prepare_response_message(response, self.send_body)])
+        return self._packer.pack([b'pc', _prepare_response_message(response, self.send_body)])
 
     def encode_links_extracted(self, request, links):
-        return packb([b'le', _prepare_request_message(request), [_prepare_request_message(link) for link in links]])
+        return self._packer.pack([b'le', _prepare_request_message(request),
+                                  [_prepare_request_message(link) for link in links]])
 
     def encode_request_error(self, request, error):
-        return packb([b're', _prepare_request_message(request), str(error)])
+        return self._packer.pack([b're', _prepare_request_message(request), str(error)])
 
     def encode_request(self, request):
-        return packb(_prepare_request_message(request))
+        return self._packer.pack(_prepare_request_message(request))
 
     def encode_update_score(self, request, score, schedule):
-        return packb([b'us', _prepare_request_message(request), score, schedule])
+        return self._packer.pack([b'us', _prepare_request_message(request), score, schedule])
 
     def encode_new_job_id(self, job_id):
-        return packb([b'njid', int(job_id)])
+        return self._packer.pack([b'njid', int(job_id)])
 
     def encode_offset(self, partition_id, offset):
-        return packb([b'of', int(partition_id), int(offset)])
+        return self._packer.pack([b'of', int(partition_id), int(offset)])
+
+    def encode_credits(self, partition_id, offset, credits):
+        return self._packer.pack([b'cr', int(partition_id), int(offset), int(credits)])
+
+
+_message_types = {
+    b'pc': 'page_crawled',
+    b'le': 'links_extracted',
+    b'us': 'update_score',
+    b're': 'request_error',
+    b'as': 'add_seeds',
+    b'njid': 'new_job_id',
+    b'of': 'offset',
+    b'cr': 'credits'
+}
 
 
 class Decoder(BaseDecoder):
+    """
+    Messages are fed one after another into the same streaming unpacker, so decoder instances shouldn't be shared
+    between threads.
+    """
+    supports_buffers = True
+
     def __init__(self, request_model, response_model, *a, **kw):
         self._request_model = request_model
         self._response_model = response_model
+        self._reset()
+
+    def _reset(self):
+        self._unpacker = Unpacker(raw=True)
+        self._fed = 0
+
+    def _unpack(self, buffer):
+        self._unpacker.feed(buffer)
+        self._fed += len(buffer)
+        try:
+            obj = self._unpacker.unpack()
+        except Exception:
+            # truncated or broken message, leftovers mustn't spoil next messages
+            self._reset()
+            raise
+        if self._unpacker.tell() != self._fed:
+            self._reset()
+            raise ValueError('Extra data after message')
+        return obj
 
     def _response_from_object(self, obj):
         url = to_native_str(obj[0])
@@ -87,7 +119,22 @@ class Decoder(BaseDecoder):
                                    meta=obj[4])
 
     def decode(self, buffer):
-        obj = unpackb(buffer)
+        return self._decode_object(self._unpack(buffer))
+
+    def decode_lazy(self, buffer):
+        obj = self._unpack(buffer)
+        if obj[0] not in _message_types:
+            raise TypeError('Unknown message type')
+        if obj[0] == b'pc':
+            meta = obj[1][2]
+        elif obj[0] in (b'le', b're', b'us'):
+            meta = obj[1][4]
+        else:
+            meta = None
+        job_id = meta.get(b'jid') if meta else None
+        return LazyMessage(_message_types[obj[0]], job_id, lambda: self._decode_object(obj))
+
+    def _decode_object(self, obj):
         if obj[0] == b'pc':
             return ('page_crawled',
                     self._response_from_object(obj[1]))
@@ -105,7 +152,9 @@ class Decoder(BaseDecoder):
             return ('new_job_id', int(obj[1]))
         if obj[0] == b'of':
             return ('offset', int(obj[1]), int(obj[2]))
+        if obj[0] == b'cr':
+            return ('credits', int(obj[1]), int(obj[2]), int(obj[3]))
         return TypeError('Unknown message type')
 
     def decode_request(self, buffer):
-        return self._request_from_object(unpackb(buffer))
+        return self._request_from_object(self._unpack(buffer))
@@ -3,11 +3,17 @@ from __future__ import absolute_import
 from frontera import Backend
 from frontera.core import OverusedBuffer
 from frontera.utils.misc import load_object
+from frontera.utils.fingerprint import sha1
+from threading import Lock
+from time import time
 import logging
 import six
 
 
 class MessageBusBackend(Backend):
+    # credits are re-sent even if they didn't change, in case DB worker missed them
+    CREDITS_RESEND_INTERVAL = 30.0
+
     def __init__(self, manager):
         settings = manager.settings
         messagebus = load_object(settings.get('MESSAGE_BUS'))
@@ -19,15 +25,24 @@ class MessageBusBackend(Backend):
         self._encoder = encoder_cls(manager.request_model, send_body=store_content)
         self._decoder = decoder_cls(manager.request_model, manager.response_model)
         self.spider_log_producer = self.mb.spider_log().producer()
+        # get_next_requests may be called by Scrapy scheduler from a thread, while other methods are called from
+        # reactor thread. Producer is shared between them, and encoders keeping state between calls are not.
+        self._producer_lock = Lock()
+        self._credits_encoder = encoder_cls(manager.request_model)
         spider_feed = self.mb.spider_feed()
         self.partition_id = int(settings.get('SPIDER_PARTITION_ID'))
         if self.partition_id < 0 or self.partition_id >= settings.get('SPIDER_FEED_PARTITIONS'):
             raise ValueError("Spider partition id cannot be less than 0 or more than SPIDER_FEED_PARTITIONS.")
         self.consumer = spider_feed.consumer(partition_id=self.partition_id)
+        self._credits_key = sha1(str(self.partition_id))
+        self._last_credits = None
+        self._last_credits_sent = 0.0
         self._get_timeout = float(settings.get('KAFKA_GET_TIMEOUT'))
         self._logger = logging.getLogger("messagebus-backend")
         self._buffer = OverusedBuffer(self._get_next_requests,
-                                      self._logger.debug)
+                                      self._logger.debug,
+                                      max_per_key=settings.get('OVERUSED_MAX_PER_KEY') or None,
+                                      max_pending=settings.get('OVERUSED_MAX_PENDING') or None)
         self._logger.info("Consuming from partition id %d", self.partition_id)
 
     @classmethod
@@ -38,27 +53,30 @@ class MessageBusBackend(Backend):
         pass
 
     def frontier_stop(self):
-        self.spider_log_producer.flush()
+        with self._producer_lock:
+            self.spider_log_producer.flush()
 
     def add_seeds(self, seeds):
         per_host = aggregate_per_host(seeds)
         for host_fprint, host_links in six.iteritems(per_host):
-            self.spider_log_producer.send(host_fprint,
-                                          self._encoder.encode_add_seeds(host_links))
+            self._send(host_fprint, self._encoder.encode_add_seeds(host_links))
 
     def page_crawled(self, response):
         host_fprint = get_host_fprint(response)
-        self.spider_log_producer.send(host_fprint, self._encoder.encode_page_crawled(response))
+        self._send(host_fprint, self._encoder.encode_page_crawled(response))
 
     def links_extracted(self, request, links):
         per_host = aggregate_per_host(links)
         for host_fprint, host_links in six.iteritems(per_host):
-            self.spider_log_producer.send(host_fprint,
-                                          self._encoder.encode_links_extracted(request, host_links))
+            self._send(host_fprint, self._encoder.encode_links_extracted(request, host_links))
 
     def request_error(self, page, error):
         host_fprint = get_host_fprint(page)
-        self.spider_log_producer.send(host_fprint, self._encoder.encode_request_error(page, error))
+        self._send(host_fprint, self._encoder.encode_request_error(page, error))
+
+    def _send(self, key, value):
+        with self._producer_lock:
+            self.spider_log_producer.send(key, value)
 
     def _get_next_requests(self, max_n_requests, **kwargs):
         requests = []
@@ -69,10 +87,24 @@ class MessageBusBackend(Backend):
                 self._logger.warning("Could not decode message: {0}, error {1}".format(encoded, str(exc)))
             else:
                 requests.append(request)
-        self.spider_log_producer.send(b'0123456789abcdef0123456789abcdef012345678',
-                                      self._encoder.encode_offset(self.partition_id, self.consumer.get_offset()))
+        self._send_credits(self.consumer.get_offset(), max_n_requests - len(requests))
         return requests
 
+    def _send_credits(self, offset, credits):
+        """
+        Advertises to DB worker how many requests spider is able to accept after consuming the spider feed up to
+        offset. Unchanged credits aren't sent more often than CREDITS_RESEND_INTERVAL.
+        """
+        credits = max(credits, 0)
+        if (offset, credits) == self._last_credits and time() - self._last_credits_sent < self.CREDITS_RESEND_INTERVAL:
+            return
+        with self._producer_lock:
+            self.spider_log_producer.send(self._credits_key,
+                                          self._credits_encoder.encode_credits(self.partition_id, offset, credits))
+            self.spider_log_producer.flush()
+        self._last_credits = (offset, credits)
+        self._last_credits_sent = time()
+
     def get_next_requests(self, max_n_requests, **kwargs):
         return self._buffer.get_next_requests(max_n_requests, **kwargs)
 
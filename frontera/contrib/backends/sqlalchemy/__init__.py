@@ -210,6 +210,9 @@ class Distributed(DistributedBackend):
     def links_extracted(self, request, links):
         self.metadata.links_extracted(request, links)
 
+    def links_extracted_many(self, batch):
+        self.metadata.links_extracted_many(batch)
+
     def request_error(self, request, error):
         self.metadata.request_error(request, error)
 
@@ -73,6 +73,13 @@ class Metadata(BaseMetadata):
                 self.cache[link.meta[b'fingerprint']] = self.session.merge(self._create_page(link))
         self.session.commit()
 
+    def links_extracted_many(self, batch):
+        for _, links in batch:
+            for link in links:
+                if link.meta[b'fingerprint'] not in self.cache:
+                    self.cache[link.meta[b'fingerprint']] = self.session.merge(self._create_page(link))
+        self.session.commit()
+
     def _modify_page(self, obj):
         db_page = self.cache[obj.meta[b'fingerprint']]
         db_page.fetched_at = datetime.utcnow()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Kafka message bus built on KafkaConsumer/KafkaProducer API of kafka-python 1.x. Producers are sending messages
+asynchronously, collecting them in batches by size and time, with optional compression. Consumers are committing
+offsets asynchronously once per batch of received messages. Lags of spider feed partitions are queried with one
+offset fetch request for the whole group and one list offsets request per broker.
+
+Spider feed consumers are assigned partitions manually, and commit offsets in their own group. Broker rejects commits
+of consumers outside of current generation of a group with subscribed members, like the one of DB worker.
+"""
+from __future__ import absolute_import
+from logging import getLogger
+from time import time
+
+from kafka import KafkaConsumer, KafkaProducer, TopicPartition
+from kafka.admin import KafkaAdminClient
+from kafka.errors import KafkaError, MessageSizeTooLargeError
+import six
+from w3lib.util import to_native_str
+
+from frontera.core.messagebus import BaseMessageBus, BaseSpiderLogStream, BaseSpiderFeedStream, \
+    BaseStreamConsumer, BaseScoringLogStream, BaseStreamProducer
+from frontera.contrib.backends.partitioners import FingerprintPartitioner, Crc32NamePartitioner
+
+logger = getLogger("messagebus.kafkabatch")
+
+
+class Consumer(BaseStreamConsumer):
+    """
+    Used in DB and SW worker. SW consumes per partition, DB worker gets partitions assigned by the group.
+    """
+    def __init__(self, location, topic, group, partition_id):
+        self._topic = topic
+        self._partition_id = partition_id
+        self._cons = KafkaConsumer(
+            bootstrap_servers=location,
+            group_id=group,
+            enable_auto_commit=False,
+            auto_offset_reset='latest',
+            max_partition_fetch_bytes=10485760)
+        if partition_id is not None:
+            self._partition = TopicPartition(topic, partition_id)
+            self._cons.assign([self._partition])
+        else:
+            self._partition = None
+            self._cons.subscribe([topic])
+        self._uncommitted = False
+
+    def get_messages(self, timeout=0.1, count=1):
+        deadline = time() + timeout
+        while count > 0:
+            remaining = max(deadline - time(), 0.0)
+            records = self._cons.poll(timeout_ms=remaining * 1000, max_records=count)
+            for partition_records in six.itervalues(records):
+                for record in partition_records:
+                    self._uncommitted = True
+                    count -= 1
+                    yield record.value
+            if not records or remaining == 0.0:
+                break
+        self._commit()
+
+    def _commit(self):
+        if not self._uncommitted:
+            return
+        self._uncommitted = False
+        self._cons.commit_async(callback=self._on_commit)
+
+    def _on_commit(self, offsets, response):
+        if isinstance(response, Exception):
+            logger.warning("Offsets commit failed for %s: %s", self._topic, response)
+
+    def get_offset(self):
+        if self._partition is None:
+            return 0
+        return self._cons.position(self._partition)
+
+
+class Producer(BaseStreamProducer):
+    def __init__(self, location, topic, partitioner_cls, batching):
+        """
+        :param partitioner_cls: partitioner class, or None to leave partitioning to Kafka
+        :param batching: dict with batch_size, linger_ms and compression_type producer options
+        """
+        self._topic = topic
+        self._partitioner_cls = partitioner_cls
+        self._partitioner = None
+        self._prod = KafkaProducer(bootstrap_servers=location, retries=5, **batching)
+
+    def _get_partitioner(self):
+        if self._partitioner is None:
+            partitions = sorted(self._prod.partitions_for(self._topic))
+            self._partitioner = self._partitioner_cls(partitions)
+        return self._partitioner
+
+    def send(self, key, *messages):
+        partition = self._get_partitioner().partition(key) if self._partitioner_cls else None
+        for msg in messages:
+            try:
+                future = self._prod.send(self._topic, value=msg, key=key, partition=partition)
+            except MessageSizeTooLargeError as e:
+                logger.error(str(e))
+                continue
+            future.add_errback(self._on_error)
+
+    def _on_error(self, error):
+        logger.warning("Could not send message to %s: %s", self._topic, error)
+
+    def flush(self):
+        self._prod.flush()
+
+    def get_offset(self, partition_id):
+        # Kafka has it's own offset management
+        raise KeyError
+
+
+class OffsetsFetcher(object):
+    def __init__(self, location, topic, group_id):
+        self._topic = topic
+        self._group_id = group_id
+        self._consumer = KafkaConsumer(bootstrap_servers=location, enable_auto_commit=False)
+        self._admin = KafkaAdminClient(bootstrap_servers=location)
+        self._partitions = []
+
+    def _get_partitions(self):
+        if not self._partitions:
+            partition_ids = self._consumer.partitions_for_topic(self._topic) or []
+            self._partitions = [TopicPartition(self._topic, p) for p in sorted(partition_ids)]
+        return self._partitions
+
+    def get(self):
+        """
+        :return: dict Lags per partition
+        """
+        partitions = self._get_partitions()
+        try:
+            produced = self._consumer.end_offsets(partitions)
+            committed = self._admin.list_consumer_group_offsets(self._group_id, partitions=partitions)
+        except KafkaError as e:
+            logger.warning("Could not fetch offsets of %s: %s", self._topic, e)
+            return {}
+        lags = {}
+        for partition in partitions:
+            metadata = committed.get(partition)
+            if metadata is None or metadata.offset < 0:
+                lags[partition.partition] = 0
+            else:
+                lags[partition.partition] = produced[partition] - metadata.offset
+        return lags
+
+
+class SpiderLogStream(BaseSpiderLogStream):
+    def __init__(self, messagebus):
+        self._location = messagebus.location
+        self._db_group = messagebus.general_group
+        self._sw_group = messagebus.sw_group
+        self._topic_done = messagebus.topic_done
+        self._batching = messagebus.batching
+
+    def producer(self):
+        return Producer(self._location, self._topic_done, FingerprintPartitioner, self._batching)
+
+    def consumer(self, partition_id, type):
+        """
+        Creates spider log consumer with BaseStreamConsumer interface
+        :param partition_id: can be None or integer
+        :param type: either b'db' or b'sw'
+        :return:
+        """
+        group = self._sw_group if type == b'sw' else self._db_group
+        return Consumer(self._location, self._topic_done, group, partition_id)
+
+
+class SpiderFeedStream(BaseSpiderFeedStream):
+    def __init__(self, messagebus):
+        self._location = messagebus.location
+        self._group = messagebus.spider_feed_group
+        self._topic = messagebus.topic_todo
+        self._max_next_requests = messagebus.max_next_requests
+        self._hostname_partitioning = messagebus.hostname_partitioning
+        self._offset_fetcher = OffsetsFetcher(self._location, self._topic, self._group)
+        self._batching = messagebus.batching
+
+    def consumer(self, partition_id):
+        return Consumer(self._location, self._topic, self._group, partition_id)
+
+    def available_partitions(self):
+        partitions = []
+        lags = self._offset_fetcher.get()
+        for partition, lag in six.iteritems(lags):
+            if lag < self._max_next_requests:
+                partitions.append(partition)
+        return partitions
+
+    def producer(self):
+        partitioner = Crc32NamePartitioner if self._hostname_partitioning else FingerprintPartitioner
+        return Producer(self._location, self._topic, partitioner, self._batching)
+
+
+class ScoringLogStream(BaseScoringLogStream):
+    def __init__(self, messagebus):
+        self._topic = messagebus.topic_scoring
+        self._group = messagebus.general_group
+        self._location = messagebus.location
+        self._batching = messagebus.batching
+
+    def consumer(self):
+        return Consumer(self._location, self._topic, self._group, partition_id=None)
+
+    def producer(self):
+        return Producer(self._location, self._topic, None, self._batching)
+
+
+class MessageBus(BaseMessageBus):
+    def __init__(self, settings):
+        self.location = settings.get('KAFKA_LOCATION').split(',')
+        self.topic_todo = to_native_str(settings.get('OUTGOING_TOPIC', "frontier-todo"))
+        self.topic_done = to_native_str(settings.get('INCOMING_TOPIC', "frontier-done"))
+        self.topic_scoring = to_native_str(settings.get('SCORING_TOPIC'))
+        self.general_group = to_native_str(settings.get('FRONTIER_GROUP', "general"))
+        self.sw_group = to_native_str(settings.get('SCORING_GROUP', "strategy-workers"))
+        self.spider_feed_group = to_native_str(settings.get('SPIDER_FEED_GROUP', "spiders"))
+        self.spider_partition_id = settings.get('SPIDER_PARTITION_ID')
+        self.max_next_requests = settings.MAX_NEXT_REQUESTS
+        self.hostname_partitioning = settings.get('QUEUE_HOSTNAME_PARTITIONING')
+
+        codec = settings.get('KAFKA_BATCH_COMPRESSION')
+        if codec not in [None, 'gzip', 'snappy', 'lz4']:
+            raise NameError("Non-existent Kafka compression codec.")
+        self.batching = {
+            'batch_size': settings.get('KAFKA_BATCH_SIZE'),
+            'linger_ms': int(settings.get('KAFKA_BATCH_LINGER') * 1000),
+            'compression_type': codec
+        }
+
+    def spider_log(self):
+        return SpiderLogStream(self)
+
+    def spider_feed(self):
+        return SpiderFeedStream(self)
+
+    def scoring_log(self):
+        return ScoringLogStream(self)
@@ -132,8 +132,8 @@ class KeyedProducer(BaseStreamProducer):
         return success
 
     def flush(self):
-        if self._prod is not None:
-            self._prod.stop()
+        # producer is synchronous, messages are acknowledged by the time send() returns
+        pass
 
     def get_offset(self, partition_id):
         # Kafka has it's own offset management
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Brokerless message bus for single host deployments. Every stream partition is a log, messages are written by
+producers directly into it, and every consumer reads it independently. Components running in one process can use
+in-process logs, components in separate processes share logs through memory mapped files.
+"""
+from __future__ import absolute_import
+from logging import getLogger
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+import os
+
+import six
+
+from frontera.core.messagebus import BaseMessageBus, BaseSpiderLogStream, BaseStreamConsumer, \
+    BaseSpiderFeedStream, BaseScoringLogStream, BaseStreamProducer
+from frontera.contrib.backends.partitioners import FingerprintPartitioner, Crc32NamePartitioner
+from frontera.contrib.messagebus.local.ring import InProcessLog, SharedMemoryLog
+from six.moves import range
+
+
+_in_process_logs = {}
+_in_process_lock = Lock()
+
+
+class Consumer(BaseStreamConsumer):
+    def __init__(self, logs, name):
+        """
+        :param logs: list of logs to read, round-robin
+        """
+        self.logs = logs
+        self.readers = [log.reader() for log in logs]
+        self.logger = getLogger("messagebus.local.Consumer(%s)" % name)
+        self.lost = 0
+
+    def get_messages(self, timeout=0.1, count=1):
+        """
+        Drains all logs without waiting, and waits for the rest of timeout when they're empty. Consumers of
+        several logs are waiting on the first log in short slices, to not miss messages in others.
+        """
+        deadline = time() + timeout
+        pairs = list(zip(self.logs, self.readers))
+        while count > 0:
+            received = 0
+            for log, reader in pairs:
+                for msg in log.read(reader, count - received, 0.0):
+                    yield msg
+                    received += 1
+                if received == count:
+                    break
+            self._check_lost()
+            count -= received
+            if received or not count:
+                continue
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            log, reader = pairs[0]
+            for msg in log.read(reader, count, remaining if len(pairs) == 1 else min(remaining, 0.001)):
+                yield msg
+                count -= 1
+
+    def _check_lost(self):
+        lost = sum(reader.lost for reader in self.readers)
+        if lost > self.lost:
+            self.logger.warning("Consumer was too slow, %d messages were overwritten." % (lost - self.lost))
+            self.lost = lost
+
+    def get_offset(self):
+        return sum(reader.seqno for reader in self.readers)
+
+
+class Producer(BaseStreamProducer):
+    def __init__(self, logs, partitioner):
+        """
+        :param logs: dict of partition id to log
+        :param partitioner: partitioner instance or None for not partitioned streams
+        """
+        self.logs = logs
+        self.partitioner = partitioner
+
+    def send(self, key, *messages):
+        if any(not isinstance(m, six.binary_type) for m in messages):
+            raise TypeError("all produce message payloads must be type bytes")
+        partition = self.partitioner.partition(key) if self.partitioner else 0
+        self.logs[partition].append(messages)
+
+    def flush(self):
+        pass
+
+    def get_offset(self, partition_id):
+        return self.logs[partition_id].count
+
+
+class SpiderLogStream(BaseSpiderLogStream):
+    def __init__(self, messagebus):
+        self.messagebus = messagebus
+        self.partitions = messagebus.spider_log_partitions
+
+    def producer(self):
+        logs = dict((p, self.messagebus.get_log('spider-log', p)) for p in self.partitions)
+        return Producer(logs, FingerprintPartitioner(self.partitions))
+
+    def consumer(self, partition_id, type):
+        partitions = self.partitions if partition_id is None else [partition_id]
+        return Consumer([self.messagebus.get_log('spider-log', p) for p in partitions],
+                        "spider-log-%s-%s" % (type, partition_id))
+
+
+class ScoringLogStream(BaseScoringLogStream):
+    def __init__(self, messagebus):
+        self.messagebus = messagebus
+
+    def consumer(self):
+        return Consumer([self.messagebus.get_log('scoring-log', 0)], "scoring-log")
+
+    def producer(self):
+        return Producer({0: self.messagebus.get_log('scoring-log', 0)}, None)
+
+
+class SpiderFeedStream(BaseSpiderFeedStream):
+    def __init__(self, messagebus):
+        self.messagebus = messagebus
+        self.partitions = messagebus.spider_feed_partitions
+        self.ready_partitions = set(self.partitions)
+        self.hostname_partitioning = messagebus.hostname_partitioning
+
+    def consumer(self, partition_id):
+        return Consumer([self.messagebus.get_log('spider-feed', partition_id)], "spider-feed-%d" % partition_id)
+
+    def producer(self):
+        logs = dict((p, self.messagebus.get_log('spider-feed', p)) for p in self.partitions)
+        partitioner = Crc32NamePartitioner(self.partitions) if self.hostname_partitioning else \
+            FingerprintPartitioner(self.partitions)
+        return Producer(logs, partitioner)
+
+    def available_partitions(self):
+        return self.ready_partitions
+
+    def mark_ready(self, partition_id):
+        self.ready_partitions.add(partition_id)
+
+    def mark_busy(self, partition_id):
+        self.ready_partitions.discard(partition_id)
+
+
+class MessageBus(BaseMessageBus):
+    """
+    Local message bus. With :setting:`LOCAL_BUS_SHARED_MEMORY` turned off all logs are kept in the process memory, and
+    all message bus instances with the same :setting:`LOCAL_BUS_NAME` are sharing them.
+    """
+    def __init__(self, settings):
+        self.name = settings.get('LOCAL_BUS_NAME')
+        self.shared_memory = settings.get('LOCAL_BUS_SHARED_MEMORY')
+        self.buffer_size = settings.get('LOCAL_BUS_BUFFER_SIZE')
+        self.directory = settings.get('LOCAL_BUS_DIR') or \
+            ('/dev/shm' if os.path.isdir('/dev/shm') else gettempdir())
+        self.spider_log_partitions = [i for i in range(settings.get('SPIDER_LOG_PARTITIONS'))]
+        self.spider_feed_partitions = [i for i in range(settings.get('SPIDER_FEED_PARTITIONS'))]
+        self.hostname_partitioning = settings.get('QUEUE_HOSTNAME_PARTITIONING')
+        # capacity of in-process logs in messages, assuming messages are about 256 bytes
+        self.in_process_capacity = max(self.buffer_size // 256, 1)
+        self.logs = {}
+
+    def get_log(self, stream, partition_id):
+        key = (stream, partition_id)
+        if key not in self.logs:
+            if self.shared_memory:
+                path = os.path.join(self.directory, "%s-%s-%d" % (self.name, stream, partition_id))
+                self.logs[key] = SharedMemoryLog(path, self.buffer_size)
+            else:
+                with _in_process_lock:
+                    global_key = (self.name,) + key
+                    if global_key not in _in_process_logs:
+                        _in_process_logs[global_key] = InProcessLog(self.in_process_capacity)
+                    self.logs[key] = _in_process_logs[global_key]
+        return self.logs[key]
+
+    def spider_log(self):
+        return SpiderLogStream(self)
+
+    def scoring_log(self):
+        return ScoringLogStream(self)
+
+    def spider_feed(self):
+        return SpiderFeedStream(self)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Contains message logs used by local message bus. Every log is a sequence of messages written by any number of
+producers and read by any number of independent readers, each keeping it's own position. Log has limited capacity,
+readers falling behind more than capacity are losing oldest messages, similarly to ZeroMQ high water mark.
+"""
+from __future__ import absolute_import
+from struct import Struct
+from threading import Condition, Lock
+from time import time, sleep
+import fcntl
+import mmap
+import os
+
+
+# write position, tail position, count of messages written, count of messages before tail, capacity
+_header = Struct(">QQQQQ")
+_length = Struct(">I")
+_WRAP = 0xFFFFFFFF
+HEADER_SIZE = 64
+
+
+class LogReader(object):
+    """
+    Position of one reader in the log.
+    """
+    __slots__ = ['position', 'seqno', 'lost']
+
+    def __init__(self, position, seqno):
+        self.position = position
+        self.seqno = seqno
+        self.lost = 0
+
+
+class InProcessLog(object):
+    """
+    Log for components sharing one process. Messages aren't copied, readers are woken up on every append.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: int, max count of messages kept for slow readers
+        """
+        self.capacity = capacity
+        self.messages = []
+        self.first = 0
+        self.count = 0
+        self.condition = Condition()
+
+    def append(self, messages):
+        with self.condition:
+            self.messages.extend(messages)
+            self.count += len(messages)
+            if len(self.messages) > self.capacity * 2:
+                trimmed = len(self.messages) - self.capacity
+                del self.messages[:trimmed]
+                self.first += trimmed
+            self.condition.notify_all()
+            return self.count
+
+    def reader(self):
+        with self.condition:
+            return LogReader(None, self.count)
+
+    def read(self, reader, count, timeout):
+        deadline = time() + timeout
+        with self.condition:
+            while reader.seqno == self.count:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return []
+                self.condition.wait(remaining)
+            if reader.seqno < self.first:
+                reader.lost += self.first - reader.seqno
+                reader.seqno = self.first
+            start = reader.seqno - self.first
+            messages = self.messages[start:start + count]
+            reader.seqno += len(messages)
+            return messages
+
+    def close(self):
+        pass
+
+
+class SharedMemoryLog(object):
+    """
+    Ring buffer in memory mapped file, shared by processes on one host. Producers are serialized with exclusive flock
+    on the file, readers take shared lock only to copy messages out. Flock doesn't exclude threads using the same
+    file descriptor, so threads sharing the log instance are serialized with a thread lock in addition. Readers don't
+    get notifications from writers, they poll the header with growing sleeps, up to 1ms.
+
+    Every message is prefixed with it's length, message which doesn't fit till the end of the buffer is written from
+    it's start, leaving the wrap marker. Writer moves tail forward when overwriting oldest messages.
+    """
+
+    def __init__(self, path, capacity):
+        """
+        :param path: str, path of the file, created if doesn't exist
+        :param capacity: int, size of ring buffer in bytes, ignored if file already exists
+        """
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = Lock()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < HEADER_SIZE:
+                os.ftruncate(self.fd, HEADER_SIZE + capacity)
+                header = _header.pack(0, 0, 0, 0, capacity)
+                os.write(self.fd, header)
+            self.mm = mmap.mmap(self.fd, 0)
+            self.capacity = _header.unpack_from(self.mm, 0)[4]
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @property
+    def count(self):
+        return _header.unpack_from(self.mm, 0)[2]
+
+    def append(self, messages):
+        mm = self.mm
+        capacity = self.capacity
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            write, tail, count, tail_count, _ = _header.unpack_from(mm, 0)
+            for msg in messages:
+                size = len(msg) + 4
+                if size > capacity:
+                    raise ValueError("Message of %d bytes doesn't fit into shared memory buffer." % len(msg))
+                offset = write % capacity
+                if capacity - offset < size:
+                    end = write + capacity - offset + size
+                else:
+                    end = write + size
+                # moving tail forward, until there is a space for the message
+                while tail < end - capacity:
+                    tail_offset = tail % capacity
+                    if capacity - tail_offset < 4:
+                        tail += capacity - tail_offset
+                        continue
+                    length, = _length.unpack_from(mm, HEADER_SIZE + tail_offset)
+                    if length == _WRAP:
+                        tail += capacity - tail_offset
+                        continue
+                    tail += length + 4
+                    tail_count += 1
+                if capacity - offset < size:
+                    if capacity - offset >= 4:
+                        _length.pack_into(mm, HEADER_SIZE + offset, _WRAP)
+                    write += capacity - offset
+                    offset = 0
+                _length.pack_into(mm, HEADER_SIZE + offset, len(msg))
+                mm[HEADER_SIZE + offset + 4:HEADER_SIZE + offset + size] = msg
+                write += size
+                count += 1
+            _header.pack_into(mm, 0, write, tail, count, tail_count, capacity)
+            return count
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.lock.release()
+
+    def reader(self):
+        write, _, count, _, _ = _header.unpack_from(self.mm, 0)
+        return LogReader(write, count)
+
+    def _read(self, reader, count):
+        mm = self.mm
+        capacity = self.capacity
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            write, tail, _, tail_count, _ = _header.unpack_from(mm, 0)
+            if reader.position < tail:
+                reader.lost += tail_count - reader.seqno
+                reader.position = tail
+                reader.seqno = tail_count
+            position = reader.position
+            messages = []
+            while position < write and len(messages) < count:
+                offset = position % capacity
+                if capacity - offset < 4:
+                    position += capacity - offset
+                    continue
+                length, = _length.unpack_from(mm, HEADER_SIZE + offset)
+                if length == _WRAP:
+                    position += capacity - offset
+                    continue
+                start = HEADER_SIZE + offset + 4
+                messages.append(mm[start:start + length])
+                position += length + 4
+            reader.position = position
+            reader.seqno += len(messages)
+            return messages
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.lock.release()
+
+    def read(self, reader, count, timeout):
+        deadline = time() + timeout
+        delay = 0.00005
+        while True:
+            if _header.unpack_from(self.mm, 0)[0] != reader.position:
+                return self._read(reader, count)
+            remaining = deadline - time()
+            if remaining <= 0:
+                return []
+            sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.001)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
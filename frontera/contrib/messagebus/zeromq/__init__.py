@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from time import time, sleep
-from struct import pack, unpack
+from time import time
+from struct import pack
 from logging import getLogger
+from collections import deque
 
 import zmq
 import six
@@ -11,18 +12,25 @@ from frontera.core.messagebus import BaseMessageBus, BaseSpiderLogStream, BaseSt
     BaseSpiderFeedStream, BaseScoringLogStream
 from frontera.contrib.backends.partitioners import FingerprintPartitioner, Crc32NamePartitioner
 from frontera.contrib.messagebus.zeromq.socket_config import SocketConfig
+from frontera.contrib.messagebus.zeromq.batch import Batch, SINGLE_SEQ, BATCH_SEQ, get_codec, decompress, split
+from frontera.utils.misc import load_object
 from six.moves import range
 
 
 class Consumer(BaseStreamConsumer):
-    def __init__(self, context, location, partition_id, identity, seq_warnings=False, hwm=1000):
+    def __init__(self, context, location, partition_id, identity, seq_warnings=False, hwm=1000, zero_copy=False):
         self.subscriber = context.zeromq.socket(zmq.SUB)
         self.subscriber.connect(location)
         self.subscriber.set(zmq.RCVHWM, hwm)
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
+        self.zero_copy = zero_copy
+        self.backlog = deque()
 
         filter = identity + pack('>B', partition_id) if partition_id is not None else identity
         self.subscriber.setsockopt(zmq.SUBSCRIBE, filter)
         self.counter = 0
+        self._received = None
         self.count_global = partition_id is None
         self.logger = getLogger("distributed_frontera.messagebus.zeromq.Consumer(%s-%s)" % (identity, partition_id))
         self.seq_warnings = seq_warnings
@@ -32,37 +40,71 @@ class Consumer(BaseStreamConsumer):
         self.stats[self.stat_key] = 0
 
     def get_messages(self, timeout=0.1, count=1):
-        started = time()
-        sleep_time = timeout / 10.0
+        """
+        Drains all messages ready in the socket without waiting, and blocks in poller for the rest of timeout only
+        when the socket is empty. If zero copy is enabled, messages are returned as memoryviews of the received
+        frames, so the codec have to support buffer objects. Batches are unpacked transparently, messages left from
+        a batch are returned on the next call. Offset is advanced as messages are returned.
+        """
+        deadline = time() + timeout
         while count:
+            if self.backlog:
+                message, self.counter = self.backlog.popleft()
+                yield message
+                count -= 1
+                continue
             try:
-                msg = self.subscriber.recv_multipart(copy=True, flags=zmq.NOBLOCK)
+                msg = self.subscriber.recv_multipart(copy=not self.zero_copy, flags=zmq.NOBLOCK)
             except zmq.Again:
-                if time() - started > timeout:
+                remaining = deadline - time()
+                if remaining <= 0 or not self.poller.poll(remaining * 1000.0):
                     break
-                sleep(sleep_time)
             else:
-                partition_seqno, global_seqno = unpack(">II", msg[2])
-                seqno = global_seqno if self.count_global else partition_seqno
-                if not self.counter:
-                    self.counter = seqno
-                elif self.counter != seqno:
-                    if self.seq_warnings:
-                        self.logger.warning("Sequence counter mismatch: expected %d, got %d. Check if system "
-                                            "isn't missing messages." % (self.counter, seqno))
-                    self.counter = None
-                yield msg[1]
-                count -= 1
-                if self.counter:
-                    self.counter += 1
-                self.stats[self.stat_key] += 1
+                self._receive(msg)
+
+    def _receive(self, msg):
+        if self.zero_copy:
+            seq = msg[2].bytes
+            payload = msg[1].buffer
+        else:
+            seq = msg[2]
+            payload = msg[1]
+        if len(seq) == SINGLE_SEQ.size:
+            partition_seqno, global_seqno = SINGLE_SEQ.unpack(seq)
+            messages = [payload]
+            count = 1
+        else:
+            partition_seqno, global_seqno, count, codec = BATCH_SEQ.unpack(seq)
+            payload = decompress(codec, payload)
+            if self.zero_copy:
+                payload = memoryview(payload)
+            messages = split(payload)
+        seqno = global_seqno if self.count_global else partition_seqno
+        # every message is queued along with the offset after it, offset is unknown after missed messages
+        if self._received is not None and self._received != seqno:
+            if self.seq_warnings:
+                self.logger.warning("Sequence counter mismatch: expected %d, got %d. Check if system "
+                                    "isn't missing messages." % (self._received, seqno))
+            self._received = None
+            offsets = [None] * count
+        else:
+            self._received = seqno + count
+            offsets = range(seqno + 1, seqno + count + 1)
+        self.backlog.extend(zip(messages, offsets))
+        self.stats[self.stat_key] += count
 
     def get_offset(self):
         return self.counter
 
 
 class Producer(object):
-    def __init__(self, context, location, identity):
+    def __init__(self, context, location, identity, batch_size=0, batch_linger=0.0, compression=None):
+        """
+        :param batch_size: int, size in bytes of messages collected per partition before sending them as one batch.
+            0 disables batching.
+        :param batch_linger: float, max time in seconds messages can wait in a batch, checked on every send.
+        :param compression: None, 'zlib' or 'lz4', compression of batches.
+        """
         self.identity = identity
         self.sender = context.zeromq.socket(zmq.PUB)
         self.sender.connect(location)
@@ -71,6 +113,16 @@ class Producer(object):
         self.stats = context.stats
         self.stat_key = "producer-%s" % identity
         self.stats[self.stat_key] = 0
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
+        self.batches = {}
+        self.codec, self.compress = get_codec(compression)
+
+    def _get_partition(self, key):
+        return self.partitioner.partition(key)
+
+    def _get_topic(self, partition):
+        return self.identity + pack(">B", partition)
 
     def send(self, key, *messages):
         # Guarantee that msg is actually a list or tuple (should always be true)
@@ -80,11 +132,14 @@ class Producer(object):
         # Raise TypeError if any message is not encoded as bytes
         if any(not isinstance(m, six.binary_type) for m in messages):
             raise TypeError("all produce message payloads must be type bytes")
-        partition = self.partitioner.partition(key)
+        partition = self._get_partition(key)
+        if self.batch_size:
+            self._append(partition, messages)
+            return
         counter = self.counters.get(partition, 0)
+        topic = self._get_topic(partition)
         for msg in messages:
-            self.sender.send_multipart([self.identity + pack(">B", partition), msg,
-                                        pack(">II", counter, self.global_counter)])
+            self.sender.send_multipart([topic, msg, SINGLE_SEQ.pack(counter, self.global_counter)])
             counter += 1
             self.global_counter += 1
             if counter == 4294967296:
@@ -94,16 +149,39 @@ class Producer(object):
             self.stats[self.stat_key] += 1
         self.counters[partition] = counter
 
+    def _append(self, partition, messages):
+        batch = self.batches.get(partition)
+        if batch is None:
+            batch = self.batches[partition] = Batch()
+        for msg in messages:
+            batch.append(msg)
+        if batch.size >= self.batch_size:
+            self._send_batch(partition)
+        if self.batch_linger:
+            expired = time() - self.batch_linger
+            for partition in [p for p, b in six.iteritems(self.batches) if b.created < expired]:
+                self._send_batch(partition)
+
+    def _send_batch(self, partition):
+        batch = self.batches.pop(partition)
+        counter = self.counters.get(partition, 0)
+        self.sender.send_multipart([self._get_topic(partition), self.compress(batch.payload()),
+                                    BATCH_SEQ.pack(counter, self.global_counter, batch.count, self.codec)])
+        self.counters[partition] = (counter + batch.count) % 4294967296
+        self.global_counter = (self.global_counter + batch.count) % 4294967296
+        self.stats[self.stat_key] += batch.count
+
     def flush(self):
-        pass
+        for partition in list(self.batches.keys()):
+            self._send_batch(partition)
 
     def get_offset(self, partition_id):
         return self.counters[partition_id]
 
 
 class SpiderLogProducer(Producer):
-    def __init__(self, context, location, partitions):
-        super(SpiderLogProducer, self).__init__(context, location, b'sl')
+    def __init__(self, context, location, partitions, **batching):
+        super(SpiderLogProducer, self).__init__(context, location, b'sl', **batching)
         self.partitioner = FingerprintPartitioner(partitions)
 
 
@@ -114,35 +192,26 @@ class SpiderLogStream(BaseSpiderLogStream):
         self.db_in_location = messagebus.socket_config.db_in()
         self.out_location = messagebus.socket_config.spiders_out()
         self.partitions = messagebus.spider_log_partitions
+        self.zero_copy = messagebus.zero_copy
+        self.batching = messagebus.batching
 
     def producer(self):
-        return SpiderLogProducer(self.context, self.out_location, self.partitions)
+        return SpiderLogProducer(self.context, self.out_location, self.partitions, **self.batching)
 
     def consumer(self, partition_id, type):
         location = self.sw_in_location if type == b'sw' else self.db_in_location
-        return Consumer(self.context, location, partition_id, b'sl')
+        return Consumer(self.context, location, partition_id, b'sl', zero_copy=self.zero_copy)
 
 
 class UpdateScoreProducer(Producer):
-    def __init__(self, context, location):
-        super(UpdateScoreProducer, self).__init__(context, location, b'us')
+    def __init__(self, context, location, **batching):
+        super(UpdateScoreProducer, self).__init__(context, location, b'us', **batching)
 
-    def send(self, key, *messages):
-        # Guarantee that msg is actually a list or tuple (should always be true)
-        if not isinstance(messages, (list, tuple)):
-            raise TypeError("msg is not a list or tuple!")
+    def _get_partition(self, key):
+        return 0
 
-        # Raise TypeError if any message is not encoded as bytes
-        if any(not isinstance(m, six.binary_type) for m in messages):
-            raise TypeError("all produce message payloads must be type bytes")
-        counter = self.counters.get(0, 0)
-        for msg in messages:
-            self.sender.send_multipart([self.identity, msg, pack(">II", counter, counter)])
-            counter += 1
-            if counter == 4294967296:
-                counter = 0
-            self.stats[self.stat_key] += 1
-        self.counters[0] = counter
+    def _get_topic(self, partition):
+        return self.identity
 
 
 class ScoringLogStream(BaseScoringLogStream):
@@ -150,17 +219,19 @@ class ScoringLogStream(BaseScoringLogStream):
         self.context = messagebus.context
         self.in_location = messagebus.socket_config.sw_out()
         self.out_location = messagebus.socket_config.db_in()
+        self.zero_copy = messagebus.zero_copy
+        self.batching = messagebus.batching
 
     def consumer(self):
-        return Consumer(self.context, self.out_location, None, b'us')
+        return Consumer(self.context, self.out_location, None, b'us', zero_copy=self.zero_copy)
 
     def producer(self):
-        return UpdateScoreProducer(self.context, self.in_location)
+        return UpdateScoreProducer(self.context, self.in_location, **self.batching)
 
 
 class SpiderFeedProducer(Producer):
-    def __init__(self, context, location, partitions, hwm, hostname_partitioning):
-        super(SpiderFeedProducer, self).__init__(context, location, b'sf')
+    def __init__(self, context, location, partitions, hwm, hostname_partitioning, **batching):
+        super(SpiderFeedProducer, self).__init__(context, location, b'sf', **batching)
         self.partitioner = Crc32NamePartitioner(partitions) if hostname_partitioning else \
             FingerprintPartitioner(partitions)
         self.sender.set(zmq.SNDHWM, hwm)
@@ -176,13 +247,16 @@ class SpiderFeedStream(BaseSpiderFeedStream):
         self.consumer_hwm = messagebus.spider_feed_rcvhwm
         self.producer_hwm = messagebus.spider_feed_sndhwm
         self.hostname_partitioning = messagebus.hostname_partitioning
+        self.zero_copy = messagebus.zero_copy
+        self.batching = messagebus.batching
 
     def consumer(self, partition_id):
-        return Consumer(self.context, self.out_location, partition_id, b'sf', seq_warnings=True, hwm=self.consumer_hwm)
+        return Consumer(self.context, self.out_location, partition_id, b'sf', seq_warnings=True, hwm=self.consumer_hwm,
+                        zero_copy=self.zero_copy)
 
     def producer(self):
         return SpiderFeedProducer(self.context, self.in_location, self.partitions,
-                                  self.producer_hwm, self.hostname_partitioning)
+                                  self.producer_hwm, self.hostname_partitioning, **self.batching)
 
     def available_partitions(self):
         return self.ready_partitions
@@ -210,6 +284,17 @@ class MessageBus(BaseMessageBus):
         self.spider_feed_sndhwm = int(settings.get('MAX_NEXT_REQUESTS') * len(self.spider_feed_partitions) * 1.2)
         self.spider_feed_rcvhwm = int(settings.get('MAX_NEXT_REQUESTS') * 2.0)
         self.hostname_partitioning = settings.get('QUEUE_HOSTNAME_PARTITIONING')
+        self.zero_copy = settings.get('ZMQ_ZERO_COPY')
+        if self.zero_copy:
+            codec_path = settings.get('MESSAGE_BUS_CODEC')
+            if not getattr(load_object(codec_path + '.Decoder'), 'supports_buffers', False):
+                raise ValueError("ZMQ_ZERO_COPY requires codec decoding from buffer objects, %s doesn't support it"
+                                 % codec_path)
+        self.batching = {
+            'batch_size': settings.get('ZMQ_BATCH_SIZE'),
+            'batch_linger': settings.get('ZMQ_BATCH_LINGER'),
+            'compression': settings.get('ZMQ_BATCH_COMPRESSION')
+        }
         if self.socket_config.is_ipv6:
             self.context.zeromq.setsockopt(zmq.IPV6, True)
 
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the batching envelope used by ZeroMQ producers and consumers. Batch is sent as the usual 3-frame
+multipart message, but payload is the compressed concatenation of length prefixed messages, and sequence frame
+carries the first sequence numbers, count of messages and compression codec id.
+"""
+from __future__ import absolute_import
+from struct import Struct
+from time import time
+import zlib
+
+
+SINGLE_SEQ = Struct(">II")
+BATCH_SEQ = Struct(">IIIB")
+_length = Struct(">I")
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+
+
+def _lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError("lz4 package is required for lz4 compression of ZeroMQ message batches.")
+    return lz4.frame
+
+
+def get_codec(name):
+    """
+    Returns codec id and compression function for compression name.
+
+    :param name: None, 'none', 'zlib' or 'lz4'
+    :return: tuple of codec id and compression function
+    """
+    if name in [None, 'none']:
+        return CODEC_NONE, bytes
+    if name == 'zlib':
+        return CODEC_ZLIB, zlib.compress
+    if name == 'lz4':
+        return CODEC_LZ4, _lz4().compress
+    raise NameError("Non-existent ZeroMQ batch compression codec %s." % name)
+
+
+def decompress(codec, payload):
+    if codec == CODEC_NONE:
+        return payload
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec == CODEC_LZ4:
+        return _lz4().decompress(bytes(payload))
+    raise TypeError("Unknown ZeroMQ batch compression codec id %d." % codec)
+
+
+def split(buffer):
+    """
+    Generates messages from uncompressed batch payload.
+
+    :param buffer: bytes or memoryview
+    """
+    offset = 0
+    size = len(buffer)
+    while offset < size:
+        length, = _length.unpack_from(buffer, offset)
+        offset += 4
+        yield buffer[offset:offset + length]
+        offset += length
+
+
+class Batch(object):
+    """
+    Messages collected for one partition, waiting to be sent.
+    """
+    __slots__ = ['buffers', 'size', 'count', 'created']
+
+    def __init__(self):
+        self.buffers = []
+        self.size = 0
+        self.count = 0
+        self.created = time()
+
+    def append(self, msg):
+        self.buffers.append(_length.pack(len(msg)))
+        self.buffers.append(msg)
+        self.size += len(msg) + 4
+        self.count += 1
+
+    def payload(self):
+        return b''.join(self.buffers)
@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
-from time import time
+from time import time, sleep
 from datetime import timedelta
+from threading import Thread
 import logging
 from argparse import ArgumentParser
 from struct import unpack
 
 import zmq
+import six
 from zmq.eventloop.ioloop import IOLoop
 from zmq.eventloop.zmqstream import ZMQStream
 
@@ -145,6 +147,108 @@ class Server(object):
         raise ValueError("Can't decode subscription correctly.")
 
 
+class ProxyServer(object):
+    """
+    Broker forwarding messages with libzmq native proxies, one thread per channel, so messages never enter Python
+    interpreter. Spider log is fanned out to strategy and DB workers through an inproc XPUB socket, DB workers
+    incoming socket is fed from both spider log and scoring log. Subscriptions are forwarded upstream by proxies
+    themselves. Stats are collected from proxies with STATISTICS command of control socket (libzmq >= 4.3),
+    and are counted in message parts.
+    """
+
+    def __init__(self, address, base_port):
+        self.ctx = zmq.Context()
+        socket_config = SocketConfig(address, base_port)
+
+        if socket_config.is_ipv6:
+            self.ctx.setsockopt(zmq.IPV6, True)
+
+        # channel name -> (frontend, backend) sockets
+        self.channels = {
+            'spider_log': (self._socket(zmq.XSUB, bind=socket_config.spiders_out()),
+                           self._socket(zmq.XPUB, bind='inproc://spider_log')),
+            'scoring_log': (self._socket(zmq.XSUB, bind=socket_config.sw_out()),
+                            self._socket(zmq.XPUB, bind='inproc://scoring_log')),
+            'sw_in': (self._socket(zmq.XSUB, connect=['inproc://spider_log']),
+                      self._socket(zmq.XPUB, bind=socket_config.sw_in())),
+            'db_in': (self._socket(zmq.XSUB, connect=['inproc://spider_log', 'inproc://scoring_log']),
+                      self._socket(zmq.XPUB, bind=socket_config.db_in())),
+            'spider_feed': (self._socket(zmq.XSUB, bind=socket_config.db_out()),
+                            self._socket(zmq.XPUB, bind=socket_config.spiders_in()))
+        }
+        self.controls = {}
+        self.threads = []
+        for name, (frontend, backend) in six.iteritems(self.channels):
+            control = self._socket(zmq.REP, bind='inproc://control-%s' % name)
+            thread = Thread(target=zmq.proxy_steerable, args=(frontend, backend, None, control),
+                            name="proxy-%s" % name)
+            thread.daemon = True
+            self.threads.append(thread)
+            self.controls[name] = self._socket(zmq.REQ, connect=['inproc://control-%s' % name])
+        self.stats = {
+            'started': time()
+        }
+        logging.basicConfig(format="%(asctime)s %(message)s",
+                            datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+        self.logger = logging.getLogger("distributed_frontera.messagebus"
+                                        ".zeromq.broker.ProxyServer")
+        self.logger.info("Using socket: {}:{}".format(socket_config.ip_addr,
+                                                      socket_config.base_port))
+
+    def _socket(self, type, bind=None, connect=[]):
+        socket = self.ctx.socket(type)
+        if bind:
+            socket.bind(bind)
+        for location in connect:
+            socket.connect(location)
+        return socket
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        self.logger.info("Distributed Frontera ZeroMQ native proxy broker is started.")
+        try:
+            while True:
+                self.log_stats()
+                sleep(10)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for control in six.itervalues(self.controls):
+            control.send(b'TERMINATE')
+        for thread in self.threads:
+            thread.join(1.0)
+
+    def get_statistics(self, name):
+        """
+        :return: dict with frontend and backend stats of channel or None if proxy didn't reply
+        """
+        control = self.controls[name]
+        control.send(b'STATISTICS')
+        if not control.poll(1000):
+            # REQ socket is stuck waiting for reply, replacing it
+            control.close(linger=0)
+            self.controls[name] = self._socket(zmq.REQ, connect=['inproc://control-%s' % name])
+            return None
+        values = [unpack("=Q", frame)[0] for frame in control.recv_multipart()]
+        keys = ['frontend_msgs_in', 'frontend_bytes_in', 'frontend_msgs_out', 'frontend_bytes_out',
+                'backend_msgs_in', 'backend_bytes_in', 'backend_msgs_out', 'backend_bytes_out']
+        return dict(zip(keys, values))
+
+    def log_stats(self):
+        stats = dict(self.stats)
+        for name in self.channels:
+            channel_stats = self.get_statistics(name)
+            if channel_stats is None:
+                continue
+            stats['%s_recvd' % name] = channel_stats['frontend_msgs_in']
+            stats['%s_subscriptions_recvd' % name] = channel_stats['backend_msgs_in']
+        self.logger.info(stats)
+
+
 def main():
     """
     Parse arguments, set configuration values, then start the broker
@@ -165,12 +269,16 @@ def main():
         '--port', type=int,
         help='Base port number, server will bind to 6 ports starting from base'
         '. Default is 5550')
+    parser.add_argument(
+        '--native-proxy', action='store_true',
+        help='Forward messages with libzmq native proxies in separate threads, '
+        'instead of Python callbacks.')
     args = parser.parse_args()
 
     settings = Settings(module=args.config)
     address = args.address if args.address else settings.get("ZMQ_ADDRESS")
     port = args.port if args.port else settings.get("ZMQ_BASE_PORT")
-    server = Server(address, port)
+    server = ProxyServer(address, port) if args.native_proxy else Server(address, port)
     server.logger.setLevel(args.log_level)
     server.start()
 
@@ -10,8 +10,18 @@ class OverusedBufferScrapy(OverusedBuffer):
     Scrapy optimized version of OverusedBuffer. Url parsing and dns resolving are made using Scrapy primitives.
     """
 
-    def _get_key(self, request, type):
-        key = urlparse_cached(request).hostname or ''
-        if type == 'ip':
-            key = dnscache.get(key, key)
-        return key
+    def _get_hostname(self, request):
+        return urlparse_cached(request).hostname or ''
+
+    def _resolve(self, hostnames):
+        resolved = {}
+        to_resolve = []
+        for hostname in hostnames:
+            ip = dnscache.get(hostname)
+            if ip is None:
+                to_resolve.append(hostname)
+            else:
+                resolved[hostname] = ip
+        if to_resolve:
+            resolved.update(self._resolver.get_many(to_resolve))
+        return resolved
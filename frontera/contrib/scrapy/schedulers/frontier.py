@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 from scrapy.core.scheduler import Scheduler
 from scrapy.http import Request
+from twisted.internet import threads
 from logging import getLogger
 
 from collections import deque
@@ -23,6 +24,8 @@ class StatsManager(object):
         'frontera/crawled_pages_count/403': 1,
         'frontera/crawled_pages_count/404': 1,
         'frontera/crawled_pages_count/999': 5,
+        'frontera/fetch_blocking_time': 0.0,
+        'frontera/fetch_time': 12.3,
         'frontera/iterations': 5,
         'frontera/links_extracted_count': 39805,
         'frontera/pending_requests_count': 0,
@@ -55,6 +58,10 @@ class StatsManager(object):
         self._inc_value('request_errors_count')
         self._inc_value('request_errors_count/%s' % str(error_code))
 
+    def add_fetch_time(self, seconds, blocking):
+        self._inc_value('fetch_time', seconds)
+        self._inc_value('fetch_blocking_time', seconds if blocking else 0.0)
+
     def set_iterations(self, iterations):
         self._set_value('iterations', iterations)
 
@@ -82,6 +89,8 @@ class FronteraScheduler(Scheduler):
         self.frontier = ScrapyFrontierManager(settings, manager)
         self._delay_on_empty = self.frontier.manager.settings.get('DELAY_ON_EMPTY')
         self._delay_next_call = 0.0
+        self._async_fetch = self.frontier.manager.settings.get('ASYNC_FETCH')
+        self._fetching = None
         self.logger = getLogger('frontera.contrib.scrapy.schedulers.FronteraScheduler')
 
     @classmethod
@@ -146,14 +155,44 @@ class FronteraScheduler(Scheduler):
         if not self.frontier.manager.finished and \
                 len(self) < self.crawler.engine.downloader.total_concurrency and \
                 self._delay_next_call < time():
-
-            info = self._get_downloader_info()
-            requests = self.frontier.get_next_requests(key_type=info['key_type'], overused_keys=info['overused_keys'])
-            for request in requests:
-                self._add_pending_request(request)
-            self._delay_next_call = time() + self._delay_on_empty if not requests else 0.0
+            if self._async_fetch:
+                self._fetch_in_thread()
+            else:
+                started = time()
+                info = self._get_downloader_info()
+                requests = self.frontier.get_next_requests(key_type=info['key_type'],
+                                                           overused_keys=info['overused_keys'])
+                self._add_fetched_requests(requests, started, blocking=True)
         return self._get_pending_request()
 
+    def _fetch_in_thread(self):
+        """
+        Starts fetching of the next batch in reactor thread pool, unless the previous fetch is still in progress.
+        Fetched requests are added to the queue by callback in reactor thread, so the engine isn't blocked while
+        backend is waiting for the batch.
+        """
+        if self._fetching is not None:
+            return
+        started = time()
+        info = self._get_downloader_info()
+        self._fetching = threads.deferToThread(self.frontier.get_next_requests, key_type=info['key_type'],
+                                               overused_keys=info['overused_keys'])
+        self._fetching.addCallbacks(self._add_fetched_requests, self._fetch_failed,
+                                    callbackArgs=(started, False))
+
+    def _add_fetched_requests(self, requests, started, blocking):
+        self._fetching = None
+        for request in requests:
+            self._add_pending_request(request)
+        self._delay_next_call = time() + self._delay_on_empty if not requests else 0.0
+        self.stats_manager.add_fetch_time(time() - started, blocking)
+
+    def _fetch_failed(self, failure):
+        self._fetching = None
+        self._delay_next_call = time() + self._delay_on_empty
+        self.logger.error("Fetching of the next requests failed",
+                          exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
     def _add_pending_request(self, request):
         return self._pending_requests.append(request)
 
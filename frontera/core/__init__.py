@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 from six.moves.urllib.parse import urlparse
-from socket import getaddrinfo
+from six.moves.queue import Queue
+from socket import getaddrinfo, error as socket_error
 from collections import deque
+from heapq import nlargest, nsmallest
+from threading import Thread, Lock
+from time import time
 import six
 
 
@@ -23,52 +27,237 @@ def get_slot_key(request, type):  # TODO: Probably use caching here
     return key
 
 
+class SlotKeyResolver(object):
+    """
+    Cache of IP addresses of hostnames, used as slot keys. Hostnames are resolved asynchronously in a pool of
+    threads, so callers never block on DNS. Expired addresses are still returned while being refreshed.
+    """
+    def __init__(self, ttl=600.0, threads=4, max_size=100000):
+        """
+        :param ttl: seconds resolved address is considered fresh
+        :param threads: count of resolving threads
+        :param max_size: maximum count of cached hostnames, expired ones are evicted when it's reached, and the
+            oldest ones if there are not enough expired
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache = {}
+        self._resolving = set()
+        self._lock = Lock()
+        self._queue = Queue()
+        self._threads = [Thread(target=self._run, name="slot-key-resolver-%d" % i) for i in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+        self._started = False
+        self.hits = 0
+        self.misses = 0
+        self.resolved = 0
+        self.failed = 0
+        self.resolve_time = 0.0
+
+    def get_many(self, hostnames):
+        """
+        Looks up hostnames in cache. Missing and expired hostnames are scheduled for resolution in one batch.
+
+        :param hostnames: iterable of hostnames
+        :return: dict of hostname to IP address, only for hostnames found in cache
+        """
+        now = time()
+        found = {}
+        to_resolve = []
+        for hostname in set(hostnames):
+            entry = self._cache.get(hostname)
+            if entry is None:
+                self.misses += 1
+                to_resolve.append(hostname)
+                continue
+            self.hits += 1
+            found[hostname] = entry[0]
+            if entry[1] <= now:
+                to_resolve.append(hostname)
+        if to_resolve:
+            self.resolve(to_resolve)
+        return found
+
+    def resolve(self, hostnames):
+        with self._lock:
+            if not self._started:
+                for thread in self._threads:
+                    thread.start()
+                self._started = True
+            hostnames = [hostname for hostname in hostnames if hostname not in self._resolving]
+            self._resolving.update(hostnames)
+        for hostname in hostnames:
+            self._queue.put(hostname)
+
+    def join(self):
+        """
+        Blocks until all scheduled hostnames are resolved.
+        """
+        self._queue.join()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'cached': len(self._cache),
+            'resolving': len(self._resolving),
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+            'resolved': self.resolved,
+            'failed': self.failed,
+            'avg_resolve_ms': self.resolve_time / self.resolved * 1000 if self.resolved else None
+        }
+
+    def _run(self):
+        while True:
+            hostname = self._queue.get()
+            started = time()
+            try:
+                key = getaddrinfo(hostname, 80)[0][4][0]
+                failed = False
+            except (socket_error, IndexError, UnicodeError):
+                key = hostname
+                failed = True
+            now = time()
+            with self._lock:
+                if len(self._cache) >= self.max_size:
+                    self._evict(now)
+                self._cache[hostname] = (key, now + self.ttl)
+                self._resolving.discard(hostname)
+                self.resolved += 1
+                self.failed += int(failed)
+                self.resolve_time += now - started
+            self._queue.task_done()
+
+    def _evict(self, now):
+        expired = [hostname for hostname, (_, expires) in six.iteritems(self._cache) if expires <= now]
+        for hostname in expired:
+            del self._cache[hostname]
+        if len(self._cache) >= self.max_size:
+            # the oldest tenth is evicted at once, so eviction doesn't scan the cache on every insert
+            count = len(self._cache) - self.max_size + max(self.max_size // 10, 1)
+            oldest = nsmallest(count, six.iteritems(self._cache), key=lambda item: item[1][1])
+            for hostname, _ in oldest:
+                del self._cache[hostname]
+
+
+SLOT_KEY_RESOLVER = SlotKeyResolver()
+
+
 class OverusedBuffer(object):
     """
     A buffering object for implementing the buffer of Frontera requests for overused domains/ips. It can be used
     when customizing backend to address efficient downloader pool usage.
+
+    Keys having pending requests are kept in a ring, and pending requests are taken from keys which aren't overused
+    in round-robin manner, so it costs O(batch + overused keys) per call. The count of pending requests can be
+    limited per key and in total, requests not fitting into limits are passed to overflow function or, if it isn't
+    set, returned to the caller, leaving the throttling of the slot to downloader.
     """
-    def __init__(self, _get_func, log_func=None):
+    def __init__(self, _get_func, log_func=None, resolver=None, max_per_key=None, max_pending=None,
+                 overflow_func=None):
         """
         :param _get_func: reference to get_next_requests() method of binded class
         :param log_func: optional logging function, for logging of internal state
+        :param resolver: :class:`SlotKeyResolver` instance for 'ip' keys, shared one is used by default
+        :param max_per_key: maximum count of pending requests per key, None for no limit
+        :param max_pending: maximum count of pending requests in total, including ones which keys are being
+            resolved, None for no limit
+        :param overflow_func: optional function called with list of requests not fitting into limits, e.g. to put
+            them back to backend queue
         """
         self._pending = dict()
+        self._ring = deque()
+        self._size = 0
+        self._unresolved = []
         self._get = _get_func
         self._log = log_func
+        self._resolver = resolver or SLOT_KEY_RESOLVER
+        self._max_per_key = max_per_key
+        self._max_pending = max_pending
+        self._overflow = overflow_func
+        self.overflowed = 0
+
+    def _get_hostname(self, request):
+        return urlparse(request.url).hostname or ''
+
+    def _resolve(self, hostnames):
+        """
+        :return: dict of hostname to IP address, for hostnames already resolved
+        """
+        return self._resolver.get_many(hostnames)
 
-    def _get_key(self, request, type):
-        return get_slot_key(request, type)
+    def _get_keys(self, requests, type):
+        """
+        :return: list of slot keys of requests, None for requests which key is still being resolved
+        """
+        hostnames = [self._get_hostname(request) for request in requests]
+        if type != 'ip':
+            return hostnames
+        resolved = self._resolve(hostnames)
+        return [resolved.get(hostname) for hostname in hostnames]
 
     def _get_pending(self, max_n_requests, overused_set):
         requests = []
-        trash_can = []
-        try:
-            while True:
-                left = 0
-                for key, pending in six.iteritems(self._pending):
-                    if key in overused_set:
-                        continue
-
-                    if pending:
-                        requests.append(pending.popleft())
-                        if not pending:
-                            trash_can.append(key)
-                        left += len(pending)
-
-                    if len(requests) == max_n_requests:
-                        return requests
-
-                if left == 0:
-                    return requests
-        finally:
-            for k in trash_can:
-                del self._pending[k]
+        skipped = []
+        ring = self._ring
+        while ring and len(requests) < max_n_requests:
+            key = ring.popleft()
+            if key in overused_set:
+                skipped.append(key)
+                continue
+            pending = self._pending[key]
+            requests.append(pending.popleft())
+            if pending:
+                ring.append(key)
+            else:
+                del self._pending[key]
+        # overused keys keep their position in the ring
+        ring.extendleft(reversed(skipped))
+        self._size -= len(requests)
+        return requests
+
+    def _is_full(self):
+        return self._max_pending is not None and self._size + len(self._unresolved) >= self._max_pending
+
+    def _add_pending(self, key, request):
+        """
+        :return: True if request is added, False if it doesn't fit into limits
+        """
+        if self._is_full():
+            return False
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = deque()
+            self._ring.append(key)
+        elif self._max_per_key is not None and len(pending) >= self._max_per_key:
+            return False
+        pending.append(request)
+        self._size += 1
+        return True
+
+    def get_stats(self, top=10):
+        """
+        :param top: count of keys with the most pending requests to report
+        :return: dict with counts of pending requests, in total and per key
+        """
+        sizes = nlargest(top, ((len(pending), key) for key, pending in six.iteritems(self._pending)))
+        return {
+            'pending': self._size,
+            'pending_keys': len(self._pending),
+            'pending_per_key': dict((key, size) for size, key in sizes),
+            'unresolved': len(self._unresolved),
+            'overflowed': self.overflowed
+        }
 
     def get_next_requests(self, max_n_requests, **kwargs):
         if self._log:
             self._log("Overused keys: %s" % str(kwargs['overused_keys']))
-            self._log("Pending: %i" % (sum([len(pending) for pending in six.itervalues(self._pending)])))
+            self._log("Pending: %i" % self._size)
+            if self._pending:
+                sizes = nlargest(10, ((len(pending), key) for key, pending in six.iteritems(self._pending)))
+                self._log("Pending per key: %s" % ", ".join("%s=%d" % (key, size) for size, key in sizes))
+            if kwargs['key_type'] == 'ip':
+                self._log("Unresolved: %i, slot keys: %s" % (len(self._unresolved), self._resolver.get_stats()))
 
         overused_set = set(kwargs['overused_keys'])
         requests = self._get_pending(max_n_requests, overused_set)
@@ -76,10 +265,31 @@ class OverusedBuffer(object):
         if len(requests) == max_n_requests:
             return requests
 
-        for request in self._get(max_n_requests-len(requests), **kwargs):
-            key = self._get_key(request, kwargs['key_type'])
-            if key in overused_set:
-                self._pending.setdefault(key, deque()).append(request)
+        # requests which keys were resolving are checked again, without waiting for the resolution, and only the
+        # rest of demand is requested from backend
+        candidates = self._unresolved
+        missing = max_n_requests - len(requests) - len(candidates)
+        if missing > 0:
+            candidates.extend(self._get(missing, **kwargs))
+        self._unresolved = []
+        overflow = []
+        for request, key in zip(candidates, self._get_keys(candidates, kwargs['key_type'])):
+            if key is None:
+                if self._is_full():
+                    overflow.append(request)
+                else:
+                    self._unresolved.append(request)
+            elif key in overused_set or len(requests) == max_n_requests:
+                if not self._add_pending(key, request):
+                    overflow.append(request)
             else:
                 requests.append(request)
+        if overflow:
+            self.overflowed += len(overflow)
+            if self._log:
+                self._log("Pending requests limit is reached, %i requests overflowed" % len(overflow))
+            if self._overflow:
+                self._overflow(overflow)
+            else:
+                requests.extend(overflow)
         return requests
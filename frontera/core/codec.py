@@ -4,9 +4,59 @@ from abc import ABCMeta, abstractmethod
 import six
 
 
+class LazyMessage(object):
+    """
+    Decoded message, which has type and job id available right away, and the rest of message decoded on the first
+    access. Iterating and indexing it gives the same tuple as :meth:`BaseDecoder.decode`.
+    """
+    __slots__ = ['type', 'job_id', '_decode', '_message']
+
+    def __init__(self, type, job_id, decode):
+        """
+        :param str type: message type
+        :param job_id: job id of the request or response in message, None if message doesn't have one
+        :param decode: callable without arguments returning decoded message tuple
+        """
+        self.type = type
+        self.job_id = job_id
+        self._decode = decode
+        self._message = None
+
+    def decode(self):
+        """
+        :return: tuple of message type and related objects
+        """
+        if self._message is None:
+            self._message = self._decode()
+            self._decode = None
+        return self._message
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.type
+        return self.decode()[index]
+
+    def __len__(self):
+        return len(self.decode())
+
+
+def get_job_id(obj):
+    """
+    :param obj: Request or Response object
+    :return: job id or None
+    """
+    return obj.meta.get(b'jid') if obj.meta else None
+
+
 @six.add_metaclass(ABCMeta)
 class BaseDecoder(object):
 
+    #: True if decoder accepts memoryviews and other buffer objects along with bytes, see ZMQ_ZERO_COPY setting
+    supports_buffers = False
+
     @abstractmethod
     def decode(self, buffer):
         """
@@ -27,6 +77,23 @@ class BaseDecoder(object):
         """
         pass
 
+    def decode_lazy(self, buffer):
+        """
+        Decodes message type and job id, postponing creation of Request and Response objects till the message is
+        accessed, so messages filtered by type or job id are cheap. This implementation decodes the whole message,
+        codecs are expected to override it.
+
+        :param bytes buffer: encoded message
+        :return: :class:`LazyMessage`
+        """
+        message = self.decode(buffer)
+        type = message[0]
+        if type in ('page_crawled', 'links_extracted', 'request_error', 'update_score'):
+            job_id = get_job_id(message[1])
+        else:
+            job_id = None
+        return LazyMessage(type, job_id, lambda: message)
+
 
 @six.add_metaclass(ABCMeta)
 class BaseEncoder(object):
@@ -118,3 +185,15 @@ class BaseEncoder(object):
         :return: bytes encoded message
         """
         pass
+
+    def encode_credits(self, partition_id, offset, credits):
+        """
+        Encodes spider free capacity, in count of requests it can accept after consuming spider feed up to offset.
+        By default, encodes spider offset only, and DB worker falls back to lag based flow control.
+
+        :param int partition_id:
+        :param int offset:
+        :param int credits:
+        :return: bytes encoded message
+        """
+        return self.encode_offset(partition_id, offset)
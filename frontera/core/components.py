@@ -50,6 +50,17 @@ class Metadata(StartStopMixin):
         """
         pass
 
+    def links_extracted_many(self, batch):
+        """
+        This method is called with links extracted from many documents at once, e.g. from a batch of spider log.
+        Implementations can override it to process all links in one pass, default is calling
+        :meth:`links_extracted` for every document.
+
+        :param list batch: A list of (request, links) tuples, as passed to :meth:`links_extracted`.
+        """
+        for request, links in batch:
+            self.links_extracted(request, links)
+
     @abstractmethod
     def request_error(self, page, error):
         """
@@ -143,6 +154,14 @@ class States(StartStopMixin):
         """
         raise NotImplementedError
 
+    @property
+    def cache(self):
+        """
+        Internal cache of states, dict mapping fingerprint to state, or None if there is no such cache. Used by
+        :term:`strategy worker` to checkpoint the cache on disk.
+        """
+        return None
+
 
 @six.add_metaclass(ABCMeta)
 class Component(Metadata):
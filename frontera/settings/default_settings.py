@@ -2,12 +2,16 @@ from __future__ import absolute_import
 from datetime import timedelta
 
 
+ASYNC_FETCH = False
 AUTO_START = True
 BACKEND = 'frontera.contrib.backends.memory.FIFO'
 BC_MIN_REQUESTS = 64
 BC_MIN_HOSTS = 24
 BC_MAX_REQUESTS_PER_HOST = 128
 CANONICAL_SOLVER = 'frontera.contrib.canonicalsolvers.Basic'
+DB_WORKER_PREFETCH_TIME = 0.0
+DB_WORKER_QUEUE_SIZE = 1024
+DB_WORKER_THREADS = 0
 DELAY_ON_EMPTY = 5.0
 DOMAIN_FINGERPRINT_FUNCTION = 'frontera.utils.fingerprint.sha1'
 
@@ -15,14 +19,23 @@ HBASE_THRIFT_HOST = 'localhost'
 HBASE_THRIFT_PORT = 9090
 HBASE_NAMESPACE = 'crawler'
 HBASE_DROP_ALL_TABLES = False
+HBASE_METADATA_CACHE_SIZE = 0
 HBASE_METADATA_TABLE = 'metadata'
 HBASE_USE_SNAPPY = False
 HBASE_USE_FRAMED_COMPACT = False
 HBASE_BATCH_SIZE = 9216
 HBASE_STATE_CACHE_SIZE_LIMIT = 3000000
+HBASE_QUEUE_COMPACTION_INTERVAL = 0
 HBASE_QUEUE_TABLE = 'queue'
+KAFKA_BATCH_COMPRESSION = None
+KAFKA_BATCH_LINGER = 0.05
+KAFKA_BATCH_SIZE = 65536
 KAFKA_GET_TIMEOUT = 5.0
 KAFKA_CODEC_LEGACY = "none"
+LOCAL_BUS_BUFFER_SIZE = 8388608
+LOCAL_BUS_DIR = None
+LOCAL_BUS_NAME = 'frontera'
+LOCAL_BUS_SHARED_MEMORY = True
 MAX_NEXT_REQUESTS = 64
 MAX_REQUESTS = 0
 MESSAGE_BUS = 'frontera.contrib.messagebus.zeromq.MessageBus'
@@ -31,11 +44,15 @@ MIDDLEWARES = [
     'frontera.contrib.middlewares.fingerprint.UrlFingerprintMiddleware',
 ]
 NEW_BATCH_DELAY = 30.0
+OVERUSED_MAX_PENDING = 100000
+OVERUSED_MAX_PER_KEY = 1000
 OVERUSED_SLOT_FACTOR = 5.0
 QUEUE_HOSTNAME_PARTITIONING = False
 REQUEST_MODEL = 'frontera.core.models.Request'
 RESPONSE_MODEL = 'frontera.core.models.Response'
 
+SCORING_COALESCE_INTERVAL = 0.0
+SCORING_COALESCE_SIZE = 10000
 SCORING_PARTITION_ID = 0
 SCORING_LOG_CONSUMER_BATCH_SIZE = 512
 SPIDER_LOG_CONSUMER_BATCH_SIZE = 512
@@ -53,6 +70,7 @@ SQLALCHEMYBACKEND_MODELS = {
     'QueueModel': 'frontera.contrib.backends.sqlalchemy.models.QueueModel'
 }
 SQLALCHEMYBACKEND_REVISIT_INTERVAL = timedelta(days=1)
+STATE_CACHE_CHECKPOINT_DIR = None
 STATE_CACHE_SIZE = 1000000
 STATE_CACHE_SIZE_LIMIT = 0
 STORE_CONTENT = False
@@ -62,5 +80,9 @@ URL_FINGERPRINT_FUNCTION = 'frontera.utils.fingerprint.sha1'
 
 ZMQ_ADDRESS = '127.0.0.1'
 ZMQ_BASE_PORT = 5550
+ZMQ_BATCH_COMPRESSION = None
+ZMQ_BATCH_LINGER = 0.1
+ZMQ_BATCH_SIZE = 0
+ZMQ_ZERO_COPY = False
 
 LOGGING_CONFIG = 'logging.conf'
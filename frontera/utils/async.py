@@ -7,7 +7,8 @@ from six.moves import range
 
 class CallLaterOnce(object):
     """Schedule a function to be called in the next reactor loop, but only if
-    it hasn't been already scheduled since the last time it run.
+    it hasn't been already scheduled since the last time it run. Scheduling
+    with shorter delay than the pending one moves the call earlier.
     """
     def __init__(self, func, reactor=reactor, *a, **kw):
         self._func = func
@@ -31,6 +32,8 @@ class CallLaterOnce(object):
             if self._errfunc:
                 d.addErrback(self.error)
             self._call = self._reactor.callLater(delay, d.callback, None)
+        elif self._call.getTime() > self._reactor.seconds() + delay:
+            self._call.reset(delay)
 
     def cancel(self):
         if self._call:
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of message bus codecs, message bus implementations and HBase row encoders on generated crawl traffic.
+Results are printed as JSON objects, one per line::
+
+    python -m frontera.utils.benchmark --codecs msgpack,json --start-broker
+"""
+from __future__ import absolute_import
+from argparse import ArgumentParser
+from random import Random
+from struct import pack, unpack
+from threading import Thread
+from time import time, sleep
+import json
+import subprocess
+import sys
+
+from frontera.core.models import Request, Response
+from frontera.settings import Settings
+from frontera.utils.fingerprint import sha1
+from frontera.utils.misc import load_object
+import six
+from six.moves import range
+from w3lib.util import to_bytes
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+CODECS = {
+    'msgpack': 'frontera.contrib.backends.remote.codecs.msgpack',
+    'json': 'frontera.contrib.backends.remote.codecs.json',
+    'compact': 'frontera.contrib.backends.remote.codecs.compact'
+}
+
+
+class TrafficGenerator(object):
+    """
+    Generates requests and responses similar to the ones passing through the message bus in a broad crawl, with
+    meta set by Scrapy converter, domain and fingerprint middlewares.
+    """
+
+    def __init__(self, hosts=200, links_per_page=300, seed=0):
+        self.random = Random(seed)
+        self.hosts = [('www.host%d.com' % i).encode('ascii') for i in range(hosts)]
+        self.links_per_page = links_per_page
+
+    def request(self, depth=1):
+        host = self.random.choice(self.hosts)
+        url = 'http://%s/category/%d/item-%d.html' % (host.decode('ascii'), self.random.randint(0, 100),
+                                                      self.random.randint(0, 100000))
+        domain = {
+            b'netloc': host,
+            b'name': host,
+            b'scheme': b'http',
+            b'sld': host.split(b'.')[1],
+            b'tld': b'com',
+            b'subdomain': b'www',
+            b'fingerprint': sha1(host)
+        }
+        return Request(url, meta={
+            b'fingerprint': sha1(url),
+            b'domain': domain,
+            b'scrapy_callback': None,
+            b'scrapy_errback': None,
+            b'origin_is_frontier': True,
+            b'scrapy_meta': {b'depth': depth, b'link_text': b'Read more', b'download_timeout': 180.0},
+            b'depth': depth,
+            b'jid': 1,
+            b'state': 0
+        })
+
+    def response(self):
+        request = self.request()
+        return Response(request.url, status_code=200, body=b'<html></html>', request=request)
+
+    def links(self):
+        count = self.random.randint(self.links_per_page // 2, self.links_per_page * 3 // 2)
+        return [self.request(depth=2) for _ in range(count)]
+
+    def events(self, pages=50):
+        """
+        :param int pages: count of crawled pages
+        :return: list of (stream, event name, encoder method name, arguments) tuples
+        """
+        events = [('spider-log', 'add_seeds', 'encode_add_seeds', ([self.request() for _ in range(100)],))]
+        for _ in range(pages):
+            response = self.response()
+            links = self.links()
+            events.append(('spider-log', 'page_crawled', 'encode_page_crawled', (response,)))
+            events.append(('spider-log', 'links_extracted', 'encode_links_extracted', (response.request, links)))
+            for link in links:
+                events.append(('scoring-log', 'update_score', 'encode_update_score',
+                               (link, self.random.random(), True)))
+                events.append(('spider-feed', 'request', 'encode_request', (link,)))
+        events.append(('spider-log', 'request_error', 'encode_request_error',
+                       (self.request(), 'DNS lookup failed')))
+        return events
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def _decode(decoder, name, buffer):
+    if name == 'request':
+        return decoder.decode_request(buffer)
+    return decoder.decode(buffer)
+
+
+def benchmark_codec(name, events, repeat=3):
+    """
+    Measures encoding and decoding of every event type with codec.
+
+    :param str name: codec name from CODECS or path to codec module
+    :param list events: events generated by :meth:`TrafficGenerator.events`
+    :return: list of result dicts, one per event type
+    """
+    path = CODECS.get(name, name)
+    encoder = load_object(path + '.Encoder')(Request, send_body=True)
+    decoder = load_object(path + '.Decoder')(Request, Response)
+
+    by_type = {}
+    for stream, event, method, args in events:
+        by_type.setdefault((stream, event, method), []).append(args)
+
+    results = []
+    for (stream, event, method), arguments in sorted(by_type.items()):
+        encode = getattr(encoder, method)
+        buffers = [encode(*args) for args in arguments]
+        started = time()
+        for _ in range(repeat):
+            for args in arguments:
+                encode(*args)
+        encoding = (time() - started) / repeat
+        started = time()
+        for _ in range(repeat):
+            for buffer in buffers:
+                _decode(decoder, event, buffer)
+        decoding = (time() - started) / repeat
+
+        allocated = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            for args in arguments:
+                _decode(decoder, event, encode(*args))
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        count = len(arguments)
+        results.append({
+            'benchmark': 'codec',
+            'codec': name,
+            'stream': stream,
+            'event': event,
+            'events': count,
+            'bytes_per_event': sum(len(b) for b in buffers) / float(count),
+            'encode_us': encoding / count * 1e6,
+            'decode_us': decoding / count * 1e6,
+            'peak_allocated_bytes': allocated
+        })
+    return results
+
+
+def _prepare_hbase_object_reference(obj=None, **kwargs):
+    """
+    Generic HBase row encoder, which was used for every put before specialized encoders of
+    :mod:`frontera.contrib.backends.hbase`. Kept as a baseline for them.
+    """
+    pack_functions = {
+        'url': to_bytes,
+        'depth': lambda x: pack('>I', 0),
+        'created_at': lambda x: pack('>Q', x),
+        'status_code': lambda x: pack('>H', x),
+        'state': lambda x: pack('>B', x),
+        'error': to_bytes,
+        'domain_fingerprint': to_bytes,
+        'score': lambda x: pack('>f', x),
+        'content': to_bytes
+    }
+    if not obj:
+        obj = dict()
+    for k, v in six.iteritems(kwargs):
+        if k in ['score', 'state']:
+            cf = 's'
+        elif k == 'content':
+            cf = 'c'
+        else:
+            cf = 'm'
+        obj[cf + ':' + k] = pack_functions[k](v)
+    return obj
+
+
+def benchmark_row_encoders(requests, repeat=3):
+    """
+    Measures HBase row encoders of every metadata event against :func:`_prepare_hbase_object_reference`.
+
+    :param list requests: requests to encode rows of
+    :return: list of result dicts, one per event
+    """
+    from frontera.contrib.backends import hbase
+
+    created_at = int(time())
+    packed_ts = hbase.pack_timestamp(created_at)
+    cases = [
+        ('seed', lambda r: _prepare_hbase_object_reference(url=r.url, depth=0, created_at=created_at,
+                                                           domain_fingerprint=r.meta[b'domain'][b'fingerprint']),
+         lambda r: hbase.prepare_seed_object(r.url, r.meta[b'domain'][b'fingerprint'], packed_ts)),
+        ('link', lambda r: _prepare_hbase_object_reference(url=r.url, created_at=created_at,
+                                                           domain_fingerprint=r.meta[b'domain'][b'fingerprint']),
+         lambda r: hbase.prepare_link_object(r.url, r.meta[b'domain'][b'fingerprint'], packed_ts)),
+        ('crawled', lambda r: _prepare_hbase_object_reference(status_code=200, content=b'<html></html>'),
+         lambda r: hbase.prepare_crawled_object(200, b'<html></html>')),
+        ('error', lambda r: _prepare_hbase_object_reference(url=r.url, created_at=created_at, error='DNS lookup failed',
+                                                            domain_fingerprint=r.meta[b'domain'][b'fingerprint']),
+         lambda r: hbase.prepare_error_object(r.url, 'DNS lookup failed', r.meta[b'domain'][b'fingerprint'],
+                                              packed_ts)),
+        ('state', lambda r: _prepare_hbase_object_reference(state=r.meta[b'state']),
+         lambda r: hbase.prepare_state_object(r.meta[b'state'])),
+        ('score', lambda r: _prepare_hbase_object_reference(score=0.5),
+         lambda r: hbase.prepare_score_object(0.5))
+    ]
+
+    def measure(encode):
+        started = time()
+        for _ in range(repeat):
+            for request in requests:
+                encode(request)
+        return (time() - started) / repeat / len(requests) * 1e6
+
+    results = []
+    for event, reference, encoder in cases:
+        reference_us = measure(reference)
+        encoder_us = measure(encoder)
+        results.append({
+            'benchmark': 'row_encoder',
+            'event': event,
+            'rows': len(requests),
+            'reference_us': reference_us,
+            'encoder_us': encoder_us,
+            'speedup': reference_us / encoder_us if encoder_us else None
+        })
+    return results
+
+
+def benchmark_bus(messagebus, events, codec='msgpack', messages=20000, rate=0):
+    """
+    Sends encoded spider log events through the message bus from a separate thread and measures latency of every
+    message and overall throughput. Send time is prepended to every message.
+
+    :param messagebus: message bus instance
+    :param int rate: messages per second sent by producer, 0 to send as fast as possible
+    :return: result dict
+    """
+    path = CODECS.get(codec, codec)
+    encoder = load_object(path + '.Encoder')(Request, send_body=True)
+    payloads = [(sha1(args[0].url if event != 'add_seeds' else 'seeds'), to_bytes(getattr(encoder, method)(*args)))
+                for stream, event, method, args in events if stream == 'spider-log']
+    spider_log = messagebus.spider_log()
+    consumer = spider_log.consumer(partition_id=None, type=b'db')
+    producer = spider_log.producer()
+    sleep(0.3)
+
+    def produce():
+        produce_started = time()
+        for i in range(messages):
+            if rate:
+                delay = produce_started + float(i) / rate - time()
+                if delay > 0:
+                    sleep(delay)
+            key, payload = payloads[i % len(payloads)]
+            producer.send(key, pack('>d', time()) + payload)
+        producer.flush()
+
+    latencies = []
+    sent_bytes = 0
+    thread = Thread(target=produce)
+    started = time()
+    thread.start()
+    while len(latencies) < messages:
+        received = 0
+        for m in consumer.get_messages(timeout=1.0, count=1024):
+            m = bytes(m)
+            latencies.append(time() - unpack('>d', m[:8])[0])
+            sent_bytes += len(m)
+            received += 1
+        if not received:
+            break
+    elapsed = time() - started - (0 if len(latencies) == messages else 1.0)
+    thread.join()
+    return {
+        'benchmark': 'bus',
+        'bus': '%s.%s' % (messagebus.__class__.__module__, messagebus.__class__.__name__),
+        'codec': codec,
+        'sent': messages,
+        'rate': rate,
+        'received': len(latencies),
+        'messages_per_sec': len(latencies) / elapsed if elapsed > 0 else None,
+        'bytes_per_sec': sent_bytes / elapsed if elapsed > 0 else None,
+        'latency_p50_ms': _percentile(latencies, 0.5) * 1000 if latencies else None,
+        'latency_p99_ms': _percentile(latencies, 0.99) * 1000 if latencies else None
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Frontera message bus and codecs benchmark.")
+    parser.add_argument('--config', type=str,
+                        help='Settings module name, should be accessible by import. Message bus is taken from '
+                        'MESSAGE_BUS setting.')
+    parser.add_argument('--codecs', type=str, default=','.join(sorted(CODECS)),
+                        help='Comma separated codec names or module paths. Default is all codecs.')
+    parser.add_argument('--pages', type=int, default=50, help='Count of crawled pages to generate.')
+    parser.add_argument('--links', type=int, default=300, help='Average count of links per page.')
+    parser.add_argument('--messages', type=int, default=20000, help='Count of messages sent through the bus.')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='Messages per second sent through the bus, default is as fast as possible.')
+    parser.add_argument('--no-bus', action='store_true', help='Benchmark codecs only.')
+    parser.add_argument('--row-encoders', action='store_true',
+                        help='Benchmark HBase row encoders only, requires happybase.')
+    parser.add_argument('--start-broker', action='store_true',
+                        help='Start ZeroMQ broker on ZMQ_BASE_PORT for the time of benchmark.')
+    parser.add_argument('--native-proxy', action='store_true',
+                        help='Start ZeroMQ broker in native proxy mode, see --start-broker.')
+    args = parser.parse_args()
+
+    settings = Settings(module=args.config)
+    if args.row_encoders:
+        generator = TrafficGenerator(links_per_page=args.links)
+        for result in benchmark_row_encoders([generator.request() for _ in range(args.pages * args.links)]):
+            print(json.dumps(result, sort_keys=True))
+        return
+
+    codecs = args.codecs.split(',')
+    events = TrafficGenerator(links_per_page=args.links).events(args.pages)
+    for codec in codecs:
+        for result in benchmark_codec(codec, events):
+            print(json.dumps(result, sort_keys=True))
+    if args.no_bus:
+        return
+
+    broker = None
+    if args.start_broker:
+        broker = subprocess.Popen([sys.executable, '-m', 'frontera.contrib.messagebus.zeromq.broker',
+                                   '--port', str(settings.get('ZMQ_BASE_PORT'))] +
+                                  (['--native-proxy'] if args.native_proxy else []))
+        sleep(1.0)
+    try:
+        messagebus = load_object(settings.get('MESSAGE_BUS'))(settings)
+        for codec in codecs:
+            print(json.dumps(benchmark_bus(messagebus, events, codec, args.messages, args.rate), sort_keys=True))
+    finally:
+        if broker is not None:
+            broker.terminate()
+            broker.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk checkpoints of strategy worker state cache. Checkpoint is a header followed by fixed size records of binary
+SHA1 fingerprint and state byte, so it can be loaded from memory-mapped file in one pass.
+"""
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+from struct import Struct
+import mmap
+import os
+
+import six
+
+MAGIC = b'FRSC\x01'
+RECORD = Struct('>20sB')
+
+
+def write_states_checkpoint(path, cache, chunk_size=65536):
+    """
+    Writes states cache to file atomically, replacing existing checkpoint. Fingerprints which aren't hex encoded
+    SHA1 hashes are skipped.
+
+    :param str path: path of checkpoint file
+    :param dict cache: mapping of fingerprint to state
+    :return: count of written states
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        buffer = []
+        for fingerprint, state in six.iteritems(cache):
+            try:
+                raw = unhexlify(fingerprint)
+            except (TypeError, ValueError):
+                continue
+            if len(raw) != RECORD.size - 1:
+                continue
+            buffer.append(RECORD.pack(raw, state))
+            if len(buffer) >= chunk_size:
+                f.write(b''.join(buffer))
+                count += len(buffer)
+                buffer = []
+        f.write(b''.join(buffer))
+        count += len(buffer)
+    os.rename(tmp_path, path)
+    return count
+
+
+def load_states_checkpoint(path, cache):
+    """
+    Loads states from checkpoint file into cache.
+
+    :param str path: path of checkpoint file
+    :param dict cache: mapping of fingerprint to state to update
+    :return: count of loaded states
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            raise ValueError("Checkpoint %s is truncated" % path)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s isn't a state cache checkpoint" % path)
+            end = size - (size - len(MAGIC)) % RECORD.size
+            unpack_from = RECORD.unpack_from
+            records = (unpack_from(mm, offset) for offset in six.moves.range(len(MAGIC), end, RECORD.size))
+            cache.update((hexlify(fingerprint), state) for fingerprint, state in records)
+        finally:
+            mm.close()
+    return (end - len(MAGIC)) // RECORD.size
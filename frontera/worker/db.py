@@ -5,10 +5,12 @@ from traceback import format_stack
 from signal import signal, SIGUSR1
 from logging.config import fileConfig
 from argparse import ArgumentParser
-from time import asctime
+from time import asctime, time
 from os.path import exists
+from collections import deque
+from threading import Thread, Lock
 
-from twisted.internet import reactor, task
+from twisted.internet import reactor, task, threads
 from frontera.core.components import DistributedBackend
 from frontera.core.manager import FrontierManager
 from frontera.utils.url import parse_domain_from_url_fast
@@ -19,11 +21,127 @@ from frontera.utils.misc import load_object
 from frontera.utils.async import CallLaterOnce
 from .server import WorkerJsonRpcService
 import six
-from six.moves import map
+from six.moves import map, range
+from six.moves.queue import Queue
 
 logger = logging.getLogger("db-worker")
 
 
+def get_host_fingerprint(request):
+    domain = request.meta.get(b'domain')
+    return domain.get(b'fingerprint') if isinstance(domain, dict) else None
+
+
+class StageStats(object):
+    """
+    Count of items passed through pipeline stage and time spent on them, updated from any thread.
+    """
+    def __init__(self):
+        self.items = 0
+        self.time = 0.0
+        self._lock = Lock()
+
+    def add(self, items, time):
+        with self._lock:
+            self.items += items
+            self.time += time
+
+    def to_dict(self):
+        return {'items': self.items, 'time': self.time}
+
+
+class ScoreUpdatesBuffer(object):
+    """
+    Coalesces score updates by fingerprint between flushes. The latest score wins, and request is scheduled if any of
+    coalesced updates was scheduling it.
+    """
+    def __init__(self, flush_interval, max_size):
+        """
+        :param float flush_interval: seconds updates are kept before flushing, 0.0 to flush every time
+        :param int max_size: count of fingerprints triggering flush before interval
+        """
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.updates = {}
+        self.last_flush = time()
+        self.collapsed = 0
+
+    def add(self, fingerprint, score, request, schedule):
+        update = self.updates.get(fingerprint)
+        if update is None:
+            self.updates[fingerprint] = [score, request, schedule]
+            return
+        update[0] = score
+        update[1] = request
+        update[2] = update[2] or schedule
+        self.collapsed += 1
+
+    def is_ready(self):
+        return len(self.updates) >= self.max_size or time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """
+        :return: list of (fingerprint, score, request, schedule) tuples, as expected by :meth:`Queue.schedule`
+        """
+        batch = [(fingerprint, score, request, schedule)
+                 for fingerprint, (score, request, schedule) in six.iteritems(self.updates)]
+        self.updates = {}
+        self.last_flush = time()
+        return batch
+
+    def __len__(self):
+        return len(self.updates)
+
+
+class ApplyStage(object):
+    """
+    Applies decoded spider log messages to backend in a separate thread, in the order of consumption, through a
+    bounded queue. Backends aren't thread-safe, so there is one apply thread, and apply callable is expected to
+    serialize backend calls with other threads.
+    """
+    def __init__(self, apply, queue_size):
+        self.apply = apply
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self._run, name="db-worker-apply")
+        self.thread.daemon = True
+        self.stats = StageStats()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def put(self, msg):
+        self.queue.put(msg)
+
+    def is_full(self):
+        return self.queue.full()
+
+    def join(self):
+        self.queue.join()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            msg = queue.get()
+            try:
+                if msg is None:
+                    break
+                started = time()
+                try:
+                    self.apply(msg)
+                except Exception:
+                    logger.exception("Error applying %s message", msg[0])
+                self.stats.add(1, time() - started)
+            finally:
+                queue.task_done()
+
+
 class Slot(object):
     def __init__(self, new_batch, consume_incoming, consume_scoring, no_batches, enable_strategy_worker,
                  new_batch_delay, no_incoming):
@@ -60,6 +178,13 @@ class Slot(object):
             self.scoring_consumption.schedule()
         self.scheduling.schedule(5.0)
 
+    def schedule_new_batch(self):
+        """
+        Generates new batch in the next reactor loop, instead of waiting for the new batch delay.
+        """
+        if not self.disable_new_batches:
+            self.new_batch.schedule(0)
+
 
 class DBWorker(object):
     def __init__(self, settings, no_batches, no_incoming):
@@ -91,13 +216,46 @@ class DBWorker(object):
         self.scoring_log_consumer_batch_size = settings.get('SCORING_LOG_CONSUMER_BATCH_SIZE')
         self.spider_feed_partitioning = 'fingerprint' if not settings.get('QUEUE_HOSTNAME_PARTITIONING') else 'hostname'
         self.max_next_requests = settings.MAX_NEXT_REQUESTS
-        self.slot = Slot(self.new_batch, self.consume_incoming, self.consume_scoring, no_batches,
+        # serializes backend calls of apply thread, batch generation thread and reactor thread
+        self._backend_lock = Lock()
+        # guards spider feed partitions state below, updated from reactor thread and batch generation thread
+        self._partitions_lock = Lock()
+        # partition id -> count of requests spider is able to accept, as advertised by spiders
+        self.credits = {}
+        # partition id -> time partition became ready, till batch is sent to it
+        self.ready_since = {}
+        # partitions which spiders sent offset or credits at least once
+        self.active_partitions = set()
+        self.prefetch_time = settings.get('DB_WORKER_PREFETCH_TIME')
+        # partition id -> deque of requests dequeued from backend and encoded ahead of demand
+        self.prefetched = {}
+        # partition id -> requests per second sent to partition, and time of last batch
+        self.consumption_rate = {}
+        self.last_sent = {}
+        if settings.get('DB_WORKER_THREADS'):
+            self.apply_stage = ApplyStage(self._apply, settings.get('DB_WORKER_QUEUE_SIZE'))
+            self.apply_stage.start()
+            new_batch = self.new_batch_in_thread
+        else:
+            self.apply_stage = None
+            new_batch = self.new_batch
+            if self.prefetch_time:
+                logger.warning("Prefetching requires DB_WORKER_THREADS, DB_WORKER_PREFETCH_TIME is ignored")
+                self.prefetch_time = 0.0
+        self.score_buffer = ScoreUpdatesBuffer(settings.get('SCORING_COALESCE_INTERVAL'),
+                                               settings.get('SCORING_COALESCE_SIZE'))
+        self.decode_stats = StageStats()
+        self.batch_stats = StageStats()
+        self._batch_running = False
+        self._batch_requested = False
+        self.slot = Slot(new_batch, self.consume_incoming, self.consume_scoring, no_batches,
                          self.strategy_enabled, settings.get('NEW_BATCH_DELAY'), no_incoming)
         self.job_id = 0
         self.stats = {
             'consumed_since_start': 0,
             'consumed_scoring_since_start': 0,
-            'pushed_since_start': 0
+            'pushed_since_start': 0,
+            'idle_time_since_start': 0.0
         }
         self._logging_task = task.LoopingCall(self.log_status)
 
@@ -116,8 +274,41 @@ class DBWorker(object):
         reactor.run()
 
     def stop(self):
+        if self.apply_stage:
+            logger.info("Waiting for queued messages to be applied.")
+            self.apply_stage.stop()
+        self.return_prefetched()
+        if self.strategy_enabled:
+            self.flush_scores()
         logger.info("Stopping frontier manager.")
-        self._manager.stop()
+        with self._backend_lock:
+            self._manager.stop()
+
+    def return_prefetched(self):
+        """
+        Puts prefetched requests back to backend queue, backends remove requests from queue once they are dequeued.
+        """
+        with self._partitions_lock:
+            requests = [request for buffer in six.itervalues(self.prefetched) for request, _, _, _ in buffer]
+            self.prefetched = {}
+        if not requests:
+            return
+        logger.info("Returning %d prefetched requests to queue.", len(requests))
+        with self._backend_lock:
+            self._backend.queue.schedule([(request.meta[b'fingerprint'], request.meta.get(b'score', 1.0), request, True)
+                                          for request in requests])
+
+    def stage_stats(self):
+        """
+        :return: dict with items processed and time spent in every stage of DB worker
+        """
+        stages = {
+            'decode': self.decode_stats.to_dict(),
+            'batch': dict(self.batch_stats.to_dict(), running=self._batch_running)
+        }
+        if self.apply_stage:
+            stages['apply'] = dict(self.apply_stage.stats.to_dict(), queue_depth=self.apply_stage.depth())
+        return stages
 
     def log_status(self):
         for k, v in six.iteritems(self.stats):
@@ -129,46 +320,63 @@ class DBWorker(object):
     def enable_new_batches(self):
         self.slot.disable_new_batches = False
 
+    def mark_ready(self, partition_id):
+        """
+        Marks spider feed partition ready and triggers new batch, if partition wasn't waiting for one already.
+        """
+        with self._partitions_lock:
+            self.spider_feed.mark_ready(partition_id)
+            if partition_id in self.ready_since:
+                return
+            self.ready_since[partition_id] = time()
+        self.slot.schedule_new_batch()
+
+    def mark_busy(self, partition_id):
+        with self._partitions_lock:
+            self.spider_feed.mark_busy(partition_id)
+            self.ready_since.pop(partition_id, None)
+
     def consume_incoming(self, *args, **kwargs):
+        if self.apply_stage and self.apply_stage.is_full():
+            # backend doesn't keep up, messages are left in spider log meanwhile
+            self.slot.consumption.schedule(0.1)
+            return 0
         consumed = 0
-        for m in self.spider_log_consumer.get_messages(timeout=1.0, count=self.spider_log_consumer_batch_size):
+        started = time()
+        decoding = 0.0
+        # links extracted from pages of the batch are applied at once, messages of hosts having links in the group
+        # are applied after it to keep the order of host messages
+        links_extracted = []
+        links_keys = set()
+        for m in self.spider_log_consumer.get_messages(timeout=0.1, count=self.spider_log_consumer_batch_size):
+            decode_started = time()
             try:
-                msg = self._decoder.decode(m)
+                msg = self._decoder.decode_lazy(m)
+                # messages of other jobs are dropped before creating requests
+                if msg.type in ('page_crawled', 'links_extracted', 'request_error') and msg.job_id != self.job_id:
+                    continue
+                msg = msg.decode()
+                decoding += time() - decode_started
             except (KeyError, TypeError) as e:
                 logger.error("Decoding error: %s", e)
                 continue
             else:
                 type = msg[0]
-                if type == 'add_seeds':
-                    _, seeds = msg
-                    logger.info('Adding %i seeds', len(seeds))
-                    for seed in seeds:
-                        logger.debug('URL: %s', seed.url)
-                    self._backend.add_seeds(seeds)
-                    continue
-                if type == 'page_crawled':
-                    _, response = msg
-                    logger.debug("Page crawled %s", response.url)
-                    if b'jid' not in response.meta or response.meta[b'jid'] != self.job_id:
-                        continue
-                    self._backend.page_crawled(response)
-                    continue
                 if type == 'links_extracted':
-                    _, request, links = msg
-                    logger.debug("Links extracted %s (%d)", request.url, len(links))
-                    if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
-                        continue
-                    self._backend.links_extracted(request, links)
+                    links_extracted.append(msg[1:])
+                    links_keys.add(self._get_message_key(msg))
                     continue
-                if type == 'request_error':
-                    _, request, error = msg
-                    logger.debug("Request error %s", request.url)
-                    if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
-                        continue
-                    self._backend.request_error(request, error)
+                if type in ('add_seeds', 'page_crawled', 'request_error'):
+                    if links_extracted and self._get_message_key(msg) in links_keys:
+                        self._put(('links_extracted_many', links_extracted))
+                        links_extracted = []
+                        links_keys.clear()
+                    self._put(msg)
                     continue
                 if type == 'offset':
                     _, partition_id, offset = msg
+                    with self._partitions_lock:
+                        self.active_partitions.add(partition_id)
                     try:
                         producer_offset = self.spider_feed_producer.get_offset(partition_id)
                     except KeyError:
@@ -179,29 +387,109 @@ class DBWorker(object):
                             # non-sense in general, happens when SW is restarted and not synced yet with Spiders.
                             continue
                         if lag < self.max_next_requests or offset == 0:
-                            self.spider_feed.mark_ready(partition_id)
+                            self.mark_ready(partition_id)
                         else:
-                            self.spider_feed.mark_busy(partition_id)
+                            self.mark_busy(partition_id)
+                    continue
+                if type == 'credits':
+                    _, partition_id, offset, credits = msg
+                    with self._partitions_lock:
+                        self.active_partitions.add(partition_id)
+                    try:
+                        producer_offset = self.spider_feed_producer.get_offset(partition_id)
+                    except KeyError:
+                        # nothing was sent to partition yet, or message bus doesn't track offsets
+                        producer_offset = offset
+                    lag = producer_offset - offset
+                    if lag < 0:
+                        continue
+                    with self._partitions_lock:
+                        self.credits[partition_id] = max(credits - lag, 0)
+                        ready = self.credits[partition_id] > 0
+                    if ready:
+                        self.mark_ready(partition_id)
+                    else:
+                        self.mark_busy(partition_id)
                     continue
                 logger.debug('Unknown message type %s', type)
             finally:
                 consumed += 1
+        if links_extracted:
+            self._put(('links_extracted_many', links_extracted))
+        self.decode_stats.add(consumed, decoding)
         """
         # TODO: Think how it should be implemented in DB-worker only mode.
         if not self.strategy_enabled and self._backend.finished():
             logger.info("Crawling is finished.")
             reactor.stop()
         """
+        if not consumed:
+            self.stats['idle_time_since_start'] += time() - started
         self.stats['consumed_since_start'] += consumed
         self.stats['last_consumed'] = consumed
         self.stats['last_consumption_run'] = asctime()
         self.slot.schedule()
         return consumed
 
+    def _put(self, msg):
+        if self.apply_stage:
+            self.apply_stage.put(msg)
+        else:
+            self._apply(msg)
+
+    def _apply(self, msg):
+        with self._backend_lock:
+            self._apply_to_backend(msg)
+
+    def _apply_to_backend(self, msg):
+        type = msg[0]
+        if type == 'add_seeds':
+            _, seeds = msg
+            logger.info('Adding %i seeds', len(seeds))
+            for seed in seeds:
+                logger.debug('URL: %s', seed.url)
+            self._backend.add_seeds(seeds)
+        elif type == 'page_crawled':
+            _, response = msg
+            logger.debug("Page crawled %s", response.url)
+            if b'jid' not in response.meta or response.meta[b'jid'] != self.job_id:
+                return
+            self._backend.page_crawled(response)
+        elif type == 'links_extracted':
+            _, request, links = msg
+            logger.debug("Links extracted %s (%d)", request.url, len(links))
+            if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
+                return
+            self._backend.links_extracted(request, links)
+        elif type == 'links_extracted_many':
+            _, batch = msg
+            batch = [(request, links) for request, links in batch
+                     if b'jid' in request.meta and request.meta[b'jid'] == self.job_id]
+            logger.debug("Links extracted from %d pages (%d)", len(batch), sum(len(links) for _, links in batch))
+            if batch:
+                self._backend.links_extracted_many(batch)
+        elif type == 'request_error':
+            _, request, error = msg
+            logger.debug("Request error %s", request.url)
+            if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
+                return
+            self._backend.request_error(request, error)
+
+    def _get_message_key(self, msg):
+        """
+        :return: host fingerprint, the message was partitioned by in spider log
+        """
+        if msg[0] == 'add_seeds':
+            obj = msg[1][0] if msg[1] else None
+        elif msg[0] == 'links_extracted':
+            obj = msg[2][0] if msg[2] else msg[1]
+        else:
+            obj = msg[1]
+        return get_host_fingerprint(obj) if obj is not None else None
+
     def consume_scoring(self, *args, **kwargs):
         consumed = 0
-        seen = set()
-        batch = []
+        started = time()
         for m in self.scoring_log_consumer.get_messages(count=self.scoring_log_consumer_batch_size):
             try:
                 msg = self._decoder.decode(m)
@@ -211,48 +499,75 @@ class DBWorker(object):
             else:
                 if msg[0] == 'update_score':
                     _, request, score, schedule = msg
-                    if request.meta[b'fingerprint'] not in seen:
-                        batch.append((request.meta[b'fingerprint'], score, request, schedule))
-                        seen.add(request.meta[b'fingerprint'])
+                    self.score_buffer.add(request.meta[b'fingerprint'], score, request, schedule)
                 if msg[0] == 'new_job_id':
                     self.job_id = msg[1]
             finally:
                 consumed += 1
-        self.queue.schedule(batch)
+        if self.score_buffer.is_ready():
+            self.flush_scores()
+        self.stats['score_updates_buffered'] = len(self.score_buffer)
+        self.stats['score_updates_collapsed'] = self.score_buffer.collapsed
 
+        if not consumed:
+            self.stats['idle_time_since_start'] += time() - started
         self.stats['consumed_scoring_since_start'] += consumed
         self.stats['last_consumed_scoring'] = consumed
         self.stats['last_consumption_run_scoring'] = asctime()
         self.slot.schedule()
 
-    def new_batch(self, *args, **kwargs):
-        def get_hostname(request):
-            try:
-                netloc, name, scheme, sld, tld, subdomain = parse_domain_from_url_fast(request.url)
-            except Exception as e:
-                logger.error("URL parsing error %s, fingerprint %s, url %s" % (e, request.meta[b'fingerprint'],
-                                                                               request.url))
-                return None
-            else:
-                return name.encode('utf-8', 'ignore')
+    def flush_scores(self):
+        batch = self.score_buffer.flush()
+        if batch:
+            with self._backend_lock:
+                self.queue.schedule(batch)
 
-        def get_fingerprint(request):
-            return request.meta[b'fingerprint']
+    def new_batch_in_thread(self, *args, **kwargs):
+        """
+        Generates new batch in a thread of reactor pool. New batch requested while one is generated is generated right
+        after it.
+        """
+        if self._batch_running:
+            self._batch_requested = True
+            return
+        self._batch_running = True
+        self._batch_requested = False
+        d = threads.deferToThread(self.new_batch)
+        d.addBoth(self._new_batch_done)
+        return d
+
+    def _new_batch_done(self, result):
+        self._batch_running = False
+        if self._batch_requested:
+            self.slot.schedule_new_batch()
+        return result
+
+    def get_hostname(self, request):
+        try:
+            netloc, name, scheme, sld, tld, subdomain = parse_domain_from_url_fast(request.url)
+        except Exception as e:
+            logger.error("URL parsing error %s, fingerprint %s, url %s" % (e, request.meta[b'fingerprint'],
+                                                                           request.url))
+            return None
+        else:
+            return name.encode('utf-8', 'ignore')
 
-        partitions = self.spider_feed.available_partitions()
-        logger.info("Getting new batches for partitions %s" % str(",").join(map(str, partitions)))
-        if not partitions:
-            return 0
+    def get_fingerprint(self, request):
+        return request.meta[b'fingerprint']
 
-        count = 0
+    def _encode_requests(self, requests):
+        """
+        :return: list of (request, key, encoded request, job id) tuples
+        """
         if self.spider_feed_partitioning == 'hostname':
-            get_key = get_hostname
+            get_key = self.get_hostname
         elif self.spider_feed_partitioning == 'fingerprint':
-            get_key = get_fingerprint
+            get_key = self.get_fingerprint
         else:
             raise Exception("Unexpected value in self.spider_feed_partitioning")
 
-        for request in self._backend.get_next_requests(self.max_next_requests, partitions=partitions):
+        encoded = []
+        for request in requests:
             try:
                 request.meta[b'jid'] = self.job_id
                 eo = self._encoder.encode_request(request)
@@ -261,15 +576,109 @@ class DBWorker(object):
                                                                                request.meta[b'fingerprint'],
                                                                                request.url))
                 continue
-            finally:
-                count += 1
-            self.spider_feed_producer.send(get_key(request), eo)
+            encoded.append((request, get_key(request), eo, self.job_id))
+        return encoded
+
+    def _get_batch(self, partition_id, count):
+        """
+        Takes prefetched requests first, and gets the rest from backend.
+        """
+        batch = []
+        with self._partitions_lock:
+            buffer = self.prefetched.get(partition_id)
+            prefetched = [buffer.popleft() for _ in range(min(len(buffer), count))] if buffer else []
+        for request, key, eo, job_id in prefetched:
+            if job_id != self.job_id:
+                batch.extend(self._encode_requests([request]))
+            else:
+                batch.append((request, key, eo, job_id))
+        if len(batch) < count:
+            with self._backend_lock:
+                requests = self._backend.get_next_requests(count - len(batch), partitions=[partition_id])
+            batch.extend(self._encode_requests(requests))
+        return batch
+
+    def _update_consumption_rate(self, partition_id, pushed):
+        now = time()
+        last_sent = self.last_sent.get(partition_id)
+        self.last_sent[partition_id] = now
+        if last_sent is None or now <= last_sent:
+            return
+        rate = pushed / (now - last_sent)
+        previous = self.consumption_rate.get(partition_id)
+        self.consumption_rate[partition_id] = rate if previous is None else previous * 0.7 + rate * 0.3
+
+    def prefetch(self):
+        """
+        Tops up buffers of encoded requests for every spider feed partition consumed by a spider, to cover consumption
+        of partition spider during :setting:`DB_WORKER_PREFETCH_TIME`, but not less than one batch.
+        """
+        prefetched = 0
+        with self._partitions_lock:
+            partitions = sorted(self.active_partitions)
+        for partition_id in partitions:
+            with self._partitions_lock:
+                buffer = self.prefetched.setdefault(partition_id, deque())
+                missing = max(int(self.consumption_rate.get(partition_id, 0.0) * self.prefetch_time),
+                              self.max_next_requests) - len(buffer)
+            if missing > 0:
+                with self._backend_lock:
+                    requests = self._backend.get_next_requests(missing, partitions=[partition_id])
+                encoded = self._encode_requests(requests)
+                with self._partitions_lock:
+                    buffer.extend(encoded)
+            prefetched += len(buffer)
+        self.stats['prefetched'] = prefetched
+
+    def new_batch(self, *args, **kwargs):
+        started = time()
+        with self._partitions_lock:
+            partitions = self.spider_feed.available_partitions()
+        logger.info("Getting new batches for partitions %s" % str(",").join(map(str, partitions)))
+        if not partitions:
+            if self.prefetch_time:
+                self.prefetch()
+            return 0
+
+        count = 0
+        latencies = []
+        for partition_id in list(partitions):
+            # batch is sized to spider credits, partitions of spiders not sending credits are getting full batches
+            with self._partitions_lock:
+                max_next_requests = min(self.credits.get(partition_id, self.max_next_requests),
+                                        self.max_next_requests)
+            if max_next_requests <= 0:
+                continue
+            pushed = 0
+            for request, key, eo, _ in self._get_batch(partition_id, max_next_requests):
+                self.spider_feed_producer.send(key, eo)
+                pushed += 1
+            count += pushed
+            self._update_consumption_rate(partition_id, pushed)
+            with self._partitions_lock:
+                if pushed and partition_id in self.ready_since:
+                    # partitions left without requests are waiting further, and aren't triggering new batches
+                    latencies.append(time() - self.ready_since.pop(partition_id))
+                exhausted = False
+                if partition_id in self.credits:
+                    self.credits[partition_id] = max(self.credits[partition_id] - pushed, 0)
+                    exhausted = not self.credits[partition_id]
+            if exhausted:
+                self.mark_busy(partition_id)
+        self.spider_feed_producer.flush()
+
+        if latencies:
+            self.stats['last_batch_latency'] = max(latencies)
 
         self.stats['pushed_since_start'] += count
         self.stats['last_batch_size'] = count
         self.stats.setdefault('batches_after_start', 0)
         self.stats['batches_after_start'] += 1
         self.stats['last_batch_generated'] = asctime()
+        self.batch_stats.add(count, time() - started)
+        if self.prefetch_time:
+            # batch is already sent, buffers are refilled for partitions becoming ready next
+            self.prefetch()
         return count
 
 
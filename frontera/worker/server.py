@@ -79,11 +79,14 @@ class StatusResource(JsonResource):
         JsonResource.__init__(self)
 
     def render_GET(self, txrequest):
-        return {
-            'is_finishing': self.worker.slot.is_finishing,
+        status = {
+            'is_finishing': getattr(self.worker.slot, 'is_finishing', False),
             'disable_new_batches': self.worker.slot.disable_new_batches,
             'stats': self.worker.stats
         }
+        if hasattr(self.worker, 'stage_stats'):
+            status['stages'] = self.worker.stage_stats()
+        return status
 
 
 class JsonRpcResource(JsonResource):
@@ -19,6 +19,10 @@ class BaseCrawlingStrategy(object):
     After exiting from all of these methods states from meta field are passed back and stored in the backend.
     """
 
+    #: If True, strategy worker scores links extracted in a batch with :meth:`links_extracted_batch`, instead of
+    #: calling :meth:`links_extracted` for every page.
+    batch_scoring = False
+
     def __init__(self, manager, mb_stream, states_context):
         self._mb_stream = mb_stream
         self._states_context = states_context
@@ -61,6 +65,23 @@ class BaseCrawlingStrategy(object):
         the links extracted for the crawled page.
         """
 
+    def links_extracted_batch(self, urls, depths, states, domains, inbound):
+        """
+        Optional vectorized alternative to :meth:`links_extracted`. If strategy sets :attr:`batch_scoring`, strategy
+        worker calls it once per batch of spider log with links extracted from all pages of the batch, as columns of
+        equal length. Links with score set are sent to scoring log in bulk, links scheduled for crawling get QUEUED
+        state. By default all links are skipped.
+
+        :param list urls: URLs of extracted links
+        :param list depths: crawl depths of links
+        :param list states: states of links
+        :param list domains: domain names of links, None if unknown
+        :param list inbound: counts of links to the URL in the batch, see :meth:`inbound_count`
+        :return: tuple of scores and schedule flags sequences (lists or NumPy arrays), score None or NaN means \
+        link is skipped
+        """
+        return [None] * len(urls), [False] * len(urls)
+
     @abstractmethod
     def page_error(self, request, error):
         """
@@ -96,6 +117,16 @@ class BaseCrawlingStrategy(object):
         """
         self._mb_stream.send(request, score, dont_queue)
 
+    def inbound_count(self, request):
+        """
+        Count of links to the request found in currently processed batch of spider log. Repeated links are passed to
+        :meth:`links_extracted` only once per batch, with the first page linking to them.
+
+        :param request: A :class:`Request <frontera.core.models.Request>` object.
+        :return: int, 0 if request wasn't linked in the batch
+        """
+        return self._states_context.inbound.get(request.meta[b'fingerprint'], 0)
+
     def create_request(self, url, method=b'GET', headers=None, cookies=None, meta=None, body=b''):
         """
         Creates request with specified fields, with state fetched from backend.
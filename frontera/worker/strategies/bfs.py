@@ -7,6 +7,8 @@ from frontera.worker.strategies import BaseCrawlingStrategy
 
 class CrawlingStrategy(BaseCrawlingStrategy):
 
+    batch_scoring = True
+
     def add_seeds(self, seeds):
         for seed in seeds:
             if seed.meta[b'state'] is States.NOT_CRAWLED:
@@ -22,6 +24,10 @@ class CrawlingStrategy(BaseCrawlingStrategy):
                 link.meta[b'state'] = States.QUEUED
                 self.schedule(link, self.get_score(link.url))
 
+    def links_extracted_batch(self, urls, depths, states, domains, inbound):
+        scores = [self.get_score(url) if state == States.NOT_CRAWLED else None for url, state in zip(urls, states)]
+        return scores, [score is not None for score in scores]
+
     def page_error(self, request, error):
         request.meta[b'state'] = States.ERROR
         self.schedule(request, score=0.0, dont_queue=True)
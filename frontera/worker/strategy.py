@@ -1,21 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from time import asctime
+from time import asctime, time
 import logging
 from traceback import format_stack, format_tb
 from signal import signal, SIGUSR1
 from logging.config import fileConfig
 from argparse import ArgumentParser
-from os.path import exists
-from frontera.utils.misc import load_object
+from os.path import exists, join
+from json import dumps
+import os
+from frontera.utils.misc import load_object, chunks
 
 from frontera.core.manager import FrontierManager
+from frontera.core.components import States
+from frontera.worker.checkpoint import write_states_checkpoint, load_states_checkpoint
 from frontera.logger.handlers import CONSOLE
 from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
 
 from frontera.settings import Settings
-from collections import Sequence
+from collections import Sequence, OrderedDict
 from binascii import hexlify
 import six
 
@@ -24,11 +28,16 @@ logger = logging.getLogger("strategy-worker")
 
 
 class UpdateScoreStream(object):
+    """
+    Buffers score updates until flush, keeping only the last update of every fingerprint, so at most one update per
+    fingerprint is sent for a batch of spider log. Updates are sent in messages of up to size updates.
+    """
     def __init__(self, encoder, scoring_log_producer, size):
         self._encoder = encoder
-        self._buffer = []
+        self._buffer = OrderedDict()
         self._producer = scoring_log_producer
         self._size = size
+        self.collapsed = 0
 
     def send(self, request, score=1.0, dont_queue=False):
         encoded = self._encoder.encode_update_score(
@@ -36,14 +45,29 @@ class UpdateScoreStream(object):
             score,
             not dont_queue
         )
-        self._buffer.append(encoded)
-        if len(self._buffer) > self._size:
-            self.flush()
+        self._put(request.meta[b'fingerprint'], encoded)
+
+    def send_many(self, requests, scores, schedule):
+        """
+        Encodes score updates of many requests at once. Requests with score None or NaN are skipped.
+        """
+        encode = self._encoder.encode_update_score
+        for request, score, queue in zip(requests, scores, schedule):
+            if score is None or score != score:
+                continue
+            self._put(request.meta[b'fingerprint'], encode(request, float(score), bool(queue)))
+
+    def _put(self, fingerprint, encoded):
+        if fingerprint in self._buffer:
+            self.collapsed += 1
+        self._buffer[fingerprint] = encoded
 
     def flush(self):
         if self._buffer:
-            self._producer.send(None, *self._buffer)
-            self._buffer = []
+            for chunk in chunks(list(self._buffer.values()), self._size):
+                self._producer.send(None, *chunk)
+            self._producer.flush()
+            self._buffer = OrderedDict()
 
 
 class StatesContext(object):
@@ -53,6 +77,9 @@ class StatesContext(object):
         self._states = states
         self._fingerprints = set()
         self._cache_flush_counter = 0
+        self.lookups = 0
+        self.hits = 0
+        self.inbound = {}
 
     def to_fetch(self, requests):
         if isinstance(requests, Sequence):
@@ -61,6 +88,10 @@ class StatesContext(object):
         self._fingerprints.add(requests.meta[b'fingerprint'])
 
     def fetch(self):
+        cache = self._states.cache
+        if cache is not None:
+            self.lookups += len(self._fingerprints)
+            self.hits += sum(1 for fingerprint in self._fingerprints if fingerprint in cache)
         self._states.fetch(self._fingerprints)
         self._fingerprints.clear()
 
@@ -72,6 +103,7 @@ class StatesContext(object):
     def release(self):
         self._states.update_cache(self._requests)
         self._requests = []
+        self.inbound = {}
 
         # Flushing states cache if needed
         if self._cache_flush_counter == 30:
@@ -108,6 +140,8 @@ class StrategyWorker(object):
 
         self.consumer_batch_size = settings.get('SPIDER_LOG_CONSUMER_BATCH_SIZE')
         self.strategy = strategy_class.from_worker(self._manager, self.update_score, self.states_context)
+        self.batch_scoring = self.strategy.batch_scoring
+        self._batch_links = []
         self.states = self._manager.backend.states
         self.stats = {
             'consumed_since_start': 0
@@ -115,8 +149,51 @@ class StrategyWorker(object):
         self.job_id = 0
         self.task = LoopingCall(self.work)
         self._logging_task = LoopingCall(self.log_status)
+        self._stats_task = None
+
+        checkpoint_dir = settings.get('STATE_CACHE_CHECKPOINT_DIR')
+        self.checkpoint_path = join(checkpoint_dir, 'states-%d.bin' % partition_id) if checkpoint_dir else None
+        self._hit_rate_log_batches = 0
+        if self.checkpoint_path:
+            self.load_checkpoint()
         logger.info("Strategy worker is initialized and consuming partition %d", partition_id)
 
+    def load_checkpoint(self):
+        cache = self.states.cache
+        if cache is None:
+            logger.warning("States component doesn't expose it's cache, checkpoints are disabled")
+            self.checkpoint_path = None
+            return
+        if not exists(self.checkpoint_path):
+            logger.info("State cache checkpoint %s not found, starting with empty cache", self.checkpoint_path)
+            return
+        started = time()
+        try:
+            count = load_states_checkpoint(self.checkpoint_path, cache)
+        except (IOError, OSError, ValueError) as exc:
+            logger.error("Failed to load state cache checkpoint %s: %s", self.checkpoint_path, exc)
+            return
+        finally:
+            # checkpoint is valid only till states change, it's written again on clean shutdown
+            self.remove_checkpoint()
+        logger.info("Loaded %d states from checkpoint %s in %.2fs", count, self.checkpoint_path, time() - started)
+        self._hit_rate_log_batches = 10
+
+    def write_checkpoint(self):
+        started = time()
+        try:
+            count = write_states_checkpoint(self.checkpoint_path, self.states.cache)
+        except (IOError, OSError) as exc:
+            logger.error("Failed to write state cache checkpoint %s: %s", self.checkpoint_path, exc)
+            return
+        logger.info("Written %d states to checkpoint %s in %.2fs", count, self.checkpoint_path, time() - started)
+
+    def remove_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_path)
+        except (IOError, OSError) as exc:
+            logger.error("Failed to remove state cache checkpoint %s: %s", self.checkpoint_path, exc)
+
     def collect_unknown_message(self, msg):
         logger.debug('Unknown message type %s', type)
 
@@ -128,7 +205,13 @@ class StrategyWorker(object):
         batch = []
         for m in self.consumer.get_messages(count=self.consumer_batch_size, timeout=1.0):
             try:
-                msg = self._decoder.decode(m)
+                msg = self._decoder.decode_lazy(m)
+                # spiders flow control and messages of other jobs are dropped before creating requests
+                if msg.type in ('offset', 'credits'):
+                    continue
+                if msg.type in ('page_crawled', 'links_extracted', 'request_error') and msg.job_id != self.job_id:
+                    continue
+                msg = msg.decode()
             except (KeyError, TypeError) as e:
                 logger.error("Decoding error:")
                 logger.exception(e)
@@ -155,8 +238,6 @@ class StrategyWorker(object):
                         _, request, error = msg
                         self.states_context.to_fetch(request)
                         continue
-                    if type == 'offset':
-                        continue
                     self.collect_unknown_message(msg)
                 except Exception as exc:
                     logger.exception(exc)
@@ -165,7 +246,32 @@ class StrategyWorker(object):
                 consumed += 1
         return (batch, consumed)
 
+    def collapse_links(self, batch):
+        """
+        Removes repeated links from links_extracted messages of the batch, so every fingerprint is passed to strategy
+        once, with the first page linking to it. Counts of links to every fingerprint are kept in states context.
+        """
+        inbound = self.states_context.inbound
+        collapsed = 0
+        for i, msg in enumerate(batch):
+            if msg[0] != 'links_extracted':
+                continue
+            _, request, links = msg
+            unique = []
+            for link in links:
+                fingerprint = link.meta[b'fingerprint']
+                if fingerprint in inbound:
+                    inbound[fingerprint] += 1
+                    collapsed += 1
+                    continue
+                inbound[fingerprint] = 1
+                unique.append(link)
+            if len(unique) != len(links):
+                batch[i] = (msg[0], request, unique)
+        return collapsed
+
     def process_batch(self, batch):
+        self.stats['last_links_collapsed'] = self.collapse_links(batch)
         for msg in batch:
             type = msg[0]
             try:
@@ -197,10 +303,20 @@ class StrategyWorker(object):
             except Exception as exc:
                 logger.exception(exc)
                 pass
+        if self._batch_links:
+            try:
+                self.score_batch_links()
+            except Exception as exc:
+                logger.exception(exc)
 
     def work(self):
         batch, consumed = self.collect_batch()
+        lookups, hits = self.states_context.lookups, self.states_context.hits
         self.states_context.fetch()
+        if self._hit_rate_log_batches and self.states_context.lookups > lookups:
+            self._hit_rate_log_batches -= 1
+            logger.info("State cache hit rate after restart %.1f%%",
+                        100.0 * (self.states_context.hits - hits) / (self.states_context.lookups - lookups))
         self.process_batch(batch)
         self.update_score.flush()
         self.states_context.release()
@@ -216,6 +332,9 @@ class StrategyWorker(object):
         self.stats['last_consumed'] = consumed
         self.stats['last_consumption_run'] = asctime()
         self.stats['consumed_since_start'] += consumed
+        self.stats['score_updates_collapsed'] = self.update_score.collapsed
+        if self.states_context.lookups:
+            self.stats['states_cache_hit_rate'] = float(self.states_context.hits) / self.states_context.lookups
 
     def run(self):
         def errback(failure):
@@ -230,6 +349,8 @@ class StrategyWorker(object):
 
         self.task.start(interval=0).addErrback(errback)
         self._logging_task.start(interval=30)
+        if self._stats_task:
+            self._stats_task.start(interval=5)
         signal(SIGUSR1, debug)
         reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
         reactor.run()
@@ -238,11 +359,30 @@ class StrategyWorker(object):
         for k, v in six.iteritems(self.stats):
             logger.info("%s=%s", k, v)
 
+    def report_stats_to(self, fd):
+        """
+        Makes worker write stats periodically to file descriptor as JSON lines, used by supervisor.
+        """
+        stream = os.fdopen(fd, 'w')
+
+        def report():
+            stream.write(dumps(self.stats) + '\n')
+            stream.flush()
+        self._stats_task = LoopingCall(report)
+
     def stop(self):
         logger.info("Closing crawling strategy.")
         self.strategy.close()
+        if self.checkpoint_path:
+            # flush clears the cache, checkpoint matches storage once states are flushed on manager stop
+            self.write_checkpoint()
         logger.info("Stopping frontier manager.")
-        self._manager.stop()
+        try:
+            self._manager.stop()
+        except Exception:
+            if self.checkpoint_path and exists(self.checkpoint_path):
+                self.remove_checkpoint()
+            raise
 
     def on_add_seeds(self, seeds):
         logger.debug('Adding %i seeds', len(seeds))
@@ -263,9 +403,34 @@ class StrategyWorker(object):
         for link in links:
             logger.debug("URL: %s", link.url)
         self.states.set_states(links)
+        if self.batch_scoring:
+            self._batch_links.extend(links)
+            return
         self.strategy.links_extracted(request, links)
         self.states.update_cache(links)
 
+    def score_batch_links(self):
+        """
+        Passes links extracted from all pages of the batch to strategy as columns and sends score updates in bulk.
+        """
+        links, self._batch_links = self._batch_links, []
+        inbound = self.states_context.inbound
+        urls, depths, states, domains, counts = [], [], [], [], []
+        for link in links:
+            meta = link.meta
+            urls.append(link.url)
+            depths.append(meta.get(b'depth', 0))
+            states.append(meta[b'state'])
+            domain = meta.get(b'domain')
+            domains.append(domain.get(b'name') if domain else None)
+            counts.append(inbound.get(meta[b'fingerprint'], 1))
+        scores, schedule = self.strategy.links_extracted_batch(urls, depths, states, domains, counts)
+        for link, score, queue in zip(links, scores, schedule):
+            if queue and score is not None and score == score:
+                link.meta[b'state'] = States.QUEUED
+        self.update_score.send_many(links, scores, schedule)
+        self.states.update_cache(links)
+
     def on_request_error(self, request, error):
         logger.debug("Page error %s (%s)", request.url, error)
         self.states.set_states(request)
@@ -283,6 +448,8 @@ def setup_environment():
                         help='Crawling strategy class path')
     parser.add_argument('--partition-id', type=int,
                         help="Instance partition id.")
+    parser.add_argument('--stats-fd', type=int,
+                        help="File descriptor to write stats to as JSON lines, used by supervisor.")
     args = parser.parse_args()
     settings = Settings(module=args.config)
     strategy_classpath = args.strategy if args.strategy else settings.get('CRAWLING_STRATEGY')
@@ -304,9 +471,11 @@ def setup_environment():
         logging.basicConfig(level=args.log_level)
         logger.setLevel(args.log_level)
         logger.addHandler(CONSOLE)
-    return settings, strategy_class
+    return settings, strategy_class, args.stats_fd
 
 if __name__ == '__main__':
-    settings, strategy_class = setup_environment()
+    settings, strategy_class, stats_fd = setup_environment()
     worker = StrategyWorker(settings, strategy_class)
+    if stats_fd is not None:
+        worker.report_stats_to(stats_fd)
     worker.run()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Supervisor running strategy workers for a set of spider log partitions on one host. Every worker is a separate
+process consuming one partition. Crashed workers are restarted, and their stats are combined in one JSON-RPC
+service.
+"""
+from __future__ import absolute_import
+from argparse import ArgumentParser
+from json import loads
+from logging.config import fileConfig
+from os.path import exists
+from time import time
+import logging
+import os
+import sys
+
+from twisted.internet import reactor, protocol, defer
+
+from frontera.logger.handlers import CONSOLE
+from frontera.settings import Settings
+from .server import JsonResource, JsonRpcService, RootResource
+
+logger = logging.getLogger("strategy-worker-supervisor")
+
+# file descriptor in worker processes, workers are writing stats to
+STATS_FD = 3
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Strategy worker process of one spider log partition, reading stats the worker writes as JSON lines.
+    """
+    def __init__(self, supervisor, partition_id):
+        self.supervisor = supervisor
+        self.partition_id = partition_id
+        self.started = time()
+        self.stats = {}
+        self.running = True
+        self._buffer = b''
+
+    def childDataReceived(self, childFD, data):
+        if childFD != STATS_FD:
+            return
+        self._buffer += data
+        while b'\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            try:
+                self.stats = loads(line.decode('utf-8'))
+            except ValueError:
+                logger.warning("Malformed stats from worker of partition %d", self.partition_id)
+
+    def processEnded(self, reason):
+        self.running = False
+        self.supervisor.worker_ended(self, reason.value.exitCode)
+
+    def signal(self, name):
+        if self.running:
+            self.transport.signalProcess(name)
+
+    @property
+    def pid(self):
+        return self.transport.pid if self.transport else None
+
+
+class StrategyWorkerSupervisor(object):
+    """
+    Starts worker process for every partition, and restarts workers exiting with error. Workers crashing soon after
+    start are restarted with growing delay, up to a minute.
+    """
+    def __init__(self, worker_args, partitions, reactor=reactor):
+        """
+        :param list worker_args: command line arguments of strategy worker, except partition id
+        :param list partitions: spider log partition ids to run workers for
+        """
+        self.worker_args = worker_args
+        self.partitions = partitions
+        self.reactor = reactor
+        self.workers = {}
+        self.restarts = dict((partition_id, 0) for partition_id in partitions)
+        self.restart_delays = dict((partition_id, 1.0) for partition_id in partitions)
+        self.stopping = False
+        self._stopped = None
+
+    def start(self):
+        for partition_id in self.partitions:
+            self.start_worker(partition_id)
+
+    def start_worker(self, partition_id):
+        worker = WorkerProcess(self, partition_id)
+        args = [sys.executable, '-m', 'frontera.worker.strategy', '--partition-id', str(partition_id),
+                '--stats-fd', str(STATS_FD)] + self.worker_args
+        self.reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                                  childFDs={0: 'w', 1: 1, 2: 2, STATS_FD: 'r'})
+        self.workers[partition_id] = worker
+        logger.info("Started strategy worker for partition %d, pid %s", partition_id, worker.pid)
+
+    def worker_ended(self, worker, exit_code):
+        partition_id = worker.partition_id
+        if self.stopping:
+            if not any(w.running for w in self.workers.values()) and self._stopped:
+                self._stopped.callback(None)
+            return
+        if exit_code == 0:
+            logger.info("Strategy worker for partition %d finished", partition_id)
+            return
+        if time() - worker.started > 60.0:
+            self.restart_delays[partition_id] = 1.0
+        delay = self.restart_delays[partition_id]
+        self.restart_delays[partition_id] = min(delay * 2, 60.0)
+        self.restarts[partition_id] += 1
+        logger.error("Strategy worker for partition %d exited with code %s, restarting in %.0fs", partition_id,
+                     exit_code, delay)
+        self.reactor.callLater(delay, self._restart, partition_id)
+
+    def _restart(self, partition_id):
+        if not self.stopping:
+            self.start_worker(partition_id)
+
+    def stop(self):
+        """
+        Stops all workers.
+
+        :return: Deferred fired when all workers exited
+        """
+        self.stopping = True
+        self._stopped = defer.Deferred()
+        running = [w for w in self.workers.values() if w.running]
+        if not running:
+            self._stopped.callback(None)
+        for worker in running:
+            worker.signal('TERM')
+        return self._stopped
+
+    def status(self):
+        workers = {}
+        consumed = 0
+        for partition_id, worker in sorted(self.workers.items()):
+            workers[str(partition_id)] = {
+                'pid': worker.pid,
+                'running': worker.running,
+                'restarts': self.restarts[partition_id],
+                'stats': worker.stats
+            }
+            consumed += worker.stats.get('consumed_since_start', 0)
+        return {
+            'workers': workers,
+            'running': sum(1 for w in self.workers.values() if w.running),
+            'consumed_since_start': consumed
+        }
+
+
+class SupervisorStatusResource(JsonResource):
+
+    ws_name = 'status'
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        JsonResource.__init__(self)
+
+    def render_GET(self, txrequest):
+        return self.supervisor.status()
+
+
+class SupervisorJsonRpcService(JsonRpcService):
+    def __init__(self, supervisor, settings):
+        root = RootResource()
+        root.putChild('status', SupervisorStatusResource(supervisor))
+        JsonRpcService.__init__(self, root, settings)
+
+
+def parse_partitions(value, count):
+    """
+    :param str value: comma separated partition ids, or ranges like 0-7
+    :param int count: count of spider log partitions
+    :return: list of partition ids
+    """
+    if not value:
+        return [i for i in range(count)]
+    partitions = []
+    for part in value.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            partitions.extend(range(int(first), int(last) + 1))
+        else:
+            partitions.append(int(part))
+    for partition_id in partitions:
+        if partition_id >= count or partition_id < 0:
+            raise ValueError("Partition id (%d) cannot be less than zero or more than SPIDER_LOG_PARTITIONS." %
+                             partition_id)
+    return sorted(set(partitions))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Frontera strategy workers supervisor.")
+    parser.add_argument('--config', type=str, required=True,
+                        help='Settings module name, should be accessible by import')
+    parser.add_argument('--log-level', '-L', type=str, default='INFO',
+                        help="Log level, for ex. DEBUG, INFO, WARN, ERROR, FATAL")
+    parser.add_argument('--strategy', type=str,
+                        help='Crawling strategy class path')
+    parser.add_argument('--partitions', type=str,
+                        help="Comma separated spider log partition ids or ranges, for ex. 0-15,32. Worker process is "
+                             "started for every partition. Default is all partitions.")
+    parser.add_argument('--port', type=int, help="Json Rpc service port to listen.")
+    args = parser.parse_args()
+
+    settings = Settings(module=args.config)
+    if args.port:
+        settings.set("JSONRPC_PORT", [args.port])
+    logging_config_path = settings.get("LOGGING_CONFIG")
+    if logging_config_path and exists(logging_config_path):
+        fileConfig(logging_config_path)
+    else:
+        logging.basicConfig(level=args.log_level)
+        logger.setLevel(args.log_level)
+        logger.addHandler(CONSOLE)
+
+    worker_args = ['--config', args.config, '--log-level', args.log_level]
+    if args.strategy:
+        worker_args += ['--strategy', args.strategy]
+    supervisor = StrategyWorkerSupervisor(worker_args,
+                                          parse_partitions(args.partitions, settings.get('SPIDER_LOG_PARTITIONS')))
+    server = SupervisorJsonRpcService(supervisor, settings)
+    server.start_listening()
+    reactor.callWhenRunning(supervisor.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    reactor.run()
@@ -59,7 +59,8 @@ setup(
             'tldextract>=1.5.1',
         ],
         'hbase': [
-            'happybase>=1.0.0'
+            'happybase>=1.0.0',
+            'cachetools'
         ],
         'zeromq': [
             'pyzmq',
@@ -68,6 +69,9 @@ setup(
         'kafka': [
             'kafka-python<=0.9.5'
         ],
+        'kafka-batch': [
+            'kafka-python>=1.4.4'
+        ],
         'distributed': [
             'Twisted'
         ]
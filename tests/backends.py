@@ -2,6 +2,7 @@ from __future__ import absolute_import
 import pytest
 
 from frontera import FrontierManager, Settings, FrontierTester
+from frontera.core.models import Request
 from frontera.utils import graphs
 from frontera.utils.tester import BaseDownloaderSimulator
 
@@ -57,6 +58,22 @@ TEST_SITES = {
 }
 
 
+class LinksExtractedManyTest(BackendTest):
+    """
+    A pytest base class for testing links from many pages applied at once.
+    """
+    def test_links_extracted_many(self):
+        backend = self.get_frontier().backend
+        page1 = Request('http://www.example.com/', meta={b'fingerprint': b'p1', b'depth': 0})
+        page2 = Request('http://www.example.com/2', meta={b'fingerprint': b'p2', b'depth': 1})
+        links = [Request('http://www.example.com/link%d' % i, meta={b'fingerprint': b'l%d' % i}) for i in range(3)]
+        backend.links_extracted_many([(page1, links[:2]), (page2, links[1:])])
+        assert [link.meta[b'depth'] for link in links] == [1, 1, 2]
+        assert sorted(r.url for r in backend.get_next_requests(10, partitions=[0])) == [l.url for l in links]
+        backend.links_extracted_many([(page2, links)])
+        assert backend.get_next_requests(10, partitions=[0]) == []
+
+
 class BackendSequenceTest(BackendTest):
     """
     A pytest base class for testing
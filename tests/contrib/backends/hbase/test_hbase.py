@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 from happybase import Connection
-from frontera.contrib.backends.hbase import HBaseState, HBaseMetadata, HBaseQueue
+from frontera.contrib.backends.hbase import HBaseState, HBaseMetadata, HBaseQueue, prepare_hbase_object, \
+    pack_timestamp, prepare_seed_object, prepare_link_object, prepare_crawled_object, prepare_error_object, \
+    prepare_state_object, prepare_score_object
 from frontera.core.models import Request, Response
 from frontera.core.components import States
+from frontera.utils.benchmark import _prepare_hbase_object_reference
 from binascii import unhexlify
 from time import sleep, time
 from w3lib.util import to_native_str
@@ -39,6 +42,17 @@ class TestHBaseBackend(object):
             set([r1.url, r2.url, r3.url])
         self.delete_rows(table, [b'10', b'11', b'12'])
 
+    def test_metadata_skips_known_links(self):
+        connection = Connection(host='hbase-docker', port=9090)
+        metadata = HBaseMetadata(connection, b'metadata', True, False, 300000, True, 100)
+        metadata.add_seeds([r1])
+        metadata.links_extracted(r1, [r1, r2, r3])
+        metadata.links_extracted(r1, [r2, r3])
+        assert metadata.stats == {'links_written': 2, 'links_skipped': 3}
+        metadata.frontier_stop()
+        table = connection.table('metadata')
+        self.delete_rows(table, [b'10', b'11', b'12'])
+
     def test_queue(self):
         connection = Connection(host='hbase-docker', port=9090)
         queue = HBaseQueue(connection, 2, b'queue', True)
@@ -50,6 +64,34 @@ class TestHBaseBackend(object):
         assert set([r.url for r in queue.get_next_requests(10, 1, min_requests=3, min_hosts=1,
                    max_requests_per_host=10)]) == set([r1.url, r2.url])
 
+    def test_queue_count_and_compaction(self):
+        connection = Connection(host='hbase-docker', port=9090)
+        queue = HBaseQueue(connection, 1, b'queue', True)
+        queue.schedule([('10', 0.5, r1, True)])
+        queue.schedule([('11', 0.5, r2, True)])
+        queue.schedule([('12', 0.5, r3, True)])
+        assert queue.count() == 3
+        assert queue.count_per_partition() == {0: 3}
+        assert queue.compact(0) == 2
+        assert queue.count() == 3
+        assert set([r.url for r in queue.get_next_requests(10, 0, min_requests=3, min_hosts=1,
+                   max_requests_per_host=10)]) == set([r1.url, r2.url, r3.url])
+        assert queue.count() == 0
+
+    def test_queue_compaction_row_limit(self):
+        connection = Connection(host='hbase-docker', port=9090)
+        queue = HBaseQueue(connection, 1, b'queue', True, compaction_interval=0.001)
+        queue.COMPACTION_MAX_ROW_ITEMS = 2
+        queue.schedule([('10', 0.5, r1, True)])
+        queue.schedule([('11', 0.5, r2, True)])
+        queue.schedule([('12', 0.5, r3, True)])
+        assert queue.compact(0) == 1
+        # compaction is also made by the consumer, before reading the partition
+        queue.schedule([('10', 0.5, r1, True)])
+        queue.schedule([('11', 0.5, r2, True)])
+        assert len(queue.get_next_requests(10, 0, min_requests=5, min_hosts=1, max_requests_per_host=10)) == 5
+        assert queue.count() == 0
+
     def test_queue_with_delay(self):
         connection = Connection(host='hbase-docker', port=9090)
         queue = HBaseQueue(connection, 1, b'queue', True)
@@ -87,3 +129,21 @@ class TestHBaseBackend(object):
         assert r4.meta[b'state'] == States.CRAWLED
         state.flush(True)
         assert state._state_cache == {}
+
+
+def test_row_encoders():
+    ts = 1466430981
+    packed_ts = pack_timestamp(ts)
+    url = 'http://www.example.com/some/page'
+    assert prepare_seed_object(url, b'81', packed_ts) == \
+        _prepare_hbase_object_reference(url=url, depth=0, created_at=ts, domain_fingerprint=b'81')
+    assert prepare_link_object(url, b'81', packed_ts) == \
+        _prepare_hbase_object_reference(url=url, created_at=ts, domain_fingerprint=b'81')
+    assert prepare_crawled_object(200, b'body') == _prepare_hbase_object_reference(status_code=200, content=b'body')
+    assert prepare_crawled_object(404) == _prepare_hbase_object_reference(status_code=404)
+    assert prepare_error_object(url, 'error', b'81', packed_ts) == \
+        _prepare_hbase_object_reference(url=url, created_at=ts, error='error', domain_fingerprint=b'81')
+    assert prepare_state_object(States.CRAWLED) == _prepare_hbase_object_reference(state=States.CRAWLED)
+    assert prepare_score_object(0.5) == _prepare_hbase_object_reference(score=0.5)
+    assert prepare_hbase_object(url=url, created_at=ts, domain_fingerprint=b'81') == \
+        _prepare_hbase_object_reference(url=url, created_at=ts, domain_fingerprint=b'81')
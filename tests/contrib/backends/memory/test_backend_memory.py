@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 from tests.test_overused_buffer import DFSOverusedBackendTest
 from tests import backends
+from frontera.core.models import Request
 
 
 class TestFIFO(backends.FIFOBackendTest):
@@ -23,9 +24,37 @@ class TestDFSOverusedSimulation(DFSOverusedBackendTest):
     backend_class = 'frontera.contrib.backends.memory.MemoryDFSOverusedBackend'
 
 
+class TestDFSOverusedOverflow(backends.BackendTest):
+    backend_class = 'frontera.contrib.backends.memory.MemoryDFSOverusedBackend'
+
+    def get_settings(self):
+        settings = super(TestDFSOverusedOverflow, self).get_settings()
+        settings.OVERUSED_MAX_PER_KEY = 5
+        return settings
+
+    def test_other_keys_progress(self):
+        backend = self.get_frontier().backend
+        hot = [Request('http://hot.com/%d' % i, meta={b'fingerprint': b'h%d' % i, b'depth': 1, b'id': i})
+               for i in range(20)]
+        other = [Request('http://other%d.com/' % i, meta={b'fingerprint': b'o%d' % i, b'depth': 0, b'id': 20 + i})
+                 for i in range(5)]
+        backend.queue.schedule([(r.meta[b'fingerprint'], 1.0, r, True) for r in hot + other])
+        requests = backend.get_next_requests(10, overused_keys=['hot.com'], key_type='domain', partitions=[0])
+        assert sorted(r.url for r in requests) == sorted(r.url for r in other)
+        # requests over the limit are put back to queue
+        assert backend.overused_buffer.get_stats()['pending'] == 5
+        assert backend.queue.count() == 15
+        requests = backend.get_next_requests(10, overused_keys=[], key_type='domain', partitions=[0])
+        assert len(requests) == 10 and all(r.url.startswith('http://hot.com/') for r in requests)
+
+
 class TestBFS(backends.BFSBackendTest):
     backend_class = 'frontera.contrib.backends.memory.BFS'
 
 
 class TestRANDOM(backends.RANDOMBackendTest):
     backend_class = 'frontera.contrib.backends.memory.RANDOM'
+
+
+class TestLinksExtractedMany(backends.LinksExtractedManyTest):
+    backend_class = 'frontera.contrib.backends.memory.FIFO'
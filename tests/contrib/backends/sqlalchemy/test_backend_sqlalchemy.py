@@ -63,6 +63,10 @@ class TestSQLiteMemoryRevisiting(SQLAlchemyRevisiting):
     pass
 
 
+class TestSQLiteMemoryLinksExtractedMany(backends.LinksExtractedManyTest, SQLiteMemory):
+    backend_class = 'frontera.contrib.backends.sqlalchemy.FIFO'
+
+
 #----------------------------------------------------
 # SQLite File
 #----------------------------------------------------
@@ -3,14 +3,18 @@
 from __future__ import absolute_import
 from frontera.contrib.backends.remote.codecs.json import Encoder as JsonEncoder, Decoder as JsonDecoder
 from frontera.contrib.backends.remote.codecs.msgpack import Encoder as MsgPackEncoder, Decoder as MsgPackDecoder
+from frontera.contrib.backends.remote.codecs.compact import Encoder as CompactEncoder, Decoder as CompactDecoder
+from frontera.core.codec import BaseEncoder
 from frontera.core.models import Request, Response
+from frontera.utils.fingerprint import sha1
 import pytest
 
 
 @pytest.mark.parametrize(
     ('encoder', 'decoder'), [
         (MsgPackEncoder, MsgPackDecoder),
-        (JsonEncoder, JsonDecoder)
+        (JsonEncoder, JsonDecoder),
+        (CompactEncoder, CompactDecoder)
     ]
 )
 def test_codec(encoder, decoder):
@@ -31,6 +35,7 @@ def test_codec(encoder, decoder):
         enc.encode_update_score(req, 0.51, True),
         enc.encode_new_job_id(1),
         enc.encode_offset(0, 28796),
+        enc.encode_credits(1, 28796, 64),
         enc.encode_request(req)
     ]
 
@@ -78,5 +83,138 @@ def test_codec(encoder, decoder):
     assert partition_id == 0
     assert offset == 28796
 
+    o_type, partition_id, offset, credits = dec.decode(next(it))
+    assert o_type == 'credits'
+    assert (partition_id, offset, credits) == (1, 28796, 64)
+
     o = dec.decode_request(next(it))
     check_request(o, req)
+
+
+def _links_extracted(hosts=5, links_per_host=20):
+    """
+    Builds request and links with meta like the one set by Scrapy converter, domain and fingerprint middlewares.
+    """
+    def make_request(url, host, depth):
+        domain = {
+            b'netloc': host,
+            b'name': host,
+            b'scheme': b'http',
+            b'sld': host.split(b'.')[1],
+            b'tld': b'com',
+            b'subdomain': b'www',
+            b'fingerprint': sha1(host)
+        }
+        return Request(url, meta={
+            b'fingerprint': sha1(url),
+            b'domain': domain,
+            b'scrapy_callback': None,
+            b'scrapy_errback': None,
+            b'origin_is_frontier': True,
+            b'scrapy_meta': {b'depth': depth, b'link_text': b'Read more', b'download_timeout': 180.0},
+            b'depth': depth,
+            b'jid': 1,
+            b'state': 0
+        })
+
+    request = make_request('http://www.example.com/', b'www.example.com', 1)
+    links = []
+    for h in range(hosts):
+        host = ('www.host%d.com' % h).encode('ascii')
+        for i in range(links_per_host):
+            links.append(make_request('http://%s/category/%d/item-%d.html' % (host.decode('ascii'), h, i), host, 2))
+    return request, links
+
+
+@pytest.mark.parametrize(
+    ('encoder', 'decoder'), [
+        (JsonEncoder, JsonDecoder),
+        (MsgPackEncoder, MsgPackDecoder),
+        (CompactEncoder, CompactDecoder)
+    ]
+)
+def test_codec_links_extracted(encoder, decoder):
+    enc = encoder(Request)
+    dec = decoder(Request, Response)
+    request, links = _links_extracted()
+    encoded = enc.encode_links_extracted(request, links)
+    _, request_d, links_d = dec.decode(encoded)
+    assert request_d.url == request.url and request_d.meta == request.meta
+    assert [(l.url, l.meta) for l in links_d] == [(l.url, l.meta) for l in links]
+
+
+def test_compact_codec_size():
+    request, links = _links_extracted()
+    compact = CompactEncoder(Request).encode_links_extracted(request, links)
+    msgpack = MsgPackEncoder(Request).encode_links_extracted(request, links)
+    assert len(compact) * 3 < len(msgpack)
+
+
+def test_codec_default_credits():
+    enc = MsgPackEncoder(Request)
+    dec = MsgPackDecoder(Request, Response)
+    assert dec.decode(BaseEncoder.encode_credits(enc, 1, 64, 32)) == ('offset', 1, 64)
+
+
+@pytest.mark.parametrize(
+    ('encoder', 'decoder'), [
+        (JsonEncoder, JsonDecoder),
+        (MsgPackEncoder, MsgPackDecoder),
+        (CompactEncoder, CompactDecoder)
+    ]
+)
+def test_codec_large_page(encoder, decoder):
+    enc = encoder(Request)
+    dec = decoder(Request, Response)
+    request, links = _links_extracted(hosts=100, links_per_host=100)
+    encoded = enc.encode_links_extracted(request, links)
+    _, request_d, links_d = dec.decode(encoded)
+    assert [(l.url, l.meta) for l in links_d] == [(l.url, l.meta) for l in links]
+
+
+@pytest.mark.parametrize(
+    ('encoder', 'decoder'), [
+        (JsonEncoder, JsonDecoder),
+        (MsgPackEncoder, MsgPackDecoder),
+        (CompactEncoder, CompactDecoder)
+    ]
+)
+def test_codec_decode_lazy(encoder, decoder):
+    enc = encoder(Request, send_body=True)
+    dec = decoder(Request, Response)
+    request, links = _links_extracted()
+    encoded = enc.encode_links_extracted(request, links)
+
+    msg = dec.decode_lazy(encoded)
+    assert (msg.type, msg.job_id, msg[0]) == ('links_extracted', 1, 'links_extracted')
+    o_type, request_d, links_d = msg
+    assert o_type == 'links_extracted'
+    assert request_d.url == request.url and len(links_d) == 100 and msg[2] is links_d
+
+    msg = dec.decode_lazy(enc.encode_page_crawled(Response(url=request.url, body=b"content", request=request)))
+    assert (msg.type, msg.job_id) == ('page_crawled', 1)
+    assert msg[1].url == request.url
+    msg = dec.decode_lazy(enc.encode_credits(1, 100, 64))
+    assert (msg.type, msg.job_id) == ('credits', None)
+    assert tuple(msg) == ('credits', 1, 100, 64)
+
+
+@pytest.mark.parametrize(
+    ('encoder', 'decoder'), [
+        (JsonEncoder, JsonDecoder),
+        (MsgPackEncoder, MsgPackDecoder),
+        (CompactEncoder, CompactDecoder)
+    ]
+)
+def test_codec_decode_buffer(encoder, decoder):
+    enc = encoder(Request)
+    dec = decoder(Request, Response)
+    request, links = _links_extracted()
+    if not decoder.supports_buffers:
+        with pytest.raises(TypeError):
+            dec.decode(memoryview(enc.encode_request(request)))
+        return
+    _, request_d, links_d = dec.decode(memoryview(enc.encode_links_extracted(request, links)))
+    assert request_d.meta == request.meta
+    assert [(l.url, l.meta) for l in links_d] == [(l.url, l.meta) for l in links]
+    assert dec.decode_request(memoryview(enc.encode_request(request))).url == request.url
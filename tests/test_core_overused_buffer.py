@@ -1,5 +1,6 @@
 from __future__ import absolute_import
-from frontera.core import OverusedBuffer
+from frontera.core import OverusedBuffer, SlotKeyResolver
+import frontera.core
 from frontera.core.models import Request
 from six.moves import range
 
@@ -39,21 +40,105 @@ class TestOverusedBuffer(object):
         assert ob.get_next_requests(10, overused_keys=['www.example.com'],
                                     key_type='domain') == [r6]
         assert set(self.logs) == set(["Overused keys: ['www.example.com']",
-                                     "Pending: 4"])
+                                     "Pending: 4",
+                                     "Pending per key: www.example.com=3, example1.com=1"])
         self.logs = []
 
         assert ob.get_next_requests(10, overused_keys=['www.example.com'],
                                     key_type='domain') == []
         assert set(self.logs) == set(["Overused keys: ['www.example.com']",
-                                      "Pending: 3"])
+                                      "Pending: 3",
+                                      "Pending per key: www.example.com=3"])
         self.logs = []
 
         #the max_next_requests is 3 here to cover the "len(requests) == max_next_requests" case.
         assert set(ob.get_next_requests(3, overused_keys=['example.com'],
                                         key_type='domain')) == set([r1, r2, r3])
         assert set(self.logs) == set(["Overused keys: ['example.com']",
-                                      "Pending: 3"])
+                                      "Pending: 3",
+                                      "Pending per key: www.example.com=3"])
         self.logs = []
 
         assert ob.get_next_requests(10, overused_keys=[], key_type='domain') == []
         assert set(self.logs) == set(["Overused keys: []", "Pending: 0"])
+
+    def test_ip_keys_resolved_asynchronously(self, monkeypatch):
+        addresses = {'www.example.com': '10.0.0.1', 'example.com': '10.0.0.1', 'example1.com': '10.0.0.2'}
+        monkeypatch.setattr(frontera.core, 'getaddrinfo',
+                            lambda host, port: [(2, 1, 6, '', (addresses[host], port))])
+        resolver = SlotKeyResolver(threads=2)
+        ob = OverusedBuffer(self.get_func, resolver=resolver)
+        self.requests = [r1, r4, r6]
+        # keys aren't known yet, requests are kept until resolved
+        assert ob.get_next_requests(10, overused_keys=['10.0.0.1'], key_type='ip') == []
+        resolver.join()
+        assert ob.get_next_requests(10, overused_keys=['10.0.0.1'], key_type='ip') == [r6]
+        assert set(ob.get_next_requests(10, overused_keys=[], key_type='ip')) == set([r1, r4])
+        stats = resolver.get_stats()
+        assert stats['resolved'] == 3 and stats['failed'] == 0 and stats['hit_rate'] == 0.5
+
+    def test_round_robin(self):
+        ob = OverusedBuffer(self.get_func)
+        self.requests = [r6, r5, r4, r3, r2, r1]
+        assert ob.get_next_requests(10, overused_keys=['www.example.com', 'example.com', 'example1.com'],
+                                    key_type='domain') == []
+        assert ob.get_next_requests(4, overused_keys=['example1.com'], key_type='domain') == [r1, r4, r2, r5]
+        # skipped key keeps it's position in the ring
+        assert ob.get_next_requests(4, overused_keys=[], key_type='domain') == [r6, r3]
+        assert ob.get_stats()['pending'] == 0
+
+    def test_limits(self):
+        overflowed = []
+        ob = OverusedBuffer(self.get_func, max_per_key=2, max_pending=3, overflow_func=overflowed.extend)
+        self.requests = [r6, r5, r4, r3, r2, r1]
+        assert ob.get_next_requests(10, overused_keys=['www.example.com', 'example.com', 'example1.com'],
+                                    key_type='domain') == []
+        assert overflowed == [r3, r5, r6]
+        stats = ob.get_stats()
+        assert stats['pending'] == 3 and stats['overflowed'] == 3
+        assert stats['pending_per_key'] == {'www.example.com': 2, 'example.com': 1}
+
+        # without overflow function requests are returned even if overused
+        ob = OverusedBuffer(self.get_func, max_per_key=1)
+        self.requests = [r3, r2, r1]
+        assert ob.get_next_requests(10, overused_keys=['www.example.com'], key_type='domain') == [r2, r3]
+
+    def test_unresolved_limits(self):
+        class Unresolving(object):
+            def get_many(self, hostnames):
+                return {}
+
+        overflowed = []
+        ob = OverusedBuffer(self.get_func, resolver=Unresolving(), max_pending=3, overflow_func=overflowed.extend)
+        self.requests = [r6, r5, r4, r3, r2, r1]
+        assert ob.get_next_requests(2, overused_keys=[], key_type='ip') == []
+        # unresolved requests are covering the demand, nothing is taken from backend
+        assert ob.get_next_requests(2, overused_keys=[], key_type='ip') == []
+        assert len(self.requests) == 4
+        assert ob.get_next_requests(5, overused_keys=[], key_type='ip') == []
+        assert ob.get_stats()['unresolved'] == 3 and overflowed == [r4, r5]
+
+
+def test_slot_key_resolver_expiration(monkeypatch):
+    monkeypatch.setattr(frontera.core, 'getaddrinfo', lambda host, port: [(2, 1, 6, '', ('10.0.0.1', port))])
+    resolver = SlotKeyResolver(ttl=0.0, threads=1, max_size=2)
+    assert resolver.get_many(['a.com', 'b.com']) == {}
+    resolver.join()
+    # expired addresses are returned while refreshed
+    assert resolver.get_many(['a.com']) == {'a.com': '10.0.0.1'}
+    resolver.join()
+    resolver.get_many(['c.com'])
+    resolver.join()
+    assert resolver.get_stats()['cached'] <= 2
+
+
+def test_slot_key_resolver_eviction():
+    resolver = SlotKeyResolver(max_size=10)
+    resolver._cache = dict(('%d.com' % i, ('10.0.0.1', 1000.0 + i)) for i in range(9))
+    resolver._cache['expired.com'] = ('10.0.0.1', 1.0)
+    resolver._evict(100.0)
+    assert sorted(resolver._cache) == ['%d.com' % i for i in range(9)]
+    # the oldest hostnames are evicted when nothing is expired
+    resolver._cache['9.com'] = ('10.0.0.1', 1009.0)
+    resolver._evict(100.0)
+    assert sorted(resolver._cache) == ['%d.com' % i for i in range(1, 10)]
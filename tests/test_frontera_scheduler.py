@@ -7,6 +7,8 @@ from frontera.core.models import Response as FResponse
 from scrapy.http import Request, Response
 from scrapy.spiders import Spider
 from scrapy.settings import Settings
+from twisted.internet import threads
+from twisted.internet.defer import Deferred
 from six.moves import range
 
 
@@ -110,6 +112,51 @@ class TestFronteraScheduler(object):
         assert set(fs.frontier.manager.get_next_requests_kwargs[0]['overused_keys']) == set(['2.1.3', '4.1.3'])
         assert fs.stats_manager.stats.get_value('frontera/returned_requests_count') == 1
 
+    def test_next_request_async_fetch(self, monkeypatch):
+        fetches = []
+
+        def defer_to_thread(f, **kwargs):
+            fetches.append((f, kwargs))
+            return Deferred()
+
+        monkeypatch.setattr(threads, 'deferToThread', defer_to_thread)
+        settings = Settings()
+        settings['ASYNC_FETCH'] = True
+        crawler = FakeCrawler(settings)
+        fs = FronteraScheduler(crawler, manager=FakeFrontierManager)
+        fs.open(Spider)
+        fs.frontier.manager.put_requests([fr1, fr2, fr3])
+        # engine isn't blocked, and only one fetch is in progress at once
+        assert fs.next_request() is None
+        assert fs.next_request() is None
+        assert len(fetches) == 1 and fs.frontier.manager.get_next_requests_kwargs == []
+
+        f, kwargs = fetches[0]
+        fs._fetching.callback(f(**kwargs))
+        request = fs.next_request()
+        assert request.url == fr3.url
+        assert len(fetches) == 2
+        fs._fetching.callback([])
+        requests = [fs.next_request() for _ in range(3)]
+        assert set([r.url for r in requests[:2]]) == set([fr1.url, fr2.url]) and requests[2] is None
+        # backend is empty, next fetch is delayed
+        assert len(fetches) == 2
+        assert fs.stats_manager.stats.get_value('frontera/returned_requests_count') == 3
+        assert fs.stats_manager.stats.get_value('frontera/fetch_blocking_time') == 0.0
+
+    def test_next_request_async_fetch_failed(self, monkeypatch):
+        monkeypatch.setattr(threads, 'deferToThread', lambda f, **kwargs: Deferred())
+        settings = Settings()
+        settings['ASYNC_FETCH'] = True
+        crawler = FakeCrawler(settings)
+        fs = FronteraScheduler(crawler, manager=FakeFrontierManager)
+        fs.open(Spider)
+        assert fs.next_request() is None
+        fs._fetching.errback(ValueError('backend is down'))
+        assert fs._fetching is None
+        assert fs.next_request() is None
+        assert fs._fetching is None
+
     def test_process_spider_output(self):
         i1 = {'name': 'item', 'item': 'i1'}
         i2 = {'name': 'item', 'item': 'i2'}
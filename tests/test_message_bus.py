@@ -2,13 +2,23 @@
 from __future__ import absolute_import
 from frontera.settings import Settings
 from frontera.contrib.messagebus.zeromq import MessageBus as ZeroMQMessageBus
+from frontera.contrib.messagebus.zeromq.broker import ProxyServer
 from frontera.contrib.messagebus.kafkabus import MessageBus as KafkaMessageBus
+from frontera.contrib.messagebus.local import MessageBus as LocalMessageBus
+from frontera.contrib.messagebus.kafkabatchbus import MessageBus as KafkaBatchMessageBus
 from frontera.utils.fingerprint import sha1
 from kafka import KafkaClient
 from random import randint
 from time import sleep
+from struct import pack, unpack
+from threading import Thread
 from six.moves import range
 import logging
+import pytest
+import six
+import sys
+import tempfile
+import zmq
 from w3lib.util import to_bytes
 
 
@@ -107,6 +117,167 @@ def test_zmq_message_bus():
     assert tester.spider_feed_activity() == 128
 
 
+def _local_settings(shared_memory):
+    settings = Settings()
+    settings.set('LOCAL_BUS_SHARED_MEMORY', shared_memory)
+    settings.set('LOCAL_BUS_DIR', tempfile.mkdtemp())
+    settings.set('LOCAL_BUS_NAME', 'test-%d' % randint(0, 1000000))
+    return settings
+
+
+def test_local_message_bus():
+    for shared_memory in [False, True]:
+        tester = MessageBusTester(LocalMessageBus, _local_settings(shared_memory))
+        tester.spider_log_activity(64)
+        assert tester.sw_activity() == 64
+        assert tester.db_activity(128) == (64, 32)
+        assert tester.spider_feed_activity() == 128
+        assert tester.db_sf_p.get_offset(0) == tester.sp_sf_c.get_offset() == 128
+
+
+def test_local_shared_memory_wraps_and_drops_overwritten():
+    settings = _local_settings(True)
+    settings.set('LOCAL_BUS_BUFFER_SIZE', 1024)
+    scoring_log = LocalMessageBus(settings).scoring_log()
+    consumer = scoring_log.consumer()
+    producer = scoring_log.producer()
+    for i in range(10):
+        producer.send(None, to_bytes("message %d" % i) * 5)
+    assert [m[:9] for m in consumer.get_messages(count=20)] == [to_bytes("message %d" % i) for i in range(10)]
+    for i in range(100):
+        producer.send(None, to_bytes("message %d" % i) * 5)
+    messages = list(consumer.get_messages(count=200))
+    assert 0 < len(messages) < 100
+    assert messages[-1] == b"message 99" * 5
+    assert consumer.get_offset() == producer.get_offset(0) == 110
+
+
+def test_local_shared_memory_threads():
+    scoring_log = LocalMessageBus(_local_settings(True)).scoring_log()
+    consumer = scoring_log.consumer()
+
+    def produce(i):
+        producer = scoring_log.producer()
+        for j in range(0, 2000, 100):
+            producer.send(None, *[to_bytes("message %d-%d" % (i, k)) * 20 for k in range(j, j + 100)])
+
+    threads = [Thread(target=produce, args=(i,)) for i in range(4)]
+    # switching threads as often as possible, to make writes interleave without locking
+    if six.PY3:
+        get_interval, set_interval, shortest = sys.getswitchinterval, sys.setswitchinterval, 1e-6
+    else:
+        get_interval, set_interval, shortest = sys.getcheckinterval, sys.setcheckinterval, 1
+    interval = get_interval()
+    set_interval(shortest)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        set_interval(interval)
+    messages = list(consumer.get_messages(count=10000))
+    assert sorted(messages) == sorted(to_bytes("message %d-%d" % (i, j)) * 20 for i in range(4) for j in range(2000))
+
+
+def test_zmq_consumer_poller():
+    for zero_copy in [False, True]:
+        settings = Settings()
+        settings.set('ZMQ_ZERO_COPY', zero_copy)
+        spider_feed = ZeroMQMessageBus(settings).spider_feed()
+        consumer = spider_feed.consumer(0)
+        producer = spider_feed.producer()
+        sleep(0.3)
+
+        def produce():
+            for i in range(10):
+                producer.send(sha1('key'), pack('>I', i))
+                sleep(0.01)
+
+        thread = Thread(target=produce)
+        thread.start()
+        # consumer waits for messages arriving with gaps until count is reached
+        messages = [bytes(m) for m in consumer.get_messages(timeout=5.0, count=10)]
+        thread.join()
+        assert [unpack('>I', m)[0] for m in messages] == list(range(10))
+        assert list(consumer.get_messages(timeout=0.1, count=1)) == []
+
+
+def test_zmq_consumer_offset():
+    for batch_size in [0, 1024]:
+        settings = Settings()
+        settings.set('SPIDER_FEED_PARTITIONS', 1)
+        settings.set('ZMQ_BATCH_SIZE', batch_size)
+        spider_feed = ZeroMQMessageBus(settings).spider_feed()
+        consumer = spider_feed.consumer(0)
+        producer = spider_feed.producer()
+        sleep(0.3)
+        for i in range(10):
+            producer.send(sha1('newhost'), b'http://newhost/' + to_bytes(str(i)))
+        producer.flush()
+        # offset is advanced only by messages already returned
+        assert len(list(consumer.get_messages(timeout=1.0, count=3))) == 3
+        assert consumer.get_offset() == producer.get_offset(0) - 7
+        assert len(list(consumer.get_messages(timeout=1.0, count=10))) == 7
+        assert consumer.get_offset() == producer.get_offset(0)
+
+
+def test_zmq_zero_copy_codec():
+    settings = Settings()
+    settings.set('ZMQ_ZERO_COPY', True)
+    settings.set('MESSAGE_BUS_CODEC', 'frontera.contrib.backends.remote.codecs.json')
+    with pytest.raises(ValueError):
+        ZeroMQMessageBus(settings)
+    settings.set('MESSAGE_BUS_CODEC', 'frontera.contrib.backends.remote.codecs.msgpack')
+    assert ZeroMQMessageBus(settings).zero_copy
+
+
+def test_zmq_message_bus_batching():
+    for compression in [None, 'zlib']:
+        settings = Settings()
+        settings.set('ZMQ_BATCH_SIZE', 1024)
+        settings.set('ZMQ_BATCH_COMPRESSION', compression)
+        spider_log = ZeroMQMessageBus(settings).spider_log()
+        consumer = spider_log.consumer(partition_id=None, type=b'db')
+        producer = spider_log.producer()
+        sleep(0.3)
+        for i in range(100):
+            producer.send(sha1(str(i % 8)), pack('>I', i) * 20)
+        producer.flush()
+        messages = []
+        for _ in range(10):
+            messages.extend(bytes(m) for m in consumer.get_messages(timeout=0.5, count=100))
+            if len(messages) >= 100:
+                break
+        assert sorted(unpack('>I', m[:4])[0] for m in messages) == list(range(100))
+        assert all(m == m[:4] * 20 for m in messages)
+
+
+def test_zmq_native_proxy_broker():
+    for _ in range(10):
+        port = randint(20000, 60000)
+        try:
+            server = ProxyServer('127.0.0.1', port)
+        except zmq.ZMQError:
+            continue
+        break
+    for thread in server.threads:
+        thread.start()
+    try:
+        settings = Settings()
+        settings.set('ZMQ_BASE_PORT', port)
+        # spider feed send HWM is derived from batch size, 128 messages have to fit in it
+        settings.set('MAX_NEXT_REQUESTS', 256)
+        tester = MessageBusTester(ZeroMQMessageBus, settings)
+        tester.spider_log_activity(64)
+        assert tester.sw_activity() == 64
+        assert tester.db_activity(128) == (64, 32)
+        assert tester.spider_feed_activity() == 128
+        assert server.get_statistics('spider_log')['frontend_msgs_in'] == 64 * 3
+    finally:
+        server.stop()
+
+
 def test_kafka_message_bus_integration():
     kafka_location = "127.0.0.1:9092"
     client = KafkaClient(kafka_location)
@@ -126,3 +297,20 @@ def test_kafka_message_bus_integration():
     assert tester.sw_activity() == 64
     assert tester.db_activity(128) == (64, 32)
     assert tester.spider_feed_activity() == 128
+
+
+def test_kafka_batch_message_bus_integration():
+    """
+    Requires Kafka broker with topics auto creation enabled, e.g. one from tests/kafka/docker-compose.yml
+    """
+    settings = Settings()
+    settings.set('KAFKA_LOCATION', "127.0.0.1:9092")
+    settings.set('FRONTIER_GROUP', 'frontier3')
+    settings.set('SPIDER_FEED_GROUP', 'spiders3')
+    settings.set('SCORING_TOPIC', "frontier-score")
+    settings.set('KAFKA_BATCH_COMPRESSION', 'gzip')
+    tester = MessageBusTester(KafkaBatchMessageBus, settings)
+    tester.spider_log_activity(64)
+    assert tester.sw_activity() == 64
+    assert tester.db_activity(128) == (64, 32)
+    assert tester.spider_feed_activity() == 128
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import unittest
+from threading import Thread
 
 from frontera.contrib.backends.remote.messagebus import MessageBusBackend
 from frontera.settings import Settings
@@ -71,12 +72,27 @@ class TestMessageBusBackend(unittest.TestCase):
         mbb.consumer.put_messages(encoded_requests)
         mbb.consumer._set_offset(0)
         requests = set(mbb.get_next_requests(10, overused_keys=[], key_type='domain'))
-        _, partition_id, offset = mbb._decoder.decode(mbb.spider_log_producer.messages[0])
-        self.assertEqual((partition_id, offset), (0, 0))
+        _, partition_id, offset, credits = mbb._decoder.decode(mbb.spider_log_producer.messages[0])
+        self.assertEqual((partition_id, offset, credits), (0, 0, 7))
         self.assertEqual(set([r.url for r in requests]), set([r1.url, r2.url, r3.url]))
         requests = set(mbb.get_next_requests(10, overused_keys=[], key_type='domain'))
         self.assertEqual([r.url for r in requests], [])
+        _, partition_id, offset, credits = mbb._decoder.decode(mbb.spider_log_producer.messages[1])
+        self.assertEqual((partition_id, offset, credits), (0, 0, 10))
         # test overused keys
         mbb.consumer.put_messages(encoded_requests)
         requests = set(mbb.get_next_requests(10, overused_keys=['www.example.com'], key_type='domain'))
         self.assertEqual(set([r.url for r in requests]), set([r2.url, r3.url]))
+
+    def test_send_credits_from_thread(self):
+        mbb = self.mbb_setup()
+        mbb.CREDITS_RESEND_INTERVAL = 0.0
+        resp = Response(r1.url, body='body', request=r1)
+        credits = Thread(target=lambda: [mbb._send_credits(offset, 10) for offset in range(500)])
+        credits.start()
+        for _ in range(500):
+            mbb.page_crawled(resp)
+        credits.join()
+        messages = [mbb._decoder.decode(m) for m in mbb.spider_log_producer.messages]
+        self.assertEqual([m[2] for m in messages if m[0] == 'credits'], list(range(500)))
+        self.assertTrue(all(m[1].url == r1.url for m in messages if m[0] == 'page_crawled'))
@@ -41,6 +41,17 @@ class TestCallLaterOnce(object):
         reactor.advance(2)
         assert self.called == 1
 
+    def test_call_later_moved_earlier(self):
+        self.called = 0
+        reactor = Clock()
+        call = CallLaterOnce(self.call_function, reactor=reactor)
+        call.schedule(delay=30)
+        call.schedule(delay=1)
+        reactor.advance(1)
+        assert self.called == 1
+        reactor.advance(30)
+        assert self.called == 1
+
     def test_call_later_cancel(self):
         self.called = 0
         reactor = Clock()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from frontera.contrib.messagebus.local import MessageBus as LocalMessageBus
+from frontera.settings import Settings
+from frontera.utils.benchmark import TrafficGenerator, benchmark_codec, benchmark_bus, CODECS
+import json
+import pytest
+
+
+@pytest.fixture(scope='module')
+def events():
+    return TrafficGenerator(hosts=10, links_per_page=20).events(pages=3)
+
+
+def test_traffic_generator(events):
+    streams = set(stream for stream, _, _, _ in events)
+    assert streams == {'spider-log', 'scoring-log', 'spider-feed'}
+    assert TrafficGenerator().events(pages=2)[2][3][0].url == TrafficGenerator().events(pages=2)[2][3][0].url
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_benchmark_codec(codec, events):
+    results = benchmark_codec(codec, events, repeat=1)
+    assert set(r['event'] for r in results) == {'add_seeds', 'page_crawled', 'links_extracted', 'request_error',
+                                                'update_score', 'request'}
+    for result in results:
+        assert result['bytes_per_event'] > 0 and result['encode_us'] > 0 and result['decode_us'] > 0
+        json.dumps(result)
+
+
+def test_benchmark_bus(events):
+    settings = Settings()
+    settings.set('LOCAL_BUS_SHARED_MEMORY', False)
+    settings.set('LOCAL_BUS_NAME', 'test-benchmark')
+    result = benchmark_bus(LocalMessageBus(settings), events, messages=500)
+    assert result['received'] == 500
+    assert result['latency_p50_ms'] <= result['latency_p99_ms']
+    assert result['messages_per_sec'] > 0
+    json.dumps(result)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from frontera.worker.checkpoint import write_states_checkpoint, load_states_checkpoint
+from frontera.utils.fingerprint import sha1
+import pytest
+
+
+def test_checkpoint_roundtrip(tmpdir):
+    path = str(tmpdir.join('states.bin'))
+    cache = dict((sha1(str(i)), i % 4) for i in range(1000))
+    cache[b'not-a-sha1'] = 1
+    assert write_states_checkpoint(path, cache, chunk_size=64) == 1000
+    loaded = {}
+    assert load_states_checkpoint(path, loaded) == 1000
+    del cache[b'not-a-sha1']
+    assert loaded == cache
+
+
+def test_checkpoint_invalid(tmpdir):
+    path = tmpdir.join('states.bin')
+    path.write(b'garbage', mode='wb')
+    with pytest.raises(ValueError):
+        load_states_checkpoint(str(path), {})
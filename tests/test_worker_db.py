@@ -2,6 +2,10 @@ from frontera.core.models import Request, Response
 from frontera.worker.db import DBWorker
 from frontera.settings import Settings
 from frontera.core.components import States
+from frontera.utils.fingerprint import sha1
+from twisted.internet import reactor
+from threading import Thread
+from time import sleep
 
 
 r1 = Request('http://www.example.com/', meta={b'fingerprint': b'1', b'state': States.DEFAULT, b'jid': 0})
@@ -11,8 +15,10 @@ r3 = Request('https://www.dmoz.org', meta={b'fingerprint': b'3', b'state': State
 
 class TestDBWorker(object):
 
-    def dbw_setup(self, distributed=False):
+    def dbw_setup(self, distributed=False, threads=0, prefetch_time=0.0):
         settings = Settings()
+        settings.DB_WORKER_THREADS = threads
+        settings.DB_WORKER_PREFETCH_TIME = prefetch_time
         settings.MAX_NEXT_REQUESTS = 64
         settings.MESSAGE_BUS = 'tests.mocks.message_bus.FakeMessageBus'
         if distributed:
@@ -43,6 +49,46 @@ class TestDBWorker(object):
         dbw.consume_incoming()
         assert set([r.url for r in dbw._backend.links]) == set([r2.url, r3.url])
 
+    def test_links_extracted_batched(self):
+        dbw = self.dbw_setup()
+        calls = []
+        dbw._backend.links_extracted_many = calls.append
+        dbw.spider_log_consumer.put_messages([dbw._encoder.encode_links_extracted(r1, [r3]),
+                                              dbw._encoder.encode_links_extracted(r1, [r2, r3])])
+        assert dbw.consume_incoming() == 2
+        assert len(calls) == 1
+        assert [[l.url for l in links] for _, links in calls[0]] == [[r2.url, r3.url], [r3.url]]
+
+    def test_links_extracted_order(self):
+        dbw = self.dbw_setup(threads=1)
+        calls = []
+        dbw._backend.links_extracted_many = lambda batch: calls.append(('links', [r.url for r, _ in batch]))
+        dbw._backend.page_crawled = lambda response: calls.append(('page', response.url))
+        example = {b'fingerprint': sha1(b'www.example.com')}
+        r4 = Request('http://www.example.com/other', meta={b'fingerprint': b'4', b'jid': 0, b'domain': example})
+        r5 = Request('http://www.scrapy.org/other', meta={b'fingerprint': b'5', b'jid': 0,
+                                                          b'domain': {b'fingerprint': sha1(b'www.scrapy.org')}})
+        r1.meta[b'domain'] = example
+        dbw.spider_log_consumer.put_messages([dbw._encoder.encode_links_extracted(r1, [r4]),
+                                              dbw._encoder.encode_page_crawled(Response(r5.url, request=r5)),
+                                              dbw._encoder.encode_page_crawled(Response(r4.url, request=r4)),
+                                              dbw._encoder.encode_links_extracted(r5, [r2])][::-1])
+        assert dbw.consume_incoming() == 4
+        dbw.apply_stage.join()
+        del r1.meta[b'domain']
+        # page of other host doesn't break the group, page of the same host is applied after links of it's host
+        assert calls == [('page', r5.url), ('links', [r1.url]), ('page', r4.url), ('links', [r5.url])]
+        dbw.stop()
+
+    def test_other_job_messages_dropped(self):
+        dbw = self.dbw_setup()
+        r4 = Request('http://www.example.com/other', meta={b'fingerprint': b'4', b'state': States.DEFAULT, b'jid': 1})
+        msg1 = dbw._encoder.encode_links_extracted(r4, [r2, r3])
+        msg2 = dbw._encoder.encode_page_crawled(Response(r4.url, request=r4))
+        dbw.spider_log_consumer.put_messages([msg1, msg2])
+        assert dbw.consume_incoming() == 2
+        assert dbw._backend.links == [] and dbw._backend.responses == []
+
     def test_request_error(self):
         dbw = self.dbw_setup()
         msg = dbw._encoder.encode_request_error(r1, 'error')
@@ -87,3 +133,141 @@ class TestDBWorker(object):
         dbw._backend.queue.put_requests([r1, r2, r3])
         assert dbw.new_batch() == 3
         assert 3 in dbw._backend.partitions
+
+    def test_credits(self):
+        dbw = self.dbw_setup(True)
+        dbw.spider_feed_producer.offset = 100
+        msg1 = dbw._encoder.encode_credits(0, 98, 10)
+        msg2 = dbw._encoder.encode_credits(1, 100, 0)
+        dbw.spider_log_consumer.put_messages([msg1, msg2])
+        dbw.consume_incoming()
+        assert dbw.credits == {0: 8, 1: 0}
+        assert 0 in dbw.spider_feed.available_partitions()
+        assert 1 not in dbw.spider_feed.available_partitions()
+        dbw._backend.queue.put_requests([r1, r2, r3])
+        assert dbw.new_batch() == 3
+        assert dbw.credits[0] == 5
+        dbw._backend.queue.put_requests([r1, r2, r3] * 3)
+        assert dbw.new_batch() == 5
+        assert dbw.credits[0] == 0
+        assert 0 not in dbw.spider_feed.available_partitions()
+
+    def test_new_batch_on_ready_partition(self):
+        dbw = self.dbw_setup(True)
+        dbw.enable_new_batches()
+        dbw.spider_feed.ready_partitions.clear()
+        dbw.spider_feed_producer.offset = 100
+        dbw.spider_log_consumer.put_messages([dbw._encoder.encode_offset(2, 90)])
+        dbw.consume_incoming()
+        assert 2 in dbw.ready_since
+        assert dbw.slot.new_batch._call.getTime() - reactor.seconds() < 1.0
+        dbw._backend.queue.put_requests([r1, r2, r3])
+        assert dbw.new_batch() == 3
+        assert 2 not in dbw.ready_since
+        assert dbw.stats['last_batch_latency'] >= 0.0
+        assert dbw.stats['idle_time_since_start'] == 0.0
+        dbw.consume_incoming()
+        assert dbw.stats['idle_time_since_start'] > 0.0
+        for call in [dbw.slot.new_batch, dbw.slot.consumption, dbw.slot.scheduling, dbw.slot.scoring_consumption]:
+            call.cancel()
+
+    def test_apply_threads(self):
+        dbw = self.dbw_setup(True, threads=2)
+        r4 = Request('http://www.example.com/other', meta={b'fingerprint': b'4', b'state': States.DEFAULT, b'jid': 0,
+                                                          b'domain': {b'fingerprint': sha1(b'www.example.com')}})
+        msgs = [dbw._encoder.encode_add_seeds([r1, r2, r3]),
+                dbw._encoder.encode_page_crawled(Response(r4.url, request=r4)),
+                dbw._encoder.encode_links_extracted(r4, [r2, r3]),
+                dbw._encoder.encode_request_error(r1, 'error')]
+        dbw.spider_log_consumer.put_messages(msgs)
+        assert dbw.consume_incoming() == 4
+        dbw.apply_stage.join()
+        assert set([r.url for r in dbw._backend.seeds]) == set([r1.url, r2.url, r3.url])
+        assert [r.url for r in dbw._backend.responses] == [r4.url]
+        assert set([r.url for r in dbw._backend.links]) == set([r2.url, r3.url])
+        assert dbw._backend.errors[0][0].url == r1.url
+        stages = dbw.stage_stats()
+        assert stages['decode']['items'] == 4 and stages['apply']['items'] == 4
+        assert stages['apply']['queue_depth'] == 0
+        dbw.stop()
+        assert not dbw.apply_stage.thread.is_alive()
+
+    def test_backend_calls_serialized(self):
+        dbw = self.dbw_setup(True, threads=4)
+        active = []
+        concurrency = []
+
+        def exclusive(method):
+            def wrapper(*args, **kwargs):
+                active.append(method)
+                concurrency.append(len(active))
+                sleep(0.001)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    active.pop()
+            return wrapper
+
+        dbw._backend.page_crawled = exclusive(dbw._backend.page_crawled)
+        dbw._backend.get_next_requests = exclusive(dbw._backend.get_next_requests)
+        requests = [Request('http://www.example%d.com/' % i,
+                            meta={b'fingerprint': sha1(str(i)), b'state': States.DEFAULT, b'jid': 0,
+                                  b'domain': {b'fingerprint': sha1('www.example%d.com' % i)}})
+                    for i in range(40)]
+        dbw._backend.queue.put_requests(requests)
+        dbw.spider_log_consumer.put_messages([dbw._encoder.encode_page_crawled(Response(r.url, request=r))
+                                              for r in requests])
+        batches = Thread(target=lambda: [dbw.new_batch() for _ in range(40)])
+        batches.start()
+        assert dbw.consume_incoming() == 40
+        batches.join()
+        dbw.apply_stage.join()
+        assert len(dbw._backend.responses) == 40
+        assert len(dbw.spider_feed_producer.messages) == 40
+        assert max(concurrency) == 1
+        dbw.stop()
+
+    def test_prefetch(self):
+        assert self.dbw_setup(True, prefetch_time=10.0).prefetch_time == 0.0
+        dbw = self.dbw_setup(True, threads=1, prefetch_time=10.0)
+        dbw.max_next_requests = 2
+        requests = [Request('http://www.example.com/%d' % i, meta={b'fingerprint': sha1(str(i)), b'jid': 0})
+                    for i in range(10)]
+        dbw._backend.queue.put_requests(requests)
+        # partitions without spiders aren't prefetched
+        dbw.prefetch()
+        assert dbw.prefetched == {} and dbw._backend.queue.count() == 10
+        dbw.spider_log_consumer.put_messages([dbw._encoder.encode_offset(0, 0)])
+        dbw.consume_incoming()
+        assert dbw.new_batch() == 2
+        assert len(dbw.prefetched[0]) == 2 and dbw._backend.queue.count() == 6
+        assert dbw.new_batch() == 2
+        assert len(dbw.spider_feed_producer.messages) == 4
+        # partition consumed two batches in a moment, all the rest is prefetched
+        assert dbw.consumption_rate[0] > 1.0
+        assert len(dbw.prefetched[0]) == 6 and dbw._backend.queue.count() == 0
+        assert dbw.stats['prefetched'] == 6
+        dbw.job_id = 1
+        assert dbw.new_batch() == 2
+        assert dbw._decoder.decode_request(dbw.spider_feed_producer.messages[-1]).meta[b'jid'] == 1
+        # prefetched requests are put back to backend queue on stop
+        dbw.stop()
+        assert dbw.prefetched == {} and dbw._backend.queue.count() == 4
+
+    def test_scoring_coalesced(self):
+        dbw = self.dbw_setup(True)
+        dbw.score_buffer.flush_interval = 60.0
+        msgs = [dbw._encoder.encode_update_score(r1, 0.5, True),
+                dbw._encoder.encode_update_score(r3, 0.6, False),
+                dbw._encoder.encode_update_score(r1, 0.7, False),
+                dbw._encoder.encode_update_score(r3, 0.8, True)]
+        # fake consumer returns messages from the end
+        dbw.scoring_log_consumer.put_messages(msgs[::-1])
+        dbw.consume_scoring()
+        assert dbw._backend.queue.requests == []
+        assert dbw.stats['score_updates_buffered'] == 2
+        assert dbw.stats['score_updates_collapsed'] == 2
+        dbw.score_buffer.flush_interval = 0.0
+        dbw.consume_scoring()
+        assert sorted((r.url, r.meta[b'score']) for r in dbw._backend.queue.requests) == [(r1.url, 0.7), (r3.url, 0.8)]
+        assert dbw.stats['score_updates_buffered'] == 0
@@ -1,8 +1,10 @@
 from frontera.worker.strategy import StrategyWorker
+from frontera.worker.strategies import BaseCrawlingStrategy
 from frontera.worker.strategies.bfs import CrawlingStrategy
 from frontera.settings import Settings
 from frontera.core.models import Request, Response
 from frontera.core.components import States
+from frontera.utils.fingerprint import sha1
 
 
 r1 = Request('http://www.example.com/', meta={b'fingerprint': b'1', b'jid': 0})
@@ -11,14 +13,20 @@ r3 = Request('https://www.dmoz.org', meta={b'fingerprint': b'3', b'jid': 0})
 r4 = Request('http://www.test.com/some/page', meta={b'fingerprint': b'4', b'jid': 0})
 
 
+class BatchScoringStrategy(CrawlingStrategy):
+    def links_extracted_batch(self, urls, depths, states, domains, inbound):
+        self.columns = (urls, depths, states, domains, inbound)
+        return [float('nan'), 0.5, None], [True, True, False]
+
+
 class TestStrategyWorker(object):
 
-    def sw_setup(self):
+    def sw_setup(self, strategy_class=CrawlingStrategy):
         settings = Settings()
         settings.BACKEND = 'frontera.contrib.backends.sqlalchemy.Distributed'
         settings.MESSAGE_BUS = 'tests.mocks.message_bus.FakeMessageBus'
         settings.SPIDER_LOG_CONSUMER_BATCH_SIZE = 100
-        return StrategyWorker(settings, CrawlingStrategy)
+        return StrategyWorker(settings, strategy_class)
 
     def test_add_seeds(self):
         sw = self.sw_setup()
@@ -71,3 +79,70 @@ class TestStrategyWorker(object):
         r4.meta[b'state'] = States.ERROR
         assert sw.scoring_log_producer.messages.pop() == \
             sw._encoder.encode_update_score(r4, 0.0, False)
+
+    def test_links_extracted_batch(self):
+        sw = self.sw_setup(BatchScoringStrategy)
+        sw.job_id = 0
+        r1.meta[b'jid'] = 0
+        links = [Request('http://www.example.com/%d' % i, meta={b'fingerprint': b'l%d' % i, b'depth': i,
+                                                                  b'domain': {b'name': b'example.com'}})
+                 for i in range(3)]
+        sw.consumer.put_messages([sw._encoder.encode_links_extracted(r1, links[1:]),
+                                  sw._encoder.encode_links_extracted(r1, links[:1])])
+        sw.work()
+        urls, depths, states, domains, inbound = sw.strategy.columns
+        assert urls == [l.url for l in links] and depths == [0, 1, 2] and inbound == [1, 1, 1]
+        assert states == [States.NOT_CRAWLED] * 3 and domains == [b'example.com'] * 3
+        links[1].meta[b'state'] = States.QUEUED
+        assert sw.scoring_log_producer.messages == [sw._encoder.encode_update_score(links[1], 0.5, True)]
+        states = [l.copy() for l in links]
+        sw.states.set_states(states)
+        assert [l.meta[b'state'] for l in states] == [States.NOT_CRAWLED, States.QUEUED, States.NOT_CRAWLED]
+
+    def test_batch_scoring_opt_in(self):
+        assert not BaseCrawlingStrategy.batch_scoring
+        sw = self.sw_setup(BatchScoringStrategy)
+        assert sw.batch_scoring
+        columns = ([r1.url, r2.url], [0, 1], [States.NOT_CRAWLED] * 2, [None, None], [1, 1])
+        assert BaseCrawlingStrategy.links_extracted_batch(sw.strategy, *columns) == ([None, None], [False, False])
+
+    def test_state_cache_checkpoint(self, tmpdir):
+        settings = Settings()
+        settings.BACKEND = 'frontera.contrib.backends.sqlalchemy.Distributed'
+        settings.MESSAGE_BUS = 'tests.mocks.message_bus.FakeMessageBus'
+        settings.STATE_CACHE_CHECKPOINT_DIR = str(tmpdir)
+        sw = StrategyWorker(settings, CrawlingStrategy)
+        link = Request('http://www.example.com/page', meta={b'fingerprint': sha1('http://www.example.com/page'),
+                                                            b'state': States.CRAWLED})
+        sw.states.update_cache([link])
+        sw.stop()
+        assert tmpdir.join('states-0.bin').check()
+
+        sw = StrategyWorker(settings, CrawlingStrategy)
+        link.meta[b'state'] = States.DEFAULT
+        sw.states.set_states([link])
+        assert link.meta[b'state'] == States.CRAWLED
+        # checkpoint is loaded once, crash of this worker leaves no stale checkpoint behind
+        assert not tmpdir.join('states-0.bin').check()
+
+    def test_links_collapsed(self):
+        sw = self.sw_setup()
+        r1.meta[b'jid'] = 0
+        r2.meta[b'jid'] = 0
+        link = Request('http://www.example.com/popular', meta={b'fingerprint': b'popular'})
+        counts = []
+        sw.batch_scoring = False
+        sw.strategy.links_extracted = lambda request, links: counts.append(
+            [(l.url, sw.strategy.inbound_count(l)) for l in links])
+        sw.consumer.put_messages([sw._encoder.encode_links_extracted(r2, [link, r4]),
+                                  sw._encoder.encode_links_extracted(r1, [link, r3])])
+        sw.work()
+        assert counts == [[(link.url, 2), (r3.url, 1)], [(r4.url, 1)]]
+        assert sw.stats['last_links_collapsed'] == 1
+        assert sw.states_context.inbound == {}
+
+        sw.strategy.schedule(link, 0.5)
+        sw.strategy.schedule(link, 0.7)
+        sw.update_score.flush()
+        assert sw.scoring_log_producer.messages == [sw._encoder.encode_update_score(link, 0.7, True)]
+        assert sw.update_score.collapsed == 1
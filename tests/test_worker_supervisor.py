@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from twisted.internet.task import Clock
+from twisted.internet.error import ProcessTerminated, ProcessDone
+from twisted.python.failure import Failure
+from frontera.worker.supervisor import StrategyWorkerSupervisor, parse_partitions, STATS_FD
+import pytest
+
+
+class FakeTransport(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.signals = []
+
+    def signalProcess(self, name):
+        self.signals.append(name)
+
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, process_protocol, executable, args, env=None, childFDs=None):
+        process_protocol.makeConnection(FakeTransport(100 + len(self.spawned)))
+        self.spawned.append((process_protocol, args))
+
+
+def test_parse_partitions():
+    assert parse_partitions(None, 4) == [0, 1, 2, 3]
+    assert parse_partitions('0-2,5,1', 8) == [0, 1, 2, 5]
+    with pytest.raises(ValueError):
+        parse_partitions('3', 2)
+
+
+def test_supervisor():
+    reactor = FakeReactor()
+    supervisor = StrategyWorkerSupervisor(['--config', 'settings'], [0, 1], reactor=reactor)
+    supervisor.start()
+    assert [args[args.index('--partition-id') + 1] for _, args in reactor.spawned] == ['0', '1']
+
+    worker0, worker1 = supervisor.workers[0], supervisor.workers[1]
+    worker0.childDataReceived(STATS_FD, b'{"consumed_since_start": 10}\n{"consumed_')
+    worker0.childDataReceived(STATS_FD, b'since_start": 20}\n')
+    worker1.childDataReceived(STATS_FD, b'{"consumed_since_start": 5}\n')
+    status = supervisor.status()
+    assert status['consumed_since_start'] == 25 and status['running'] == 2
+
+    # crashed worker is restarted after delay, finished one isn't
+    worker0.processEnded(Failure(ProcessTerminated(exitCode=1)))
+    worker1.processEnded(Failure(ProcessDone(0)))
+    assert len(reactor.spawned) == 2
+    reactor.advance(1.0)
+    assert len(reactor.spawned) == 3
+    assert supervisor.workers[0] is not worker0 and supervisor.status()['workers']['0']['restarts'] == 1
+    supervisor.workers[0].processEnded(Failure(ProcessTerminated(exitCode=1)))
+    reactor.advance(1.0)
+    assert len(reactor.spawned) == 3
+    reactor.advance(1.0)
+    assert len(reactor.spawned) == 4
+
+    stopped = supervisor.stop()
+    assert supervisor.workers[0].transport.signals == ['TERM']
+    assert not stopped.called
+    supervisor.workers[0].processEnded(Failure(ProcessTerminated(exitCode=1)))
+    assert stopped.called
+    reactor.advance(60.0)
+    assert len(reactor.spawned) == 4
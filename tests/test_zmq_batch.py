@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from frontera.contrib.messagebus.zeromq.batch import Batch, get_codec, decompress, split, CODEC_NONE, CODEC_ZLIB
+import pytest
+
+
+messages = [b'', b'message', b'x' * 1024, b'\x00\x01\x02']
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_batch_roundtrip(compression):
+    codec, compress = get_codec(compression)
+    batch = Batch()
+    for msg in messages:
+        batch.append(msg)
+    assert batch.count == 4
+    assert batch.size == sum(len(m) + 4 for m in messages)
+    payload = compress(batch.payload())
+    assert list(split(decompress(codec, payload))) == messages
+    assert [bytes(m) for m in split(memoryview(decompress(codec, payload)))] == messages
+
+
+def test_codecs():
+    assert get_codec(None)[0] == CODEC_NONE
+    assert get_codec('none')[0] == CODEC_NONE
+    assert get_codec('zlib')[0] == CODEC_ZLIB
+    with pytest.raises(NameError):
+        get_codec('bzip2')
+    with pytest.raises(TypeError):
+        decompress(100, b'')